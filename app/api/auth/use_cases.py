@@ -8,7 +8,6 @@ from uuid import uuid4
 from fastapi import Depends
 from fastapi import HTTPException
 import jwt
-from requests_oauthlib import OAuth2Session
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession
 
@@ -21,20 +20,21 @@ from app.settings import get_config
 from .schemas import AuthLoginResponse
 from .schemas import GoogleUser
 
-config = get_config()
-
-OAUTH_CONFIG = {
-    "GOOGLE": {
-        "TOKEN_URL": "https://accounts.google.com/o/oauth2/token",
-        "USERINFO_URL": "https://www.googleapis.com/oauth2/v1/userinfo",
-        "REDIRECT_URL": f"{config.base_url}/api/v1/auth/google/callback",
-    },
-    "GITHUB": {
-        "TOKEN_URL": "https://github.com/login/oauth/access_token",
-        "USERINFO_URL": "https://api.github.com/user",
-        "REDIRECT_URL": f"{config.base_url}/api/v1/auth/github/callback",
-    },
-}
+
+def oauth_config(config: Config) -> dict[str, dict[str, str]]:
+    return {
+        "GOOGLE": {
+            "TOKEN_URL": "https://accounts.google.com/o/oauth2/token",
+            "USERINFO_URL": "https://www.googleapis.com/oauth2/v1/userinfo",
+            "REDIRECT_URL": f"{config.base_url}/api/v1/auth/google/callback",
+        },
+        "GITHUB": {
+            "TOKEN_URL": "https://github.com/login/oauth/access_token",
+            "USERINFO_URL": "https://api.github.com/user",
+            "REDIRECT_URL": f"{config.base_url}/api/v1/auth/github/callback",
+        },
+    }
+
 
 # class AuthLogin:
 
@@ -64,6 +64,10 @@ class AuthGoogleCallback:
                            Depends(get_session)],
         config: Annotated[Config, Depends(get_config)],
     ) -> None:
+        # requests_oauthlib pulls in requests and oauthlib, only load them
+        # once someone actually logs in
+        from requests_oauthlib import OAuth2Session
+
         self.dbsession = session
         self.config = config
         self.oauth = OAuth2Session(
@@ -72,13 +76,14 @@ class AuthGoogleCallback:
         )
 
     async def execute(self, code: str) -> AuthLoginResponse:
+        urls = oauth_config(self.config)["GOOGLE"]
         _ = self.oauth.fetch_token(
-            OAUTH_CONFIG["GOOGLE"]["TOKEN_URL"],
+            urls["TOKEN_URL"],
             code,
             client_secret=self.config.oauth.client_secret,
         )
 
-        res = self.oauth.get(OAUTH_CONFIG["GOOGLE"]["USERINFO_URL"])
+        res = self.oauth.get(urls["USERINFO_URL"])
         data: GoogleUser = res.json()
 
         async with self.dbsession() as session:
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from http import HTTPStatus
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse
+
+from app.service.idempotency import fingerprint
+from app.service.idempotency import IdempotencyConflict
+from app.service.idempotency import IdempotencyStore
+from app.service.idempotency import RequestInProgress
+from app.service.idempotency import StoredResponse
+
+logger = logging.getLogger(__name__)
+
+
+async def idempotent(
+    store: IdempotencyStore,
+    user_id: int,
+    endpoint: str,
+    key: Optional[str],
+    request: tuple[Any, ...],
+    run: Callable[[], Awaitable[StoredResponse]],
+) -> ORJSONResponse:
+    """Runs *run* once per Idempotency-Key. *request* holds the JSON-able
+    parts of the request (path parameters, body), a key sent again with
+    other parts is refused. Without Redis the request runs unprotected."""
+    from redis.exceptions import RedisError
+
+    digest = fingerprint(*request)
+    stored = None
+    if key is not None:
+        try:
+            stored = await store.begin(user_id, endpoint, key, digest)
+        except IdempotencyConflict as e:
+            raise HTTPException(HTTPStatus.UNPROCESSABLE_ENTITY, str(e))
+        except RequestInProgress as e:
+            raise HTTPException(HTTPStatus.CONFLICT,
+                                str(e),
+                                headers={"Retry-After": "1"})
+        except RedisError as e:
+            logger.warning("idempotency key ignored, redis failed: %r", e)
+            key = None
+    if stored is not None:
+        return ORJSONResponse(stored.body,
+                              status_code=stored.status,
+                              headers={"Idempotent-Replayed": "true"})
+
+    try:
+        response = await run()
+    except BaseException:
+        if key is not None:
+            try:
+                await store.abort(user_id, endpoint, key)
+            except RedisError:
+                logger.exception("failed to release idempotency key %s", key)
+        raise
+
+    if key is not None:
+        try:
+            await store.complete(user_id, endpoint, key, digest, response)
+        except RedisError:
+            logger.exception("failed to store the response of %s", key)
+    return ORJSONResponse(response.body, status_code=response.status)
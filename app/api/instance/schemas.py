@@ -4,8 +4,17 @@ from typing import Literal, Optional
 from uuid import UUID
 
 from pydantic import BaseModel
+from pydantic import ConfigDict
+from pydantic import Field
+from pydantic import model_validator
 
 from app.models import InstanceSchema
+from app.service.snapshots import NAME_PATTERN
+
+# suspend keeps the guest in memory and resumes instantly, hibernate saves
+# its memory to disk and frees it. pause is the former name of suspend.
+InstanceState = Literal["start", "poweroff", "suspend", "resume", "hibernate",
+                        "pause"]
 
 
 class InstanceListResponse(BaseModel):
@@ -22,27 +31,177 @@ class InstanceUpdateNameResponse(BaseModel):
 
 
 class InstanceStateRequest(BaseModel):
-    state: Literal["start", "poweroff", "pause"]
+    state: InstanceState
 
 
 class InstanceStateResponse(BaseModel):
-    state: Literal["start", "poweroff", "pause"]
+    state: InstanceState
+
+
+class InstanceSnapshotRequest(BaseModel):
+    name: str = Field(pattern=NAME_PATTERN)
+    # save the memory too, reverting resumes the guest where it was
+    memory: bool = False
+    description: Optional[str] = None
 
 
-class InstanceCreateRequest(BaseModel):
+class InstanceSnapshotSchema(BaseModel):
     name: str
+    created: int
+    state: str
+    memory: bool
+    current: bool
+    description: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
+
+
+class InstanceSnapshotListResponse(BaseModel):
+    snapshots: list[InstanceSnapshotSchema]
+
+
+class InstanceFilter(BaseModel):
+    owner: Optional[int] = None
+    name_prefix: Optional[str] = None
+    state: Optional[Literal["running", "off"]] = None
+
+
+class InstanceBulkStateRequest(BaseModel):
+    state: InstanceState
+    ids: Optional[list[UUID]] = None
+    filter: Optional[InstanceFilter] = None
+
+    @model_validator(mode="after")
+    def check_target(self) -> InstanceBulkStateRequest:
+        if (self.ids is None) == (self.filter is None):
+            raise ValueError("either ids or filter must be given")
+        return self
+
+
+class InstanceBulkStateResult(BaseModel):
+    id: UUID
+    name: Optional[str] = None
+    ok: bool
+    error: Optional[str] = None
+
+
+class InstanceBulkStateResponse(BaseModel):
+    state: InstanceState
+    succeeded: int
+    failed: int
+    results: list[InstanceBulkStateResult]
+
+
+class InstanceQosRequest(BaseModel):
+    # None falls back to the owner's tier, or the default one
+    qos: Optional[str] = None
+
+
+class InstanceQosResponse(BaseModel):
+    id: UUID
+    # tier in effect, None is unlimited
+    qos: Optional[str] = None
+
+
+class InstanceOwnerQosResponse(BaseModel):
+    # tier in effect for the owner's instances without one of their own
+    qos: Optional[str] = None
+    succeeded: int
+    failed: int
+    results: list[InstanceBulkStateResult]
+
+
+class InstanceTemplate(BaseModel):
     os: str
     vcpu: int
     ram: int
     ram_unit: Literal["KiB", "MiB", "GiB"]
     size: int
     root_password: str
+    # dedicated: vCPUs pinned to host cores of their own, memory bound to
+    # the NUMA cells of those cores and optionally backed by hugepages
+    profile: Literal["shared", "dedicated"] = "shared"
+    hugepages: bool = False
+    # disk and NIC drivers, one of the profiles of the config, its
+    # default_profile when unset
+    performance: Optional[str] = None
+    # QoS tier of the instance, admins only. Otherwise it is in its
+    # owner's tier
+    qos: Optional[str] = None
+
+
+class InstanceCreateRequest(InstanceTemplate):
+    name: str
     hostname: Optional[str] = None
 
 
+class InstanceBatchCreateRequest(BaseModel):
+    template: InstanceTemplate
+    count: Optional[int] = Field(default=None, ge=1, le=100)
+    prefix: Optional[str] = None
+    names: Optional[list[str]] = Field(default=None,
+                                       min_length=1,
+                                       max_length=100)
+
+    @model_validator(mode="after")
+    def check_names(self) -> InstanceBatchCreateRequest:
+        if (self.count is None) == (self.names is None):
+            raise ValueError("either count or names must be given")
+        if self.count is not None and not self.prefix:
+            raise ValueError("prefix is required together with count")
+        return self
+
+    @property
+    def instance_names(self) -> list[str]:
+        if self.names is not None:
+            return self.names
+        assert self.count is not None
+        return [f"{self.prefix}-{i}" for i in range(1, self.count + 1)]
+
+
 class InstanceCreateResponse(BaseModel):
     jobid: UUID
 
 
+class InstanceJobStageSchema(BaseModel):
+    name: str
+    start: float
+    end: float
+    duration: float
+    error: Optional[str] = None
+    model_config = ConfigDict(from_attributes=True)
+
+
+class InstanceJobItemSchema(BaseModel):
+    name: str
+    status: Literal["QUEUED", "PROCESSING", "COMPLETED", "FAILED"]
+    host: Optional[str] = None
+    instance_id: Optional[UUID] = None
+    error: Optional[str] = None
+    stages: list[InstanceJobStageSchema] = []
+    # waiting items only: provisioning runs of the host served before this
+    # one, and the estimated seconds until it gets its turn
+    position: Optional[int] = None
+    eta: Optional[float] = None
+    model_config = ConfigDict(from_attributes=True)
+
+
 class InstanceJobStatusResponse(BaseModel):
     status: Literal["QUEUED", "PROCESSING", "COMPLETED"]
+    items: list[InstanceJobItemSchema] = []
+
+
+class InstanceStageStats(BaseModel):
+    name: str
+    count: int
+    errors: int
+    mean: float
+    # upper bound of the histogram bucket, None when past the last one
+    p50: Optional[float] = None
+    p95: Optional[float] = None
+    p99: Optional[float] = None
+    buckets: dict[str, int] = {}
+
+
+class InstanceStageStatsResponse(BaseModel):
+    # slowest stages (by mean duration) first
+    stages: list[InstanceStageStats] = []
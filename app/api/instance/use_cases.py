@@ -1,56 +1,141 @@
+import asyncio
 from http import HTTPStatus
-from typing import Annotated, AsyncIterator
+import logging
+import os
+from typing import Annotated, Any, AsyncIterator, Callable, Optional, TYPE_CHECKING, TypeVar
 from uuid import UUID
 
 from fastapi import Depends
 from fastapi import HTTPException
-import libvirt
+from fastapi import status
+from fastapi import WebSocket
+from fastapi import WebSocketException
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession
 
-import app.db
+from app.db import get_address_resolver
+from app.db import get_console_proxy
+from app.db import get_cpu_placement
+from app.db import get_inventory_reader
+from app.db import get_ipam
+from app.db import get_ledger
 from app.db import get_session
-from app.db import get_virt
+from app.db import get_virt_pool
+from app.models import Address
 from app.models import Instance
 from app.models import InstanceSchema
+from app.models import NameReservation
 from app.models import User
 from app.models import UserSchema
+from app.service.addresses import AddressResolver
+from app.service.console import ConsoleBusy
+from app.service.console import ConsoleError
+from app.service.console import ConsoleProxy
+from app.service.console import vnc_address
+from app.service.inventory import domain_fields
+from app.service.inventory import InventoryReader
+from app.service.ipam import IPAM
+from app.service.ipam import remove_dhcp_host
+from app.service.ledger import Allocation
+from app.service.ledger import Ledger
+from app.service.pinning import CpuPlacement
+from app.service.qos import apply_tier
+from app.service.qos import get_tier
+from app.service.qos import QosError
+from app.service.qos import tier_name
+from app.service.resilience import HostUnavailable
+from app.service.snapshots import create_snapshot
+from app.service.snapshots import delete_snapshot
+from app.service.snapshots import list_snapshots
+from app.service.snapshots import revert_snapshot
+from app.service.snapshots import snapshot_files
+from app.service.snapshots import SnapshotError
+from app.service.snapshots import SnapshotInfo
+from app.service.virt import lookup_domains
 from app.service.virt import Virt
+from app.service.virt import VirtPool
+from app.settings import Config
+from app.settings import get_config
+from app.settings import QosTier
 
+from .schemas import InstanceBulkStateRequest
+from .schemas import InstanceBulkStateResponse
+from .schemas import InstanceBulkStateResult
 from .schemas import InstanceCreateRequest
+from .schemas import InstanceFilter
+from .schemas import InstanceOwnerQosResponse
+from .schemas import InstanceQosResponse
+from .schemas import InstanceSnapshotRequest
 from .schemas import InstanceStateResponse
 
+if TYPE_CHECKING:
+    import libvirt
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
 AsyncSessionMaker = Annotated[async_sessionmaker[AsyncSession],
                               Depends(get_session)]
 
 
-def transform_domain(domain: libvirt.virDomain) -> InstanceSchema:
-    name = domain.name()
-    uuid = UUID(domain.UUIDString())
-    state, max_mem, mem, vcpu, time = domain.info()
-    if state == libvirt.VIR_DOMAIN_RUNNING:
-        state = "running"
-        vcpu = domain.maxVcpus()
-        ram = domain.maxMemory()
-        iface = list(
-            domain.interfaceAddresses(
-                libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE).items())
-        if len(iface) > 0:
-            _, val = iface[0]
-            ip = val["addrs"][0]["addr"]
+def transform_domain(
+        domain: "libvirt.virDomain",
+        ip: Optional[str] = None,
+        resolver: Optional[AddressResolver] = None) -> InstanceSchema:
+    return InstanceSchema(**domain_fields(domain, ip, resolver))
+
+
+def with_ip(fields: dict[str, Any], ip: Optional[str]) -> dict[str, Any]:
+    # the worker publishing the inventory doesn't know what IPAM assigned
+    return fields if ip is None else {**fields, "ip": ip}
+
+
+def lookup_fields(conn: "libvirt.virConnect", id: UUID, ip: Optional[str],
+                  resolver: AddressResolver) -> dict[str, Any]:
+    return domain_fields(conn.lookupByUUID(id.bytes), ip, resolver)
+
+
+def set_state(virt: Virt, id: UUID, state: str) -> None:
+    apply_state(virt.get_vm_by_id(id), state)
+
+
+def domain_xml(conn: "libvirt.virConnect", id: UUID) -> str:
+    return conn.lookupByUUIDString(str(id)).XMLDesc(0)
+
+
+def apply_state(domain: "libvirt.virDomain", state: str) -> None:
+    import libvirt
+
+    if state == "start":
+        domain.create()
+    elif state == "poweroff":
+        domain.destroy()
+    elif state in ("suspend", "pause"):
+        # vCPUs stop, the memory stays where it is
+        domain.suspend()
+    elif state == "hibernate":
+        # memory written to disk, it's read back by the next start
+        domain.managedSave()
+    elif state == "resume":
+        if domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
+            domain.resume()
         else:
-            ip = ""
+            domain.create()
     else:
-        ram = int(max_mem)
-        vcpu = int(vcpu)
-        ip = ""
-        state = "off"
-    return InstanceSchema(id=uuid,
-                          name=name,
-                          ip=ip,
-                          vcpu=vcpu,
-                          ram=ram,
-                          state=state)
+        raise ValueError(f"Unhandled state {state!r}")
+
+
+def match_filter(domain: "libvirt.virDomain", filter: InstanceFilter) -> bool:
+    import libvirt
+
+    if filter.name_prefix and not domain.name().startswith(filter.name_prefix):
+        return False
+    if filter.state is not None:
+        running = domain.state()[0] == libvirt.VIR_DOMAIN_RUNNING
+        if running != (filter.state == "running"):
+            return False
+    return True
 
 
 class InstanceList:
@@ -58,15 +143,114 @@ class InstanceList:
     def __init__(
         self,
         session: AsyncSessionMaker,
-        virt: Annotated[Virt, Depends(get_virt)],
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        resolver: Annotated[AddressResolver,
+                            Depends(get_address_resolver)],
+        inventory: Annotated[Optional[InventoryReader],
+                             Depends(get_inventory_reader)],
     ) -> None:
         self.dbsession = session
-        self.virt = virt
+        self.pool = pool
+        self.resolver = resolver
+        self.inventory = inventory
+        # hosts listed from their last known state, they didn't answer
+        self.stale_hosts: list[str] = []
 
-    async def execute(self, user: UserSchema) -> AsyncIterator[InstanceSchema]:
-        domains = self.virt.get_vms()
-        for domain in domains:
-            yield transform_domain(domain)
+    def host_fields(self, conn: "libvirt.virConnect", ids: Optional[list[UUID]],
+                    ips: dict[UUID, str]) -> list[dict[str, Any]]:
+        # domain_fields makes RPCs too, it runs on a thread of the host
+        if ids is None:
+            domains = conn.listAllDomains()
+        else:
+            domains = lookup_domains(conn, ids)
+        return [
+            domain_fields(domain, ips.get(UUID(domain.UUIDString())),
+                          self.resolver) for domain in domains
+        ]
+
+    async def host_instances(self, host: str, ids: Optional[list[UUID]],
+                             ips: dict[UUID, str]) -> list[dict[str, Any]]:
+        listed = self.inventory.host(host) if self.inventory else None
+        if listed is not None:
+            if ids is None:
+                found = list(listed.domains.values())
+            else:
+                found = [
+                    listed.domains[id] for id in ids if id in listed.domains
+                ]
+            return [with_ip(f, ips.get(f["id"])) for f in found]
+
+        virt = self.pool.get(host)
+        try:
+            fields = await virt.read("list", self.host_fields, ids, ips)
+        except HostUnavailable:
+            self.stale_hosts.append(host)
+            if ids is None:
+                return list(virt.known.values())
+            return [virt.known[id] for id in ids if id in virt.known]
+        if ids is None:
+            virt.known = {f["id"]: f for f in fields}
+        else:
+            virt.known.update((f["id"], f) for f in fields)
+        return fields
+
+    async def execute(self, user: UserSchema) -> AsyncIterator[dict[str, Any]]:
+        """Listed instances as plain InstanceSchema dicts, a listing is
+        encoded without building (and validating) a model per instance.
+        Hosts that don't answer in time are listed as they last were, and
+        added to stale_hosts."""
+        async with self.dbsession() as session:
+            user_obj = await User.get_by_id(session, user.id)
+            if not user_obj:
+                raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid User")
+            by_host = None
+            if not user_obj.is_admin:
+                by_host = await Instance.get_ids_by_host(session,
+                                                         user_id=user.id)
+                ips = await Address.get_ips(
+                    session, [id for ids in by_host.values() for id in ids])
+            else:
+                ips = await Address.get_ips(session)
+
+        if by_host is None:
+            lookups = [
+                self.host_instances(host, None, ips) for host in self.pool.hosts
+            ]
+        else:
+            # only the user's own domains are looked up, listing cost follows
+            # the number of instances owned instead of the size of the host
+            lookups = [
+                self.host_instances(host, ids, ips)
+                for host, ids in by_host.items()
+                if host in self.pool.uris
+            ]
+
+        for instances in await asyncio.gather(*lookups):
+            for instance in instances:
+                yield instance
+
+
+def host_of(instance: Optional[Instance], pool: VirtPool) -> str:
+    if instance is None or instance.host not in pool.uris:
+        # domains defined outside of the API live on the default host
+        return pool.default
+    return instance.host
+
+
+def on_known_hosts(by_host: dict[str, list[UUID]],
+                   pool: VirtPool) -> dict[str, list[UUID]]:
+    """*by_host* with the instances of unknown hosts on the default one,
+    as host_of() places them."""
+    known: dict[str, list[UUID]] = {}
+    for host, ids in by_host.items():
+        known.setdefault(host if host in pool.uris else pool.default,
+                         []).extend(ids)
+    return known
+
+
+async def locate(session: AsyncSession, pool: VirtPool, id: UUID) -> Virt:
+    return await pool.connect(
+        host_of(await Instance.get_by_id(session, id), pool))
 
 
 class InstanceDetail:
@@ -74,14 +258,38 @@ class InstanceDetail:
     def __init__(
         self,
         session: AsyncSessionMaker,
-        virt: Annotated[Virt, Depends(get_virt)],
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        resolver: Annotated[AddressResolver,
+                            Depends(get_address_resolver)],
+        inventory: Annotated[Optional[InventoryReader],
+                             Depends(get_inventory_reader)],
     ) -> None:
         self.dbsession = session
-        self.virt = virt
+        self.pool = pool
+        self.resolver = resolver
+        self.inventory = inventory
 
     async def execute(self, id: UUID, user: UserSchema) -> InstanceSchema:
-        domain = self.virt.conn.lookupByUUID(id.bytes)
-        return transform_domain(domain)
+        async with self.dbsession() as session:
+            instance = await Instance.get_by_id(session, id)
+            address = await Address.get_by_instance(session, id)
+        ip = address.ip if address is not None else None
+
+        host = host_of(instance, self.pool)
+        listed = self.inventory.host(host) if self.inventory else None
+        # a domain missing from the snapshot may be newer than it
+        if listed is not None and id in listed.domains:
+            return InstanceSchema(**with_ip(listed.domains[id], ip))
+
+        virt = self.pool.get(host)
+        try:
+            fields = await virt.read("read", lookup_fields, id, ip,
+                                     self.resolver)
+        except HostUnavailable:
+            if id not in virt.known:
+                raise
+            fields = virt.known[id]
+        return InstanceSchema(**fields)
 
 
 class InstanceUpdateName:
@@ -107,29 +315,488 @@ class InstanceUpdateName:
         return InstanceSchema.from_orm(instance)
 
 
+def remove_domain(virt: Virt, id: UUID, image_dir: str) -> Optional[Allocation]:
+    import libvirt
+
+    try:
+        domain = virt.get_vm_by_id(id)
+    except libvirt.libvirtError:
+        return None
+
+    _, max_mem, _, nr_vcpu, _ = domain.info()
+    try:
+        disk = domain.blockInfo("vda")[0]
+    except libvirt.libvirtError:
+        disk = 0
+
+    if domain.isActive():
+        domain.destroy()
+    domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+                         libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                         libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+
+    path = os.path.join(image_dir, domain.name())
+    if os.path.exists(path):
+        os.remove(path)
+    for path in snapshot_files(image_dir, domain.name()):
+        os.remove(path)
+
+    return Allocation(vcpu=nr_vcpu, ram=max_mem, disk=disk)
+
+
+class InstanceDelete:
+
+    def __init__(
+        self,
+        session: AsyncSessionMaker,
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        ledger: Annotated[Ledger, Depends(get_ledger)],
+        ipam: Annotated[IPAM, Depends(get_ipam)],
+        cpus: Annotated[CpuPlacement, Depends(get_cpu_placement)],
+        config: Annotated[Config, Depends(get_config)],
+    ) -> None:
+        self.dbsession = session
+        self.pool = pool
+        self.ledger = ledger
+        self.ipam = ipam
+        self.cpus = cpus
+        self.config = config
+
+    async def execute(self, id: UUID, user: UserSchema) -> None:
+        async with self.dbsession() as session:
+            instance = await Instance.get_by_id(session, id)
+            user_obj = await User.get_by_id(session, user.id)
+            if not instance or not user_obj:
+                raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Instance ID")
+            if instance.user_id != user.id and not user_obj.is_admin:
+                raise HTTPException(HTTPStatus.UNAUTHORIZED,
+                                    "Invalid Instance ID")
+
+            # rows from before hosts were recorded say "default"
+            host, owner = host_of(instance, self.pool), instance.user_id
+            virt = await self.pool.connect(host)
+            allocation = await virt.call("write", remove_domain, virt, id,
+                                         self.config.image_dir)
+            virt.known.pop(id, None)
+            # its dedicated CPUs, if any, are free again
+            self.cpus.forget(host)
+
+            await instance.delete(session)
+            await NameReservation.release(session, [id])
+
+            address = await self.ipam.release_instance(session, id)
+
+        if (address is not None and address.ip is not None and
+                address.host in self.pool.uris):
+            try:
+                virt = await self.pool.connect(address.host)
+                await virt.call("write", remove_dhcp_host, virt.conn,
+                                self.config.network.name, address.mac,
+                                address.ip)
+            except HostUnavailable as e:
+                # the instance is gone, a leftover host entry only pins an
+                # address IPAM no longer hands out
+                logger.warning("DHCP host of %s not removed: %s", id, e)
+
+        if allocation is not None:
+            await self.ledger.release(host, owner, id, allocation)
+
+
 class InstanceUpdateState:
 
     def __init__(
         self,
         session: AsyncSessionMaker,
-        virt: Annotated[Virt, Depends(get_virt)],
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
     ) -> None:
         self.dbsession = session
-        self.virt = virt
+        self.pool = pool
 
     async def execute(self, id: UUID, state: str) -> InstanceStateResponse:
-        dom = self.virt.get_vm_by_id(id)
+        import libvirt
 
-        if dom is None:
-            raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Instance ID")
+        async with self.dbsession() as session:
+            virt = await locate(session, self.pool, id)
 
-        if state == "start":
-            dom.create()
-        elif state == "poweroff":
-            dom.destroy()
-        elif state == "pause":
-            dom.managedSave()
-        else:
+        try:
+            await virt.call("write", set_state, virt, id, state)
+        except ValueError:
             raise HTTPException(HTTPStatus.BAD_REQUEST, "Unhandled state")
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Instance ID")
+            raise
+
+        return InstanceStateResponse(state=state)
+
+
+class InstanceBulkUpdateState:
+
+    def __init__(
+        self,
+        session: AsyncSessionMaker,
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+    ) -> None:
+        self.dbsession = session
+        self.pool = pool
+
+    def lookup(
+        self,
+        data: InstanceBulkStateRequest,
+        host: str,
+        ids: Optional[list[UUID]],
+        owned: Optional[set[UUID]],
+    ) -> tuple[list["libvirt.virDomain"], list[InstanceBulkStateResult]]:
+        import libvirt
+
+        virt = self.pool.get(host)
+        missing: list[InstanceBulkStateResult] = []
+        if ids is None:
+            domains = virt.get_vms()
+        else:
+            domains = []
+            for id in ids:
+                try:
+                    domains.append(virt.get_vm_by_id(id))
+                except libvirt.libvirtError:
+                    missing.append(
+                        InstanceBulkStateResult(id=id,
+                                                ok=False,
+                                                error="Invalid Instance ID"))
+
+        targets = []
+        for domain in domains:
+            if owned is not None and UUID(domain.UUIDString()) not in owned:
+                # only explicitly requested instances are reported back, a
+                # filter silently skips what the user doesn't own
+                if data.ids is not None:
+                    missing.append(
+                        InstanceBulkStateResult(id=UUID(domain.UUIDString()),
+                                                ok=False,
+                                                error="Invalid Instance ID"))
+                continue
+            if data.filter is not None and not match_filter(
+                    domain, data.filter):
+                continue
+            targets.append(domain)
+        return targets, missing
+
+    async def apply(self, host: str, domain: "libvirt.virDomain",
+                    state: str) -> InstanceBulkStateResult:
+        import libvirt
+
+        result = InstanceBulkStateResult(id=UUID(domain.UUIDString()),
+                                         name=domain.name(),
+                                         ok=True)
+        try:
+            await self.pool.get(host).call("write", apply_state, domain, state)
+        except (libvirt.libvirtError, HostUnavailable) as e:
+            result.ok = False
+            result.error = str(e)
+        return result
+
+    async def execute(self, data: InstanceBulkStateRequest,
+                      user: UserSchema) -> InstanceBulkStateResponse:
+        async with self.dbsession() as session:
+            user_obj = await User.get_by_id(session, user.id)
+            if not user_obj:
+                raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid User")
+
+            owned: Optional[set[UUID]] = None
+            if not user_obj.is_admin:
+                owned = set(await Instance.get_ids_by_user(session, user.id))
+
+            by_host: dict[str, Optional[list[UUID]]]
+            if data.ids is not None:
+                found = await Instance.get_ids_by_host(session, ids=data.ids)
+                by_host = dict(on_known_hosts(found, self.pool))
+                known = {id for ids in by_host.values() for id in ids or []}
+                unknown = [id for id in data.ids if id not in known]
+                if unknown:
+                    by_host.setdefault(self.pool.default, []).extend(unknown)
+            elif data.filter and data.filter.owner is not None:
+                owned_by = await Instance.get_ids_by_host(
+                    session, user_id=data.filter.owner)
+                by_host = dict(on_known_hosts(owned_by, self.pool))
+            else:
+                by_host = {host: None for host in self.pool.hosts}
+
+        results: list[InstanceBulkStateResult] = []
+        targets: list[tuple[str, libvirt.virDomain]] = []
+        for host, ids in by_host.items():
+            if host not in self.pool.uris:
+                continue
+            virt = self.pool.get(host)
+            try:
+                domains, missing = await virt.call("list", self.lookup, data,
+                                                   host, ids, owned)
+            except HostUnavailable as e:
+                # nothing is done on the host, what it had is reported failed
+                unreachable = ids if ids is not None else list(virt.known)
+                results.extend(
+                    InstanceBulkStateResult(id=id, ok=False, error=str(e))
+                    for id in unreachable
+                    if owned is None or id in owned)
+                continue
+            targets.extend((host, domain) for domain in domains)
+            results.extend(missing)
+
+        results += await asyncio.gather(
+            *(self.apply(host, domain, data.state) for host, domain in targets))
+
+        failed = sum(1 for result in results if not result.ok)
+        return InstanceBulkStateResponse(
+            state=data.state,
+            succeeded=len(results) - failed,
+            failed=failed,
+            results=results,
+        )
+
+
+async def owned_instance(session: AsyncSession, pool: VirtPool, id: UUID,
+                         user: UserSchema) -> Instance:
+    instance = await Instance.get_by_id(session, id)
+    user_obj = await User.get_by_id(session, user.id)
+    if not instance or not user_obj:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Instance ID")
+    if instance.user_id != user.id and not user_obj.is_admin:
+        raise HTTPException(HTTPStatus.UNAUTHORIZED, "Invalid Instance ID")
+    return instance
+
+
+async def owned_virt(session: AsyncSession, pool: VirtPool, id: UUID,
+                     user: UserSchema) -> Virt:
+    instance = await owned_instance(session, pool, id, user)
+    return await pool.connect(host_of(instance, pool))
+
+
+def snapshot_error(e: Exception) -> HTTPException:
+    import libvirt
+
+    if isinstance(e, SnapshotError):
+        return HTTPException(HTTPStatus.BAD_REQUEST, str(e))
+    if (isinstance(e, libvirt.libvirtError) and
+            e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT):
+        return HTTPException(HTTPStatus.NOT_FOUND, "Invalid Snapshot")
+    return HTTPException(HTTPStatus.CONFLICT, str(e))
+
+
+class InstanceSnapshot:
+    """Base of the snapshot use cases, runs *call* against the domain of an
+    instance the user may access."""
+
+    def __init__(
+        self,
+        session: AsyncSessionMaker,
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        config: Annotated[Config, Depends(get_config)],
+    ) -> None:
+        self.dbsession = session
+        self.pool = pool
+        self.config = config
+
+    async def run(self, id: UUID, user: UserSchema, call: Callable[..., T],
+                  *args: Any) -> T:
+        import libvirt
+
+        async with self.dbsession() as session:
+            virt = await owned_virt(session, self.pool, id, user)
+        try:
+            return await virt.call("snapshot", self.on_domain, virt, id, call,
+                                   *args)
+        except (SnapshotError, libvirt.libvirtError) as e:
+            raise snapshot_error(e)
+
+    @staticmethod
+    def on_domain(virt: Virt, id: UUID, call: Callable[..., T], *args:
+                  Any) -> T:
+        return call(virt.get_vm_by_id(id), *args)
+
+
+class InstanceSnapshotCreate(InstanceSnapshot):
+
+    async def execute(self, id: UUID, data: InstanceSnapshotRequest,
+                      user: UserSchema) -> SnapshotInfo:
+        return await self.run(id, user, create_snapshot, self.config.image_dir,
+                              data.name, data.memory, data.description)
+
+
+class InstanceSnapshotList(InstanceSnapshot):
+
+    async def execute(self, id: UUID, user: UserSchema) -> list[SnapshotInfo]:
+        return await self.run(id, user, list_snapshots)
+
+
+class InstanceSnapshotRevert(InstanceSnapshot):
+
+    async def execute(self, id: UUID, name: str,
+                      user: UserSchema) -> SnapshotInfo:
+        return await self.run(id, user, revert_snapshot, name)
+
+
+class InstanceSnapshotDelete(InstanceSnapshot):
+
+    async def execute(self, id: UUID, name: str, user: UserSchema) -> None:
+        await self.run(id, user, delete_snapshot, name)
+
+
+async def admin_user(session: AsyncSession, user: UserSchema) -> User:
+    user_obj = await User.get_by_id(session, user.id)
+    if not user_obj or not user_obj.is_admin:
+        raise HTTPException(HTTPStatus.FORBIDDEN, "Admins only")
+    return user_obj
+
+
+def check_tier(config: Config, qos: Optional[str]) -> None:
+    if qos is not None and qos not in config.qos:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid QoS tier")
+
+
+def retier(virt: Virt, id: UUID, tier: Optional[QosTier]) -> None:
+    apply_tier(virt.get_vm_by_id(id), tier)
+
+
+class InstanceUpdateQos:
+    """Puts an instance in a QoS tier of its own, or back in its owner's,
+    and applies the limits to its domain, live if it runs."""
+
+    def __init__(
+        self,
+        session: AsyncSessionMaker,
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        config: Annotated[Config, Depends(get_config)],
+    ) -> None:
+        self.dbsession = session
+        self.pool = pool
+        self.config = config
+
+    async def execute(self, id: UUID, qos: Optional[str],
+                      user: UserSchema) -> InstanceQosResponse:
+        import libvirt
+
+        check_tier(self.config, qos)
+        async with self.dbsession() as session:
+            await admin_user(session, user)
+            instance = await Instance.get_by_id(session, id)
+            if not instance:
+                raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Instance ID")
+            name = tier_name(self.config, qos, instance.user.qos)
+            virt = await self.pool.connect(host_of(instance, self.pool))
+            try:
+                await virt.call("write", retier, virt, id,
+                                get_tier(self.config, name))
+            except QosError as e:
+                raise HTTPException(HTTPStatus.CONFLICT, str(e))
+            except libvirt.libvirtError as e:
+                if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                    raise HTTPException(HTTPStatus.NOT_FOUND,
+                                        "Invalid Instance ID")
+                raise HTTPException(HTTPStatus.CONFLICT, str(e))
+            # recorded once the domain has the limits
+            await instance.update_qos(session, qos)
+            await session.commit()
+        return InstanceQosResponse(id=id, qos=name)
+
+
+class InstanceOwnerUpdateQos:
+    """Puts a user in a QoS tier, and applies it to every instance of
+    theirs without a tier of its own."""
+
+    def __init__(
+        self,
+        session: AsyncSessionMaker,
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        config: Annotated[Config, Depends(get_config)],
+    ) -> None:
+        self.dbsession = session
+        self.pool = pool
+        self.config = config
+
+    async def apply(self, host: str, id: UUID,
+                    tier: Optional[QosTier]) -> InstanceBulkStateResult:
+        import libvirt
+
+        result = InstanceBulkStateResult(id=id, ok=True)
+        if host not in self.pool.uris:
+            result.ok = False
+            result.error = "Invalid Instance ID"
+            return result
+        virt = self.pool.get(host)
+        try:
+            await virt.call("write", retier, virt, id, tier)
+        except (libvirt.libvirtError, HostUnavailable) as e:
+            result.ok = False
+            result.error = str(e)
+        return result
+
+    async def execute(self, owner_id: int, qos: Optional[str],
+                      user: UserSchema) -> InstanceOwnerQosResponse:
+        check_tier(self.config, qos)
+        async with self.dbsession() as session:
+            await admin_user(session, user)
+            owner = await User.get_by_id(session, owner_id)
+            if not owner:
+                raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid User")
+            await owner.update_qos(session, qos)
+            await session.commit()
+            by_host = on_known_hosts(
+                await Instance.get_ids_by_host(session,
+                                               user_id=owner_id,
+                                               untiered=True), self.pool)
+
+        # recorded first, instances failing here get the tier on a retry
+        name = tier_name(self.config, None, qos)
+        tier = get_tier(self.config, name)
+        results = await asyncio.gather(*(self.apply(host, id, tier)
+                                         for host, ids in by_host.items()
+                                         for id in ids))
+        failed = sum(1 for result in results if not result.ok)
+        return InstanceOwnerQosResponse(
+            qos=name,
+            succeeded=len(results) - failed,
+            failed=failed,
+            results=results,
+        )
+
+
+class InstanceConsole:
+
+    def __init__(
+        self,
+        session: AsyncSessionMaker,
+        pool: Annotated[VirtPool, Depends(get_virt_pool)],
+        config: Annotated[Config, Depends(get_config)],
+        proxy: Annotated[ConsoleProxy, Depends(get_console_proxy)],
+    ) -> None:
+        self.dbsession = session
+        self.pool = pool
+        self.config = config
+        self.proxy = proxy
+
+    async def execute(self, websocket: WebSocket, id: UUID,
+                      user: UserSchema) -> None:
+        import libvirt
+
+        async with self.dbsession() as session:
+            try:
+                instance = await owned_instance(session, self.pool, id, user)
+            except HTTPException as e:
+                raise WebSocketException(status.WS_1008_POLICY_VIOLATION,
+                                         e.detail)
+        host = host_of(instance, self.pool)
+        virt = self.pool.get(host)
+        try:
+            xml = await virt.read("read", domain_xml, id)
+        except HostUnavailable as e:
+            raise WebSocketException(status.WS_1013_TRY_AGAIN_LATER, str(e))
+        except libvirt.libvirtError as e:
+            raise WebSocketException(status.WS_1011_INTERNAL_ERROR, str(e))
 
-        return InstanceStateResponse(state=state)
\ No newline at end of file
+        try:
+            address, port = vnc_address(xml)
+            address = self.config.get_host(host).console_address or address
+            await self.proxy.serve(websocket, address, port)
+        except ConsoleBusy as e:
+            raise WebSocketException(status.WS_1013_TRY_AGAIN_LATER, str(e))
+        except ConsoleError as e:
+            raise WebSocketException(status.WS_1008_POLICY_VIOLATION, str(e))
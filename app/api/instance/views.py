@@ -1,36 +1,116 @@
+import asyncio
+from collections import deque
 from http import HTTPStatus
-from typing import Annotated, Optional
+import logging
+import time
+from typing import Annotated, AsyncIterator, Optional
 from uuid import UUID
+from uuid import uuid4
 
 from fastapi import APIRouter
 from fastapi import BackgroundTasks
 from fastapi import Depends
+from fastapi import Header
 from fastapi import HTTPException
 from fastapi import Path
 from fastapi import Request
-from fastapi.responses import JSONResponse
+from fastapi import Response
+from fastapi import WebSocket
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette.authentication import requires
 
+from app.api.idempotency import idempotent
+from app.api.responses import fast_json
+from app.db import get_cpu_placement
+from app.db import get_idempotency_store
+from app.db import get_ipam
+from app.db import get_jobs
+from app.db import get_ledger
+from app.db import get_provision_queue
+from app.db import get_provisioner
+from app.db import get_rate_limiter
+from app.db import get_scheduler
 from app.db import get_session
-from app.db import get_virt
+from app.db import get_stage_histograms
 from app.models.instances import Instance
 from app.models.instances import InstanceSchema
+from app.models.reservations import NameReservation
 from app.models.users import User
-from app.models.users import UserSchema
+from app.security.ratelimit import check_rate
+from app.security.ratelimit import rate_limit
+from app.service.fairqueue import Lane
+from app.service.fairqueue import PRIORITY_ADMIN
+from app.service.fairqueue import PRIORITY_NORMAL
+from app.service.idempotency import IdempotencyStore
+from app.service.idempotency import StoredResponse
+from app.service.ipam import IPAM
+from app.service.ipam import Lease
+from app.service.ipam import NoAddress
+from app.service.jobs import Job
+from app.service.jobs import JobItem
+from app.service.jobs import JobLog
+from app.service.jobs import JobStore
+from app.service.ledger import Allocation
+from app.service.ledger import Ledger
+from app.service.ledger import QuotaExceeded
+from app.service.pinning import CpuPlacement
+from app.service.pinning import NoCores
+from app.service.pinning import Pinning
+from app.service.placement import NoCapacity
+from app.service.placement import Reservation
+from app.service.placement import Scheduler
+from app.service.placement import to_kib
+from app.service.provision import Output
+from app.service.provision import ProvisionError
+from app.service.provision import ProvisionRequest
+from app.service.qos import tier_name
+from app.service.ratelimit import RateLimiter
+from app.service.resilience import HostUnavailable
+from app.service.timeline import quantile
+from app.service.timeline import Stage
+from app.service.timeline import StageHistograms
+from app.service.timeline import Timeline
 from app.settings import Config
 from app.settings import get_config
 
+from .schemas import InstanceBatchCreateRequest
+from .schemas import InstanceBulkStateRequest
+from .schemas import InstanceBulkStateResponse
 from .schemas import InstanceCreateRequest
+from .schemas import InstanceCreateResponse
+from .schemas import InstanceJobStatusResponse
 from .schemas import InstanceListResponse
+from .schemas import InstanceOwnerQosResponse
+from .schemas import InstanceQosRequest
+from .schemas import InstanceQosResponse
+from .schemas import InstanceSnapshotListResponse
+from .schemas import InstanceSnapshotRequest
+from .schemas import InstanceSnapshotSchema
+from .schemas import InstanceStageStats
+from .schemas import InstanceStageStatsResponse
 from .schemas import InstanceStateRequest
 from .schemas import InstanceStateResponse
+from .schemas import InstanceTemplate
 from .schemas import InstanceUpdateNameRequest
 from .schemas import InstanceUpdateNameResponse
+from .use_cases import InstanceBulkUpdateState
+from .use_cases import InstanceConsole
+from .use_cases import InstanceDelete
 from .use_cases import InstanceDetail
 from .use_cases import InstanceList
+from .use_cases import InstanceOwnerUpdateQos
+from .use_cases import InstanceSnapshotCreate
+from .use_cases import InstanceSnapshotDelete
+from .use_cases import InstanceSnapshotList
+from .use_cases import InstanceSnapshotRevert
 from .use_cases import InstanceUpdateName
+from .use_cases import InstanceUpdateQos
 from .use_cases import InstanceUpdateState
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/instances", tags=["instance"])
 
 
@@ -38,10 +118,42 @@ router = APIRouter(prefix="/instances", tags=["instance"])
 async def list_instances(
         request: Request,
         use_case: InstanceList = Depends(InstanceList),
-) -> InstanceListResponse:
-    return InstanceListResponse(instances=[
-        instance async for instance in use_case.execute(request.scope["user"])
-    ])
+) -> Response:
+    # polled all the time and the largest response, built from trusted
+    # fields so it's encoded directly
+    user = request.scope["user"]
+    instances = [instance async for instance in use_case.execute(user)]
+    response = fast_json(request, {"instances": instances})
+    if use_case.stale_hosts:
+        response.headers["x-stale-hosts"] = ",".join(use_case.stale_hosts)
+    return response
+
+
+@router.get("/stages", response_model=InstanceStageStatsResponse)
+async def get_stage_stats(
+    histograms: Annotated[StageHistograms,
+                          Depends(get_stage_histograms)],
+) -> InstanceStageStatsResponse:
+    stages = []
+    for name, histogram in (await histograms.snapshot()).items():
+        count = int(histogram.get("count", 0))
+        stages.append(
+            InstanceStageStats(
+                name=name,
+                count=count,
+                errors=int(histogram.get("errors", 0)),
+                mean=histogram.get("sum", 0) / count if count else 0,
+                p50=quantile(histogram, 0.5),
+                p95=quantile(histogram, 0.95),
+                p99=quantile(histogram, 0.99),
+                buckets={
+                    k: int(v)
+                    for k, v in histogram.items()
+                    if k not in ("count", "sum", "errors")
+                },
+            ))
+    stages.sort(key=lambda stage: stage.mean, reverse=True)
+    return InstanceStageStatsResponse(stages=stages)
 
 
 @router.get("/{instance_id}", response_model=InstanceSchema)
@@ -69,13 +181,328 @@ async def update_instance_name(
     return InstanceUpdateNameResponse(id=instance.id, name=instance.name)
 
 
-@router.post("/{instance_id}/state")
+@router.post("/state", response_model=InstanceBulkStateResponse)
+async def bulk_update_state(
+    request: Request,
+    data: InstanceBulkStateRequest,
+    limiter: Annotated[RateLimiter, Depends(get_rate_limiter)],
+    store: Annotated[IdempotencyStore,
+                     Depends(get_idempotency_store)],
+    idempotency_key: Optional[str] = Header(None,
+                                            alias="Idempotency-Key",
+                                            max_length=255),
+    use_case: InstanceBulkUpdateState = Depends(InstanceBulkUpdateState),
+) -> Response:
+    user = request.scope["user"]
+
+    async def run() -> StoredResponse:
+        await check_rate(limiter, user, "bulk_state")
+        response = await use_case.execute(data, user)
+        return StoredResponse(HTTPStatus.OK, response.model_dump(mode="json"))
+
+    return await idempotent(store, user.id, "bulk_state", idempotency_key,
+                            (data.model_dump(mode="json"),), run)
+
+
+@router.post("/{instance_id}/state", response_model=InstanceStateResponse)
 async def update_state(
-    data: InstanceStateRequest,
+        request: Request,
+        data: InstanceStateRequest,
+        limiter: Annotated[RateLimiter, Depends(get_rate_limiter)],
+        store: Annotated[IdempotencyStore,
+                         Depends(get_idempotency_store)],
+        idempotency_key: Optional[str] = Header(None,
+                                                alias="Idempotency-Key",
+                                                max_length=255),
+        instance_id: UUID = Path(description="id of instance"),
+        use_case: InstanceUpdateState = Depends(InstanceUpdateState),
+) -> Response:
+
+    async def run() -> StoredResponse:
+        await check_rate(limiter, request.scope["user"], "state")
+        response = await use_case.execute(instance_id, data.state)
+        return StoredResponse(HTTPStatus.OK, response.model_dump(mode="json"))
+
+    return await idempotent(store, request.scope["user"].id, "state",
+                            idempotency_key,
+                            (str(instance_id), data.model_dump(mode="json")),
+                            run)
+
+
+@router.get("/{instance_id}/snapshots",
+            response_model=InstanceSnapshotListResponse)
+async def list_snapshots(
+    request: Request,
+    instance_id: UUID = Path(description="id of instance"),
+    use_case: InstanceSnapshotList = Depends(InstanceSnapshotList),
+) -> InstanceSnapshotListResponse:
+    snapshots = await use_case.execute(instance_id, request.scope["user"])
+    return InstanceSnapshotListResponse.model_validate({"snapshots": snapshots})
+
+
+@router.post("/{instance_id}/snapshots",
+             status_code=HTTPStatus.CREATED,
+             response_model=InstanceSnapshotSchema,
+             dependencies=[Depends(rate_limit("snapshot"))])
+async def create_snapshot(
+    request: Request,
+    data: InstanceSnapshotRequest,
+    instance_id: UUID = Path(description="id of instance"),
+    use_case: InstanceSnapshotCreate = Depends(InstanceSnapshotCreate),
+) -> InstanceSnapshotSchema:
+    snapshot = await use_case.execute(instance_id, data, request.scope["user"])
+    return InstanceSnapshotSchema.model_validate(snapshot)
+
+
+@router.post("/{instance_id}/snapshots/{name}/revert",
+             response_model=InstanceSnapshotSchema,
+             dependencies=[Depends(rate_limit("revert"))])
+async def revert_snapshot(
+    request: Request,
+    instance_id: UUID = Path(description="id of instance"),
+    name: str = Path(description="name of snapshot"),
+    use_case: InstanceSnapshotRevert = Depends(InstanceSnapshotRevert),
+) -> InstanceSnapshotSchema:
+    snapshot = await use_case.execute(instance_id, name, request.scope["user"])
+    return InstanceSnapshotSchema.model_validate(snapshot)
+
+
+@router.delete("/{instance_id}/snapshots/{name}",
+               status_code=HTTPStatus.NO_CONTENT)
+async def delete_snapshot(
+    request: Request,
+    instance_id: UUID = Path(description="id of instance"),
+    name: str = Path(description="name of snapshot"),
+    use_case: InstanceSnapshotDelete = Depends(InstanceSnapshotDelete),
+) -> None:
+    await use_case.execute(instance_id, name, request.scope["user"])
+
+
+@router.put("/{instance_id}/qos", response_model=InstanceQosResponse)
+async def update_qos(
+    request: Request,
+    data: InstanceQosRequest,
     instance_id: UUID = Path(description="id of instance"),
-    use_case: InstanceUpdateState = Depends(InstanceUpdateState),
-) -> InstanceStateResponse:
-    return await use_case.execute(instance_id, data.state)
+    use_case: InstanceUpdateQos = Depends(InstanceUpdateQos),
+) -> InstanceQosResponse:
+    return await use_case.execute(instance_id, data.qos, request.scope["user"])
+
+
+@router.put("/owners/{user_id}/qos", response_model=InstanceOwnerQosResponse)
+async def update_owner_qos(
+    request: Request,
+    data: InstanceQosRequest,
+    user_id: int = Path(description="id of the owner"),
+    use_case: InstanceOwnerUpdateQos = Depends(InstanceOwnerUpdateQos),
+) -> InstanceOwnerQosResponse:
+    return await use_case.execute(user_id, data.qos, request.scope["user"])
+
+
+@router.websocket("/{instance_id}/console")
+async def console(
+        websocket: WebSocket,
+        instance_id: UUID = Path(description="id of instance"),
+        use_case: InstanceConsole = Depends(InstanceConsole),
+) -> None:
+    await use_case.execute(websocket, instance_id, websocket.scope["user"])
+
+
+@router.delete("/{instance_id}", status_code=HTTPStatus.NO_CONTENT)
+async def delete_instance(
+        request: Request,
+        instance_id: UUID = Path(description="id of instance"),
+        use_case: InstanceDelete = Depends(InstanceDelete),
+) -> None:
+    await use_case.execute(instance_id, request.scope["user"])
+
+
+def check_instance_name(name: str) -> None:
+    if any(c.isspace() for c in name):
+        raise HTTPException(HTTPStatus.BAD_REQUEST,
+                            "Name can't contain whitespace")
+
+
+def check_qos(config: Config, user: User, qos: Optional[str]) -> None:
+    if qos is None:
+        return
+    if not user.is_admin:
+        raise HTTPException(HTTPStatus.FORBIDDEN,
+                            "Only admins choose the QoS tier")
+    if qos not in config.qos:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid QoS tier")
+
+
+async def admit(
+    scheduler: Scheduler,
+    ledger: Ledger,
+    user: User,
+    template: InstanceTemplate,
+    id: UUID,
+    hosts: Optional[list[str]] = None,
+) -> tuple[Reservation, Allocation]:
+    allocation = Allocation(
+        vcpu=template.vcpu,
+        ram=to_kib(template.ram, template.ram_unit),
+        disk=template.size << 30,
+    )
+    try:
+        reservation = scheduler.place(allocation.vcpu, allocation.ram, hosts)
+    except NoCapacity:
+        raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE,
+                            "No host has enough capacity left")
+    try:
+        await ledger.admit(reservation.host,
+                           user.id,
+                           id,
+                           allocation,
+                           unlimited_user=user.is_admin)
+    except QuotaExceeded as e:
+        scheduler.release(reservation)
+        if e.scope == "user":
+            raise HTTPException(HTTPStatus.FORBIDDEN, str(e))
+        raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+    return reservation, allocation
+
+
+async def release(
+    scheduler: Scheduler,
+    ledger: Ledger,
+    user_id: int,
+    reservation: Reservation,
+    id: UUID,
+    allocation: Allocation,
+) -> None:
+    scheduler.release(reservation)
+    await ledger.release(reservation.host, user_id, id, allocation)
+
+
+async def lease_addresses(
+    ipam: IPAM,
+    session_maker: async_sessionmaker[AsyncSession],
+    instances: list[tuple[str, str]],
+) -> list[Lease]:
+    """Reserves a MAC, and an address if IPAM manages them, for every
+    (host, name), before anything is created so the instance's IP is known
+    right away."""
+    leases: list[Lease] = []
+    async with session_maker() as session:
+        try:
+            for host, name in instances:
+                leases.append(await ipam.allocate(session, host, name))
+        except NoAddress as e:
+            for lease in leases:
+                await ipam.release(session, lease)
+            raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+    return leases
+
+
+async def release_lease(lease: Lease) -> None:
+    ipam = get_ipam()
+    session_maker = await get_session().__anext__()
+    async with session_maker() as session:
+        await ipam.release(session, lease)
+
+
+async def reserve_names(
+    session_maker: async_sessionmaker[AsyncSession],
+    user_id: int,
+    instances: list[tuple[str, str]],
+    ids: list[UUID],
+) -> None:
+    """Reserves the name of every (name, host) along with the UUID its
+    domain will be defined with. A repeated create fails here, before
+    provisioning touches the disk of the first one."""
+    async with session_maker() as session:
+        taken = await NameReservation.reserve(
+            session, user_id,
+            [(name, host, id) for (name, host), id in zip(instances, ids)])
+    if taken:
+        raise HTTPException(
+            HTTPStatus.CONFLICT,
+            f"Instance name already in use: {', '.join(taken)}")
+
+
+async def release_names(ids: list[UUID]) -> None:
+    session_maker = await get_session().__anext__()
+    async with session_maker() as session:
+        await NameReservation.release(session, ids)
+
+
+async def pin_instances(
+    cpus: CpuPlacement,
+    template: InstanceTemplate,
+    instances: list[tuple[str, UUID]],
+) -> list[Optional[Pinning]]:
+    """Allocates the host CPUs of every (host, id) of a dedicated
+    *template*. All or nothing."""
+    if template.profile != "dedicated":
+        return [None] * len(instances)
+    pinnings: list[Optional[Pinning]] = []
+    try:
+        for host, id in instances:
+            pinnings.append(await cpus.allocate(
+                host, id, template.vcpu,
+                to_kib(template.ram, template.ram_unit), template.hugepages))
+    except (NoCores, HostUnavailable) as e:
+        for host, id in instances[:len(pinnings)]:
+            await cpus.release(host, id)
+        raise HTTPException(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+    return pinnings
+
+
+async def admit_instances(
+    scheduler: Scheduler,
+    ledger: Ledger,
+    ipam: IPAM,
+    cpus: CpuPlacement,
+    session_maker: async_sessionmaker[AsyncSession],
+    user: User,
+    template: InstanceTemplate,
+    names: list[str],
+    hosts: Optional[list[str]] = None,
+) -> tuple[list[Reservation], Allocation, list[UUID], list[Lease],
+           list[Optional[Pinning]]]:
+    """Everything the instances need before provisioning starts: host
+    capacity, quota, their names, host CPUs and addresses, on one of
+    *hosts* if given. All or nothing."""
+    if template.hugepages and template.profile != "dedicated":
+        raise HTTPException(HTTPStatus.BAD_REQUEST,
+                            "Hugepages need the dedicated profile")
+    # dedicated instances only go to hosts with dedicated CPUs
+    allowed = cpus.hosts if template.profile == "dedicated" else hosts
+    if allowed is not None and hosts is not None:
+        allowed = [host for host in allowed if host in hosts]
+    # generated up front, the ledger tracks admissions by instance
+    ids = [uuid4() for _ in names]
+    admitted: list[tuple[Reservation, Allocation]] = []
+    named = False
+    pinned: list[tuple[str, UUID]] = []
+    try:
+        for id in ids:
+            admitted.append(await admit(scheduler, ledger, user, template, id,
+                                        allowed))
+        hosts = [(name, reservation.host)
+                 for name, (reservation, _) in zip(names, admitted)]
+        await reserve_names(session_maker, user.id, hosts, ids)
+        named = True
+        pinnings = await pin_instances(
+            cpus, template, [(host, id) for (_, host), id in zip(hosts, ids)])
+        pinned = [(host, id)
+                  for (_, host), id, pinning in zip(hosts, ids, pinnings)
+                  if pinning is not None]
+        leases = await lease_addresses(ipam, session_maker,
+                                       [(host, name) for name, host in hosts])
+    except HTTPException:
+        for id, (reservation, allocation) in zip(ids, admitted):
+            await release(scheduler, ledger, user.id, reservation, id,
+                          allocation)
+        if named:
+            await release_names(ids)
+        for host, id in pinned:
+            await cpus.release(host, id)
+        raise
+    reservations = [reservation for reservation, _ in admitted]
+    return reservations, admitted[0][1], ids, leases, pinnings
 
 
 @router.post("/create")
@@ -83,83 +510,399 @@ async def create_instance(
     request: Request,
     data: InstanceCreateRequest,
     config: Annotated[Config, Depends(get_config)],
+    limiter: Annotated[RateLimiter, Depends(get_rate_limiter)],
+    scheduler: Annotated[Scheduler, Depends(get_scheduler)],
+    ledger: Annotated[Ledger, Depends(get_ledger)],
+    jobs: Annotated[JobStore, Depends(get_jobs)],
+    ipam: Annotated[IPAM, Depends(get_ipam)],
+    cpus: Annotated[CpuPlacement, Depends(get_cpu_placement)],
+    session_maker: Annotated[async_sessionmaker[AsyncSession],
+                             Depends(get_session)],
+    store: Annotated[IdempotencyStore,
+                     Depends(get_idempotency_store)],
     task: BackgroundTasks,
-) -> JSONResponse:
+    idempotency_key: Optional[str] = Header(None,
+                                            alias="Idempotency-Key",
+                                            max_length=255),
+) -> Response:
     base_image = config.images.get(data.os)
     if base_image is None:
         raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid OS type")
+    if data.performance is not None and data.performance not in config.profiles:
+        raise HTTPException(HTTPStatus.BAD_REQUEST,
+                            "Invalid performance profile")
+
+    check_instance_name(data.name)
+
+    user = request.scope["user"]
+    check_qos(config, user, data.qos)
+
+    async def run() -> StoredResponse:
+        # charged here, a replay of a stored response is not
+        await check_rate(limiter, user, "create")
+        # registered first, so any worker serves it as soon as it's answered
+        job = await jobs.create(user.id, [data.name])
+        reservations, allocation, ids, leases, pinnings = await admit_instances(
+            scheduler, ledger, ipam, cpus, session_maker, user, data,
+            [data.name])
+        job.items[0].host = reservations[0].host
 
-    if any(c.isspace() for c in data.name):
+        task.add_task(
+            createvm_batch,
+            user=user,
+            job=job,
+            reservations=reservations,
+            ids=ids,
+            leases=leases,
+            pinnings=pinnings,
+            allocation=allocation,
+            template=data,
+            hostname=data.hostname,
+            linked=False,
+        )
+        return StoredResponse(HTTPStatus.ACCEPTED, {
+            "status": "accepted",
+            "jobid": str(job.id)
+        })
+
+    return await idempotent(store, user.id, "create", idempotency_key,
+                            (data.model_dump(mode="json"),), run)
+
+
+@router.post("/batch",
+             status_code=HTTPStatus.ACCEPTED,
+             response_model=InstanceCreateResponse)
+async def batch_create_instances(
+    request: Request,
+    data: InstanceBatchCreateRequest,
+    config: Annotated[Config, Depends(get_config)],
+    jobs: Annotated[JobStore, Depends(get_jobs)],
+    scheduler: Annotated[Scheduler, Depends(get_scheduler)],
+    ledger: Annotated[Ledger, Depends(get_ledger)],
+    ipam: Annotated[IPAM, Depends(get_ipam)],
+    cpus: Annotated[CpuPlacement, Depends(get_cpu_placement)],
+    session_maker: Annotated[async_sessionmaker[AsyncSession],
+                             Depends(get_session)],
+    limiter: Annotated[RateLimiter, Depends(get_rate_limiter)],
+    store: Annotated[IdempotencyStore,
+                     Depends(get_idempotency_store)],
+    task: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None,
+                                            alias="Idempotency-Key",
+                                            max_length=255),
+) -> Response:
+    base_image = config.images.get(data.template.os)
+    if base_image is None:
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid OS type")
+    performance = data.template.performance
+    if performance is not None and performance not in config.profiles:
         raise HTTPException(HTTPStatus.BAD_REQUEST,
-                            "Name can't contain whitespace")
+                            "Invalid performance profile")
 
-    task.add_task(
-        createvm,
-        user=request.scope["user"],
-        name=data.name,
-        vcpu=data.vcpu,
-        ram=f"{data.ram}{data.ram_unit}",
-        size=data.size,
-        os=data.os,
-        new_password=data.root_password,
-        hostname=data.hostname,
-    )
+    names = data.instance_names
+    for name in names:
+        check_instance_name(name)
+    if len(set(names)) != len(names):
+        raise HTTPException(HTTPStatus.BAD_REQUEST, "Duplicate instance name")
 
-    return JSONResponse(
-        content={"status": "accepted"},
-        status_code=HTTPStatus.ACCEPTED,
-    )
+    user = request.scope["user"]
+    check_qos(config, user, data.template.qos)
 
+    async def run() -> StoredResponse:
+        # priced per instance
+        await check_rate(limiter, user, "batch", len(names))
+        job = await jobs.create(user.id, names)
+        reservations, allocation, ids, leases, pinnings = await admit_instances(
+            scheduler, ledger, ipam, cpus, session_maker, user, data.template,
+            names)
+        for item, reservation in zip(job.items, reservations):
+            item.host = reservation.host
 
-async def createvm(
-    user: UserSchema,
-    name: str,
-    vcpu: int,
-    ram: str,
-    size: int,
-    os: str,
-    new_password: str,
-    hostname: Optional[str] = None,
-) -> None:
-    import subprocess
-
-    if hostname is None:
-        hostname = str(name)
-
-    subprocess.check_call([
-        "./createvm.py",
-        "--name",
-        str(name),
-        "--vcpu",
-        str(vcpu),
-        "--ram",
-        str(ram),
-        "--size",
-        f"{size}G",
-        "--os",
-        str(os),
-        "--new-password",
-        str(new_password),
-        "--hostname",
-        hostname,
-    ])
-
-    virt = get_virt()
-
-    domain = virt.get_vm_by_name(name)
+        task.add_task(
+            createvm_batch,
+            user=user,
+            job=job,
+            reservations=reservations,
+            ids=ids,
+            leases=leases,
+            pinnings=pinnings,
+            allocation=allocation,
+            template=data.template,
+        )
+        return StoredResponse(HTTPStatus.ACCEPTED, {"jobid": str(job.id)})
+
+    return await idempotent(store, user.id, "batch", idempotency_key,
+                            (data.model_dump(mode="json"),), run)
 
+
+@router.get("/jobs/{job_id}", response_model=InstanceJobStatusResponse)
+async def get_job_status(
+    request: Request,
+    jobs: Annotated[JobStore, Depends(get_jobs)],
+    job_id: UUID = Path(description="id of provisioning job"),
+) -> InstanceJobStatusResponse:
+    job = await jobs.get(job_id)
+    if job is None or job.user_id != request.scope["user"].id:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Job ID")
+    return InstanceJobStatusResponse.model_validate({
+        "status": job.status,
+        "items": job.items,
+    })
+
+
+# a comment is sent when nothing else was for this long, so proxies keep
+# the stream open
+LOG_KEEPALIVE = 15.0
+
+
+def log_event(number: int, line: str) -> str:
+    # data can't hold a line break, one field per line
+    data = "".join(f"data: {part}\n" for part in line.splitlines() or [""])
+    return f"id: {number}\n{data}\n"
+
+
+async def log_events(jobs: JobStore, id: UUID,
+                     offset: int) -> AsyncIterator[str]:
+    while True:
+        start, lines, status = await jobs.read_log(id, offset)
+        if start > offset:
+            yield f": {start - offset} lines dropped\n\n"
+        for number, line in enumerate(lines, start):
+            yield log_event(number, line)
+        offset = start + len(lines)
+        if status is not None:
+            yield f"event: end\ndata: {status}\n\n"
+            return
+        if lines:
+            continue
+        if not await jobs.wait(id, offset, LOG_KEEPALIVE):
+            # expired without an end, its worker died running it
+            if not await jobs.exists(id):
+                return
+            yield ": keepalive\n\n"
+
+
+@router.get("/jobs/{job_id}/log")
+async def get_job_log(
+    request: Request,
+    jobs: Annotated[JobStore, Depends(get_jobs)],
+    job_id: UUID = Path(description="id of provisioning job"),
+    offset: Optional[int] = None,
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+) -> StreamingResponse:
+    """Output of the provisioning runs of the job as server-sent events, one
+    per line with its number as id. Resumes from line *offset*, or after
+    the last event received by a reconnecting EventSource. Ends with an
+    `end` event holding the job's status."""
+    job = await jobs.get(job_id)
+    if job is None or job.user_id != request.scope["user"].id:
+        raise HTTPException(HTTPStatus.NOT_FOUND, "Invalid Job ID")
+    if offset is None:
+        try:
+            offset = int(last_event_id) + 1 if last_event_id else 0
+        except ValueError:
+            raise HTTPException(HTTPStatus.BAD_REQUEST, "Invalid Last-Event-ID")
+    return StreamingResponse(log_events(jobs, job_id, max(offset, 0)),
+                             media_type="text/event-stream",
+                             headers={
+                                 "cache-control": "no-cache",
+                                 "x-accel-buffering": "no",
+                             })
+
+
+def job_output(log: JobLog, prefix: str, secrets: list[str],
+               tail: deque[str]) -> Output:
+    """Appends lines to *log*, each behind *prefix* and with *secrets*
+    masked, the last ones are also kept in *tail*."""
+
+    def output(line: str) -> None:
+        for secret in secrets:
+            line = line.replace(secret, "****")
+        tail.append(line)
+        log.append(f"{prefix}{line}")
+
+    return output
+
+
+async def record_instances(user: User, template: InstanceTemplate,
+                           items: list[JobItem], leases: list[Lease]) -> None:
+    """Inserts the rows of the items whose domain was created and assigns
+    their addresses, an item is COMPLETED once both are done."""
+    created = [item for item in items if item.instance_id is not None]
     session_maker = await get_session().__anext__()
 
     async with session_maker() as session:
         user_obj = await User.get_by_id(session, user.id)
         if not user_obj:
+            for item in created:
+                item.status = "FAILED"
+                item.error = "Invalid user"
             return
 
-        await Instance.create(
+        await Instance.bulk_create(
             session,
-            UUID(str(domain.UUIDString())),
-            name,
             user_obj,
+            [(item.instance_id, item.name, item.host) for item in created],
+            qos=template.qos,
         )
+        ipam = get_ipam()
+        for item, lease in zip(items, leases):
+            if item.instance_id is None:
+                continue
+            try:
+                await ipam.assign(session, lease, item.instance_id)
+            except Exception as e:
+                logger.exception("failed to assign the address of %s",
+                                 item.name)
+                item.status = "FAILED"
+                item.error = f"address not recorded: {e}"
+                continue
+            item.status = "COMPLETED"
+
+
+async def createvm_batch(
+    user: User,
+    job: Job,
+    reservations: list[Reservation],
+    ids: list[UUID],
+    leases: list[Lease],
+    pinnings: list[Optional[Pinning]],
+    allocation: Allocation,
+    template: InstanceTemplate,
+    hostname: Optional[str] = None,
+    linked: bool = True,
+) -> None:
+    """Provisions every item of *job*, in this process. Batches default to
+    linked clones: every disk is an overlay of the same base image, so the
+    base is read once instead of copied per instance.
+
+    Each run takes two slots of its host in turn, one to create the disk
+    and one for the rest, so full copies are bounded on their own.
+
+    The output of the runs goes to the job's log, prefixed with the
+    instance's name. The job is written to the JobStore as it goes, any API
+    worker serves its status and log.
+    """
+    provisioner = get_provisioner()
+    cpus = get_cpu_placement()
+    scheduler = get_scheduler()
+    ledger = get_ledger()
+    histograms = get_stage_histograms()
+    queue = get_provision_queue()
+    priority = PRIORITY_ADMIN if user.is_admin else PRIORITY_NORMAL
+    qos = tier_name(get_config(), template.qos, user.qos)
+    # a linked clone only writes a qcow2 header
+    disk_lane: Lane = "light" if linked else "disk"
+    # ansible -vvv prints the command line with both passwords
+    secrets = [
+        secret for secret in (template.root_password,
+                              get_config().images[template.os].root_password)
+        if secret
+    ]
+
+    async def run(item: JobItem, request: ProvisionRequest, lane: Lane,
+                  phase: str, queued: float, output: Output) -> None:
+        step = provisioner.create_disk if phase == "disk" else provisioner.boot
+        item.ticket = queue.submit(request.host, lane, user.id, priority)
+        try:
+            async with queue.slot(item.ticket):
+                item.status = "PROCESSING"
+                item.timeline.append(
+                    Stage("queue" if phase == "disk" else "queue-boot", queued,
+                          time.time()))
+                await step(request, Timeline(stages=item.timeline), output)
+        finally:
+            item.ticket = None
+
+    async def provision(item: JobItem, reservation: Reservation, id: UUID,
+                        lease: Lease, pinning: Optional[Pinning]) -> None:
+        request = ProvisionRequest(
+            host=reservation.host,
+            name=item.name,
+            vcpu=template.vcpu,
+            ram=template.ram,
+            ram_unit=template.ram_unit,
+            size=f"{template.size}G",
+            os=template.os,
+            new_password=template.root_password,
+            hostname=hostname or item.name,
+            linked=linked,
+            ip=lease.ip,
+            mac=lease.mac,
+            uuid=id,
+            pinning=pinning,
+            performance=template.performance,
+            qos=qos,
+        )
+        # last lines of output, for the error
+        tail: deque[str] = deque(maxlen=3)
+        output = job_output(job.log, f"[{item.name}] ", secrets, tail)
+        error: Optional[Exception] = None
+        disk = False
+        try:
+            request.cpuset = await cpus.shared(reservation.host)
+            await run(item, request, disk_lane, "disk", job.created, output)
+            disk = True
+            await run(item, request, "light", "boot", time.time(), output)
+        except Exception as e:
+            if not isinstance(e, (ProvisionError, HostUnavailable)):
+                logger.exception("failed to provision %s", item.name)
+            error = e
+
+        try:
+            await histograms.observe(item.timeline)
+        except Exception:
+            logger.exception("failed to record the timeline of %s", item.name)
+
+        if error is not None:
+            item.status = "FAILED"
+            item.error = str(error) or type(error).__name__
+            if tail:
+                item.error += ": " + " / ".join(tail)
+            try:
+                await provisioner.discard(request, disk)
+            except Exception:
+                # whatever is left of it still uses its address, name and
+                # capacity, none of them may go to another instance
+                logger.exception("failed to clean up %s, keeping what it holds",
+                                 item.name)
+                item.error += " (cleanup failed)"
+                return
+            await release(scheduler, ledger, user.id, reservation, id,
+                          allocation)
+            await release_lease(lease)
+            await release_names([id])
+            await cpus.release(reservation.host, id)
+            return
+        scheduler.commit(reservation)
+        await cpus.commit(reservation.host, id)
+        # defined with the UUID reserved along with its name
+        item.instance_id = id
+
+    # written out while it runs, readers of the log end with the status the
+    # job got
+    async with get_jobs().running(job):
+        # one run failing in its own error handling doesn't keep the others
+        # from being recorded
+        results = await asyncio.gather(
+            *(provision(item, reservation, id, lease, pinning)
+              for item, reservation, id, lease, pinning in zip(
+                  job.items, reservations, ids, leases, pinnings)),
+            return_exceptions=True)
+        for item, result in zip(job.items, results):
+            if isinstance(result, BaseException):
+                logger.error("failed to provision %s",
+                             item.name,
+                             exc_info=result)
+                if item.instance_id is None:
+                    item.status = "FAILED"
+                    item.error = item.error or repr(result)
 
-        await session.flush()
+        try:
+            await record_instances(user, template, job.items, leases)
+        except Exception as e:
+            logger.exception("failed to record the instances of job %s", job.id)
+            for item in job.items:
+                if item.instance_id is not None and item.status != "COMPLETED":
+                    item.status = "FAILED"
+                    item.error = f"instance not recorded: {e}"
@@ -1,40 +1,152 @@
 from functools import lru_cache
 import logging
-from typing import AsyncIterator, Optional
+from typing import AsyncIterator, Optional, TYPE_CHECKING
 
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncEngine
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 
+from app.service.addresses import AddressResolver
+from app.service.console import ConsoleProxy
+from app.service.fairqueue import ProvisionQueue
+from app.service.idempotency import IdempotencyStore
+from app.service.inventory import InventoryReader
+from app.service.ipam import IPAM
+from app.service.jobs import JobStore
+from app.service.ledger import Ledger
+from app.service.pinning import CpuPlacement
+from app.service.placement import Scheduler
+from app.service.provision import Provisioner
+from app.service.ratelimit import RateLimiter
+from app.service.timeline import StageHistograms
 from app.service.virt import Virt
 from app.service.virt import VirtMode
+from app.service.virt import VirtPool
 from app.settings import get_config
 
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
 logger = logging.getLogger(__name__)
 
-config = get_config()
+# Everything below is created on first use (the app lifespan warms them up),
+# importing this module neither reads the config nor loads libvirt.
 
-async_engine = create_async_engine(
-    config.db,
-    pool_pre_ping=True,
-    echo=True,
-)
 
-async_session = async_sessionmaker[AsyncSession](
-    bind=async_engine,
-    autoflush=False,
-    future=True,
-)
+@lru_cache
+def get_engine() -> AsyncEngine:
+    return create_async_engine(
+        get_config().db,
+        pool_pre_ping=True,
+        echo=True,
+    )
 
 
 @lru_cache
+def get_sessionmaker() -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker[AsyncSession](
+        bind=get_engine(),
+        autoflush=False,
+        future=True,
+    )
+
+
+@lru_cache
+def get_virt_pool() -> VirtPool:
+    config = get_config()
+    return VirtPool({host.name: host.uri for host in config.hosts},
+                    VirtMode.READ | VirtMode.WRITE,
+                    concurrency=config.host_concurrency,
+                    resilience=config.resilience)
+
+
 def get_virt() -> Virt:
-    return Virt(config.libvirt, VirtMode.READ | VirtMode.WRITE)
+    return get_virt_pool().get(get_config().default_host)
+
+
+@lru_cache
+def get_scheduler() -> Scheduler:
+    return Scheduler.from_config(get_config())
+
+
+@lru_cache
+def get_provision_queue() -> ProvisionQueue:
+    return ProvisionQueue.from_config(get_config())
+
+
+@lru_cache
+def get_cpu_placement() -> CpuPlacement:
+    config = get_config()
+    return CpuPlacement(get_virt_pool(), config, config.capacity_refresh,
+                        get_redis(), config.reconcile.disk_grace)
+
+
+@lru_cache
+def get_provisioner() -> Provisioner:
+    return Provisioner(get_config(), get_virt_pool())
+
+
+@lru_cache
+def get_redis() -> "Redis":
+    from redis.asyncio import Redis
+
+    return Redis.from_url(get_config().redis)
+
+
+@lru_cache
+def get_ledger() -> Ledger:
+    return Ledger.from_config(get_redis(), get_config())
+
+
+@lru_cache
+def get_rate_limiter() -> RateLimiter:
+    return RateLimiter(get_redis(), get_config().ratelimit)
+
+
+@lru_cache
+def get_idempotency_store() -> IdempotencyStore:
+    return IdempotencyStore(get_redis(), get_config().idempotency)
+
+
+@lru_cache
+def get_jobs() -> JobStore:
+    return JobStore(get_redis(), get_config().jobs)
+
+
+@lru_cache
+def get_address_resolver() -> AddressResolver:
+    resolver = AddressResolver(get_config().addresses)
+    get_virt_pool().watch(resolver.on_lifecycle)
+    return resolver
+
+
+@lru_cache
+def get_inventory_reader() -> Optional[InventoryReader]:
+    config = get_config().inventory
+    if not config.enabled:
+        return None
+    return InventoryReader(config.path, config.max_age)
+
+
+@lru_cache
+def get_console_proxy() -> ConsoleProxy:
+    return ConsoleProxy(get_config().console)
+
+
+@lru_cache
+def get_stage_histograms() -> StageHistograms:
+    return StageHistograms(get_redis())
+
+
+@lru_cache
+def get_ipam() -> IPAM:
+    return IPAM(get_config().network)
 
 
 async def get_session() -> AsyncIterator[async_sessionmaker[AsyncSession]]:
     try:
-        yield async_session
+        yield get_sessionmaker()
     except SQLAlchemyError as e:
         logger.exception(e)
@@ -1,14 +1,76 @@
+import asyncio
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+import logging
+import math
+from typing import AsyncIterator
+
 from fastapi import APIRouter
 from fastapi import Depends
 from fastapi import FastAPI
+from fastapi import Request
 from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import text
 
 from app.api.auth.views import router as auth_router
 from app.api.instance.views import router as instance_router
+from app.db import get_address_resolver
+from app.db import get_engine
+from app.db import get_inventory_reader
+from app.db import get_redis
+from app.db import get_scheduler
+from app.db import get_virt_pool
 from app.security.auth import get_current_user
+from app.service.domain import load_template
+from app.service.resilience import HostUnavailable
 from app.settings import get_config
 
-config = get_config()
+logger = logging.getLogger(__name__)
+
+
+async def warm_up(app: FastAPI) -> None:
+    # pay for the config, the domain templates, the first database connection
+    # and the hypervisor connections before serving, not on the first request
+    config = get_config()
+    for host in config.hosts:
+        load_template(config.get_domain_template(host.name))
+
+    async with get_engine().connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+    pool = get_virt_pool()
+    results = await asyncio.gather(
+        *(pool.connect(host) for host in pool.hosts),
+        return_exceptions=True,
+    )
+    app.state.hosts = {}
+    for host, result in zip(pool.hosts, results):
+        if isinstance(result, Exception):
+            logger.error("failed to connect to host %s: %s", host, result)
+        app.state.hosts[host] = not isinstance(result, Exception)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    app.state.ready = False
+    # watches lifecycle events, before warm_up opens the connections
+    get_address_resolver()
+    await warm_up(app)
+
+    config = get_config()
+    capacity_refresh = asyncio.create_task(get_scheduler().run(
+        get_virt_pool(), config.capacity_refresh, get_inventory_reader()))
+    app.state.ready = any(app.state.hosts.values())
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        capacity_refresh.cancel()
+        await get_engine().dispose()
+        get_virt_pool().close()
+        await get_redis().close()
+
 
 app = FastAPI(
     title="hyperk",
@@ -17,6 +79,8 @@ app = FastAPI(
     dependencies=[
         Depends(get_current_user),
     ],
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 apiv1 = APIRouter(prefix="/api/v1", tags=["apiv1"])
@@ -25,6 +89,16 @@ apiv1.include_router(instance_router)
 
 app.include_router(apiv1)
 
+
+@app.exception_handler(HostUnavailable)
+async def host_unavailable(request: Request,
+                           err: HostUnavailable) -> JSONResponse:
+    return JSONResponse(
+        status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        content={"detail": str(err)},
+        headers={"retry-after": str(max(1, math.ceil(err.retry_after)))})
+
+
 # @app.exception_handler(Exception)
 # async def err_handler(request: Request, err: Exception) -> JSONResponse:
 #     err_message = f"Failed to execute: {request.method} {request.url}"
@@ -36,3 +110,15 @@ app.include_router(apiv1)
 @app.get("/", include_in_schema=False)
 def index() -> JSONResponse:
     return JSONResponse({"status": "ok"})
+
+
+@app.get("/readyz", include_in_schema=False)
+def readyz(request: Request) -> JSONResponse:
+    ready = getattr(request.app.state, "ready", False)
+    return JSONResponse(
+        {
+            "status": "ready" if ready else "starting",
+            "hosts": getattr(request.app.state, "hosts", {}),
+        },
+        status_code=HTTPStatus.OK if ready else HTTPStatus.SERVICE_UNAVAILABLE,
+    )
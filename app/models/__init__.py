@@ -1,5 +1,7 @@
+from .addresses import Address
 from .base import Base
 from .instances import Instance
 from .instances import InstanceSchema
+from .reservations import NameReservation
 from .users import User
 from .users import UserSchema
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from typing import Optional, Sequence
+from uuid import UUID
+
+from sqlalchemy import delete
+from sqlalchemy import Integer
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import update
+from sqlalchemy import Uuid
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped
+from sqlalchemy.orm import mapped_column
+
+from .base import Base
+
+
+class Address(Base):
+    __tablename__ = "addresses"
+
+    # offset of the address in the configured subnet, the MAC is derived
+    # from it so both are unique together. Without an address pool it only
+    # numbers the MAC and ip stays NULL.
+    slot: Mapped[int] = mapped_column("slot",
+                                      Integer,
+                                      nullable=False,
+                                      primary_key=True,
+                                      autoincrement=False)
+
+    ip: Mapped[Optional[str]] = mapped_column("ip",
+                                              String(length=45),
+                                              nullable=True,
+                                              unique=True)
+
+    mac: Mapped[str] = mapped_column("mac",
+                                     String(length=17),
+                                     nullable=False,
+                                     unique=True)
+
+    host: Mapped[str] = mapped_column("host", String(length=64), nullable=False)
+
+    name: Mapped[str] = mapped_column("name", String(length=64), nullable=False)
+
+    # set once the domain is defined, NULL while provisioning
+    instance_id: Mapped[Optional[UUID]] = mapped_column("instance_id",
+                                                        Uuid(as_uuid=True,
+                                                             native_uuid=False),
+                                                        nullable=True,
+                                                        index=True)
+
+    @classmethod
+    async def get_slots(cls, session: AsyncSession) -> list[int]:
+        return list(await session.scalars(select(cls.slot)))
+
+    @classmethod
+    async def get_by_instance(cls, session: AsyncSession,
+                              instance_id: UUID) -> Optional[Address]:
+        stmt = select(cls).where(cls.instance_id == instance_id)
+        return await session.scalar(stmt)
+
+    @classmethod
+    async def get_ips(cls,
+                      session: AsyncSession,
+                      ids: Optional[Sequence[UUID]] = None) -> dict[UUID, str]:
+        stmt = select(cls.instance_id,
+                      cls.ip).where(cls.instance_id.is_not(None),
+                                    cls.ip.is_not(None))
+        if ids is not None:
+            stmt = stmt.where(cls.instance_id.in_(ids))
+        return {id: ip for id, ip in await session.execute(stmt)}
+
+    @classmethod
+    async def create(cls, session: AsyncSession, slot: int, ip: Optional[str],
+                     mac: str, host: str, name: str) -> Address:
+        address = Address(slot=slot, ip=ip, mac=mac, host=host, name=name)
+        session.add(address)
+        await session.commit()
+        return address
+
+    @classmethod
+    async def assign(cls, session: AsyncSession, slot: int,
+                     instance_id: UUID) -> None:
+        await session.execute(
+            update(cls).where(cls.slot == slot).values(instance_id=instance_id))
+        await session.commit()
+
+    @classmethod
+    async def delete_slot(cls, session: AsyncSession, slot: int) -> None:
+        await session.execute(delete(cls).where(cls.slot == slot))
+        await session.commit()
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 from ipaddress import ip_address
-from typing import Literal, Optional, TYPE_CHECKING
+from typing import Literal, Optional, Sequence, TYPE_CHECKING
 from uuid import UUID
 
 from pydantic import ConfigDict, BaseModel
 from sqlalchemy import ForeignKey
+from sqlalchemy import insert
 from sqlalchemy import Integer
 from sqlalchemy import select
 from sqlalchemy import String
@@ -38,7 +39,18 @@ class Instance(Base):
 
     user_id: Mapped[int] = mapped_column("user_id",
                                          ForeignKey("users.id"),
-                                         nullable=False)
+                                         nullable=False,
+                                         index=True)
+
+    host: Mapped[str] = mapped_column("host",
+                                      String(length=64),
+                                      nullable=False,
+                                      server_default="default")
+
+    # QoS tier of its own, the owner's applies when None
+    qos: Mapped[Optional[str]] = mapped_column("qos",
+                                               String(length=16),
+                                               nullable=True)
 
     user: Mapped[User] = relationship("User", back_populates="instances")
 
@@ -49,9 +61,38 @@ class Instance(Base):
         return await session.scalar(stmt)
 
     @classmethod
-    async def create(cls, session: AsyncSession, id: UUID, name: str,
-                     user: User) -> Instance:
-        instance = Instance(id=id, name=name, user_id=user.id)
+    async def get_ids_by_user(cls, session: AsyncSession,
+                              user_id: int) -> list[UUID]:
+        stmt = select(cls.id).where(cls.user_id == user_id)
+        return list(await session.scalars(stmt))
+
+    @classmethod
+    async def get_ids_by_host(cls,
+                              session: AsyncSession,
+                              user_id: Optional[int] = None,
+                              ids: Optional[Sequence[UUID]] = None,
+                              untiered: bool = False) -> dict[str, list[UUID]]:
+        stmt = select(cls.host, cls.id)
+        if user_id is not None:
+            stmt = stmt.where(cls.user_id == user_id)
+        if untiered:
+            # in the QoS tier of their owner
+            stmt = stmt.where(cls.qos.is_(None))
+        if ids is not None:
+            stmt = stmt.where(cls.id.in_(ids))
+        hosts: dict[str, list[UUID]] = {}
+        for host, id in await session.execute(stmt):
+            hosts.setdefault(host, []).append(id)
+        return hosts
+
+    @classmethod
+    async def create(cls,
+                     session: AsyncSession,
+                     id: UUID,
+                     name: str,
+                     user: User,
+                     host: str = "default") -> Instance:
+        instance = Instance(id=id, name=name, user_id=user.id, host=host)
         session.add(instance)
         await session.commit()
         await session.refresh(instance)
@@ -61,10 +102,33 @@ class Instance(Base):
             raise RuntimeError("Instance not created")
         return new
 
+    @classmethod
+    async def bulk_create(cls,
+                          session: AsyncSession,
+                          user: User,
+                          instances: Sequence[tuple[UUID, str, str]],
+                          qos: Optional[str] = None) -> None:
+        if not instances:
+            return
+        stmt = insert(cls).values([{
+            "id": id,
+            "name": name,
+            "host": host,
+            "user_id": user.id,
+            "qos": qos,
+        } for id, name, host in instances])
+        await session.execute(stmt)
+        await session.commit()
+
     async def update_name(self, session: AsyncSession, name: str) -> None:
         self.name = name
         await session.flush()
 
+    async def update_qos(self, session: AsyncSession,
+                         qos: Optional[str]) -> None:
+        self.qos = qos
+        await session.flush()
+
     async def delete(self, session: AsyncSession) -> None:
         await session.delete(self)
         await session.flush()
@@ -76,5 +140,5 @@ class InstanceSchema(BaseModel):
     ip: Optional[str] = None
     ram: str
     vcpu: int
-    state: Literal["running", "off", "paused"]
+    state: Literal["running", "off", "paused", "hibernated"]
     model_config = ConfigDict(from_attributes=True)
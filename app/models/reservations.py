@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import time
+from typing import Sequence
+from uuid import UUID
+
+from sqlalchemy import delete
+from sqlalchemy import ForeignKey
+from sqlalchemy import insert
+from sqlalchemy import Integer
+from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import Uuid
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Mapped
+from sqlalchemy.orm import mapped_column
+
+from .base import Base
+
+
+class NameReservation(Base):
+    """Domain (and disk image) name held by an instance, from admission on.
+
+    Provisioning writes every disk to <image_dir>/<name> whatever the host,
+    so names are unique across hosts.
+    """
+    __tablename__ = "name_reservations"
+
+    name: Mapped[str] = mapped_column("name",
+                                      String(length=64),
+                                      nullable=False,
+                                      primary_key=True)
+
+    host: Mapped[str] = mapped_column("host", String(length=64), nullable=False)
+
+    user_id: Mapped[int] = mapped_column("user_id",
+                                         ForeignKey("users.id"),
+                                         nullable=False)
+
+    # generated before the domain is defined, it's given the same UUID
+    instance_id: Mapped[UUID] = mapped_column("instance_id",
+                                              Uuid(as_uuid=True,
+                                                   native_uuid=False),
+                                              nullable=False,
+                                              unique=True)
+
+    # epoch seconds
+    created: Mapped[int] = mapped_column("created",
+                                         Integer,
+                                         nullable=False,
+                                         default=lambda: int(time.time()))
+
+    @classmethod
+    async def reserve(cls, session: AsyncSession, user_id: int,
+                      names: Sequence[tuple[str, str, UUID]]) -> list[str]:
+        """Reserves every (name, host, instance id), all or none. Returns
+        the names already taken, empty once reserved."""
+        stmt = select(cls.name).where(cls.name.in_([n for n, _, _ in names]))
+        taken = list(await session.scalars(stmt))
+        if taken:
+            return taken
+        now = int(time.time())
+        try:
+            await session.execute(
+                insert(cls).values([{
+                    "name": name,
+                    "host": host,
+                    "user_id": user_id,
+                    "instance_id": instance_id,
+                    "created": now,
+                } for name, host, instance_id in names]))
+            await session.commit()
+        except IntegrityError:
+            # reserved by a concurrent request since the check
+            await session.rollback()
+            return list(await session.scalars(stmt))
+        return []
+
+    @classmethod
+    async def release(cls, session: AsyncSession,
+                      instance_ids: Sequence[UUID]) -> None:
+        await session.execute(
+            delete(cls).where(cls.instance_id.in_(instance_ids)))
+        await session.commit()
@@ -37,6 +37,11 @@ class User(Base):
                                            Boolean(),
                                            nullable=False)
 
+    # QoS tier of the user's instances without one of their own
+    qos: Mapped[Optional[str]] = mapped_column("qos",
+                                               String(length=16),
+                                               nullable=True)
+
     instances: Mapped[list[Instance]] = relationship(
         "Instance",
         back_populates="user",
@@ -67,6 +72,11 @@ class User(Base):
             raise RuntimeError("User not created")
         return new
 
+    async def update_qos(self, session: AsyncSession,
+                         qos: Optional[str]) -> None:
+        self.qos = qos
+        await session.flush()
+
     async def get_instances(self,
                             session: AsyncSession) -> AsyncIterator[Instance]:
         stmt = select(Instance).where(Instance.user_id == self.id)
@@ -2,12 +2,13 @@ from typing import Annotated, Optional, TypedDict
 
 from fastapi import Depends
 from fastapi import HTTPException
-from fastapi import Request
 from fastapi import status
+from fastapi import WebSocketException
 from fastapi.security.utils import get_authorization_scheme_param
 import jwt
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import HTTPConnection
 
 from app.db import get_session
 from app.models.users import User
@@ -17,6 +18,7 @@ from app.settings import get_config
 whitelist = [
     "/api/v1/auth/google/callback",
     "/api/v1/auth/github/callback",
+    "/readyz",
 ]
 
 UnauthorizedError = HTTPException(
@@ -35,8 +37,16 @@ class JWTPayload(TypedDict):
     jti: str
 
 
+def unauthorized(request: HTTPConnection) -> Exception:
+    if request.scope["type"] == "websocket":
+        # closes the handshake, browsers send the access_token cookie along
+        return WebSocketException(status.WS_1008_POLICY_VIOLATION,
+                                  "Not authenticated")
+    return UnauthorizedError
+
+
 async def get_current_user(
-    request: Request,
+    request: HTTPConnection,
     config: Annotated[Config, Depends(get_config)],
     dbsession: Annotated[async_sessionmaker[AsyncSession],
                          Depends(get_session)],
@@ -51,7 +61,7 @@ async def get_current_user(
         _, token = get_authorization_scheme_param(authorization)
 
     if not token:
-        raise UnauthorizedError
+        raise unauthorized(request)
 
     try:
         payload: JWTPayload = jwt.decode(
@@ -70,14 +80,14 @@ async def get_current_user(
             },
         )
     except jwt.PyJWTError:
-        raise UnauthorizedError
+        raise unauthorized(request)
 
     principal = payload["sub"]
 
     async with dbsession() as session:
         user = await User.get_by_username(session, principal)
         if user is None:
-            raise UnauthorizedError
+            raise unauthorized(request)
         request.scope["user"] = user
 
     return None
@@ -0,0 +1,42 @@
+from typing import Annotated, Awaitable, Callable
+
+from fastapi import Depends
+from fastapi import HTTPException
+from fastapi import Request
+from fastapi import status
+
+from app.db import get_rate_limiter
+from app.models.users import User
+from app.service.ratelimit import RateLimited
+from app.service.ratelimit import RateLimiter
+from app.service.ratelimit import retry_after
+
+
+async def check_rate(limiter: RateLimiter,
+                     user: User,
+                     endpoint: str,
+                     units: int = 1) -> None:
+    try:
+        await limiter.admit(user.id,
+                            endpoint,
+                            units,
+                            unlimited_user=user.is_admin)
+    except RateLimited as e:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=str(e),
+            headers={"Retry-After": retry_after(e.retry_after)},
+        )
+
+
+def rate_limit(endpoint: str) -> Callable[..., Awaitable[None]]:
+    """Route dependency taking the configured cost of *endpoint* from the
+    caller's buckets, runs after authentication."""
+
+    async def check(
+        request: Request,
+        limiter: Annotated[RateLimiter, Depends(get_rate_limiter)],
+    ) -> None:
+        await check_rate(limiter, request.scope["user"], endpoint)
+
+    return check
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import threading
+import time
+from typing import TYPE_CHECKING
+from uuid import UUID
+
+from app.settings import AddressConfig
+
+if TYPE_CHECKING:
+    import libvirt
+
+
+@dataclass
+class Resolved:
+    # MAC -> IPv4 address, in the order of the domain's interfaces
+    addresses: dict[str, str]
+    expires: float
+
+
+def source_flag(source: str) -> int:
+    import libvirt
+
+    return {
+        "lease": libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE,
+        "arp": libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP,
+        "agent": libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT,
+    }[source]
+
+
+def interface_addresses(domain: libvirt.virDomain,
+                        source: str) -> dict[str, str]:
+    """First IPv4 address of every interface of *domain* as *source* knows
+    them. Empty when it doesn't, e.g. no guest agent is running."""
+    import libvirt
+
+    try:
+        interfaces = domain.interfaceAddresses(source_flag(source))
+    except libvirt.libvirtError:
+        return {}
+    addresses: dict[str, str] = {}
+    for name, interface in interfaces.items():
+        mac = interface.get("hwaddr")
+        # the agent reports the guest's loopback too
+        if not mac or name == "lo":
+            continue
+        for addr in interface.get("addrs") or ():
+            if addr["type"] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                addresses.setdefault(mac, addr["addr"])
+    return addresses
+
+
+class AddressResolver:
+    """Addresses of running domains, for the ones IPAM didn't assign.
+
+    DHCP leases only exist on networks libvirt serves DHCP for, bridged
+    domains are found in the host's ARP table or through the guest agent.
+    The configured sources are asked in order, the first one knowing an
+    address wins. Results are kept per domain, and per MAC within it, for
+    `ttl` seconds, or `miss_ttl` while no source knows one (e.g. the guest
+    is still booting). Lifecycle events of a domain drop its entry.
+    """
+
+    def __init__(self, config: AddressConfig) -> None:
+        self.config = config
+        self.cache: dict[UUID, Resolved] = {}
+        # lookups run in worker threads, events in libvirt's
+        self.lock = threading.Lock()
+
+    def lookup(self, domain: libvirt.virDomain) -> str:
+        """Address of the first interface of *domain* that has one, empty
+        when none is known."""
+        id = UUID(domain.UUIDString())
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(id)
+        if entry is None or entry.expires <= now:
+            addresses = self.resolve(domain)
+            ttl = self.config.ttl if addresses else self.config.miss_ttl
+            entry = Resolved(addresses, now + ttl)
+            with self.lock:
+                self.cache[id] = entry
+        return next(iter(entry.addresses.values()), "")
+
+    def resolve(self, domain: libvirt.virDomain) -> dict[str, str]:
+        for source in self.config.sources:
+            addresses = interface_addresses(domain, source)
+            if addresses:
+                return addresses
+        return {}
+
+    def invalidate(self, id: UUID) -> None:
+        with self.lock:
+            self.cache.pop(id, None)
+
+    def on_lifecycle(self, host: str, id: UUID, event: int) -> None:
+        # started, stopped, resumed... the address may change with any
+        self.invalidate(id)
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import socket
+from typing import Optional
+from xml.etree import ElementTree as ET
+
+from starlette.websockets import WebSocket
+from starlette.websockets import WebSocketDisconnect
+
+from app.settings import ConsoleConfig
+
+logger = logging.getLogger(__name__)
+
+# addresses meaning "every interface", the console is reached on loopback
+WILDCARD = {"", "0.0.0.0", "::"}
+
+
+class ConsoleError(Exception):
+    pass
+
+
+class ConsoleBusy(ConsoleError):
+    """The process already relays as many consoles as it's allowed to."""
+
+
+def vnc_address(xml: str) -> tuple[str, int]:
+    """(address, port) of the VNC server of a running domain, from its live
+    XML, autoport only assigns the port once the domain starts."""
+    graphics = ET.fromstring(xml).find("devices/graphics[@type='vnc']")
+    if graphics is None:
+        raise ConsoleError("Instance has no VNC console")
+    port = int(graphics.get("port", "-1"))
+    if port <= 0:
+        raise ConsoleError("Instance is not running")
+    listen = graphics.find("listen[@type='address']")
+    address = graphics.get("listen", "")
+    if listen is not None:
+        address = listen.get("address", address)
+    if address in WILDCARD:
+        address = "127.0.0.1"
+    return address, port
+
+
+class ConsoleProxy:
+    """Relays VNC connections over WebSockets, for every console of the API
+    process.
+
+    Each direction is a single task that doesn't read more before the
+    previous write completed, so a slow peer stalls its sender instead of
+    growing buffers. Reads from the VNC server go to a buffer allocated
+    once per console and coalesce whatever arrived, up to its size, into
+    one message.
+    """
+
+    def __init__(self, config: ConsoleConfig) -> None:
+        self.config = config
+        self.sessions = 0
+
+    async def connect(self, address: str, port: int) -> socket.socket:
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(address,
+                                       port,
+                                       type=socket.SOCK_STREAM,
+                                       proto=socket.IPPROTO_TCP)
+        family, type, proto, _, sockaddr = infos[0]
+        sock = socket.socket(family, type, proto)
+        sock.setblocking(False)
+        # keystrokes and small updates shouldn't wait for more data
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, sockaddr),
+                                   self.config.connect_timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def serve(self, websocket: WebSocket, address: str,
+                    port: int) -> None:
+        """Accepts *websocket* and relays it to the VNC server at
+        *address*:*port* until either side closes."""
+        if self.sessions >= self.config.max_sessions:
+            raise ConsoleBusy("Too many open consoles, try again later")
+        self.sessions += 1
+        try:
+            try:
+                sock = await self.connect(address, port)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise ConsoleError(f"VNC server unreachable: {e}")
+            try:
+                # noVNC and websockify clients ask for "binary"
+                subprotocol = ("binary" if "binary" in websocket.scope.get(
+                    "subprotocols", ()) else None)
+                await websocket.accept(subprotocol=subprotocol)
+                await self.relay(websocket, sock)
+            finally:
+                sock.close()
+        finally:
+            self.sessions -= 1
+
+    async def relay(self, websocket: WebSocket, sock: socket.socket) -> None:
+        tasks = [
+            asyncio.create_task(self.client_to_vnc(websocket, sock)),
+            asyncio.create_task(self.vnc_to_client(websocket, sock)),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        # either side going away ends the console, anything else is a bug
+        expected = (OSError, WebSocketDisconnect)
+        for task in done:
+            e = task.exception()
+            if e is not None and not isinstance(e, expected):
+                logger.error("console relay failed", exc_info=e)
+        try:
+            await websocket.close()
+        except RuntimeError:
+            # closed by the client already
+            pass
+
+    async def client_to_vnc(self, websocket: WebSocket,
+                            sock: socket.socket) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            data: Optional[bytes] = message.get("bytes")
+            if data is None:
+                # VNC is binary, websockify's base64 text mode isn't supported
+                continue
+            # waits until the whole message was written, a slow VNC server
+            # stops the client from being read meanwhile
+            await loop.sock_sendall(sock, data)
+
+    async def vnc_to_client(self, websocket: WebSocket,
+                            sock: socket.socket) -> None:
+        loop = asyncio.get_running_loop()
+        buffer = bytearray(self.config.buffer_size)
+        view = memoryview(buffer)
+        while True:
+            n = await loop.sock_recv_into(sock, view)
+            if n == 0:
+                return
+            # ASGI messages carry bytes, the buffer is reused for the next
+            # read so this is the one copy made
+            await websocket.send_bytes(view[:n].tobytes())
@@ -0,0 +1,470 @@
+from __future__ import annotations
+
+from copy import deepcopy
+from dataclasses import dataclass
+from dataclasses import field
+from functools import lru_cache
+import re
+from typing import Iterable, Optional, Sequence, TYPE_CHECKING
+from uuid import UUID
+from uuid import uuid4
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
+
+from app.service.qos import bandwidth_element
+from app.service.qos import iotune_element
+
+if TYPE_CHECKING:
+    from app.service.pinning import Pinning
+    from app.settings import PerformanceProfile
+    from app.settings import QosTier
+
+# keep the usual prefixes when serializing, instead of ns0, ns1...
+ET.register_namespace("qemu", "http://libvirt.org/schemas/domain/qemu/1.0")
+ET.register_namespace("libosinfo",
+                      "http://libosinfo.org/xmlns/libvirt/domain/1.0")
+
+NAME_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+MAC_RE = re.compile(r"(?:[0-9a-f]{2}:){5}[0-9a-f]{2}")
+SLOT_RE = re.compile("\x00([a-z]+)\x00")
+
+ATTR_ENTITIES = {'"': "&quot;"}
+
+SEED = ('<disk type="file" device="cdrom">'
+        '<driver name="qemu" type="raw" />'
+        '<source file="{path}" />'
+        '<target dev="sda" bus="sata" />'
+        '<readonly />'
+        '</disk>')
+
+TOPOLOGY = ('<topology sockets="{sockets}" dies="1" cores="{cores}" '
+            'threads="{threads}" />')
+
+VCPUPIN = '<vcpupin vcpu="{vcpu}" cpuset="{cpuset}" />'
+EMULATORPIN = '<emulatorpin cpuset="{cpuset}" />'
+MEMNODE = '<memnode cellid="{id}" mode="strict" nodeset="{node}" />'
+NUMA_CELL = '<cell id="{id}" cpus="{cpus}" memory="{memory}" unit="KiB" />'
+HUGEPAGES = ('<memoryBacking><hugepages><page size="{size}" unit="KiB" />'
+             '</hugepages></memoryBacking>')
+
+# rendered from DomainSpec.pinning, cpuset and performance, a template
+# can't have them
+TUNING = ("cputune", "numatune", "memoryBacking", "cpu/numa", "iothreads")
+
+SCSI = ('<controller type="scsi" index="0" model="virtio-scsi">{driver}'
+        '</controller>')
+# sda is the seed ISO's
+SCSI_TARGET = {"dev": "sdb", "bus": "scsi"}
+
+
+class InvalidDomain(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class Nic:
+    mac: str
+    # libvirt network name for "network" interfaces, bridge device otherwise
+    source: str
+    type: str = "network"
+
+
+@dataclass(frozen=True)
+class Topology:
+    sockets: int
+    cores: int
+    threads: int = 1
+
+
+@dataclass
+class DomainSpec:
+    name: str
+    vcpu: int
+    # KiB
+    ram: int
+    disk: str
+    nics: Sequence[Nic] = ()
+    seed_iso: Optional[str] = None
+    topology: Optional[Topology] = None
+    uuid: UUID = field(default_factory=uuid4)
+    # dedicated host CPUs and cells, the topology defaults to theirs
+    pinning: Optional[Pinning] = None
+    # host CPUs the vCPUs (and, for a pinned domain, the emulator) float on
+    cpuset: Optional[str] = None
+    # disk and NIC drivers, the template's when None
+    performance: Optional[PerformanceProfile] = None
+    # disk and NIC limits, the template's when None
+    qos: Optional[QosTier] = None
+
+
+def parse_cpuset(cpuset: str) -> set[int]:
+    """CPUs of a libvirt cpuset, e.g. 0-3,8,^2."""
+    cpus: set[int] = set()
+    excluded: set[int] = set()
+    for part in cpuset.replace(" ", "").split(","):
+        if not part:
+            continue
+        into = cpus
+        if part.startswith("^"):
+            into, part = excluded, part[1:]
+        first, _, last = part.partition("-")
+        into.update(range(int(first), int(last or first) + 1))
+    return cpus - excluded
+
+
+def format_cpuset(cpus: Iterable[int]) -> str:
+    ranges: list[str] = []
+    start = end = None
+    for cpu in sorted(cpus):
+        if end is not None and cpu == end + 1:
+            end = cpu
+            continue
+        if start is not None:
+            ranges.append(f"{start}-{end}" if start != end else str(start))
+        start = end = cpu
+    if start is not None:
+        ranges.append(f"{start}-{end}" if start != end else str(start))
+    return ",".join(ranges)
+
+
+def element(tag: str, attrs: dict[str, str]) -> str:
+    values = "".join(f' {key}="{escape(str(value), ATTR_ENTITIES)}"'
+                     for key, value in attrs.items())
+    return f"<{tag}{values} />"
+
+
+def pop(parent: ET.Element, tag: str) -> Optional[ET.Element]:
+    elem = parent.find(tag)
+    if elem is not None:
+        parent.remove(elem)
+        elem.tail = None
+    return elem
+
+
+def serialize(elem: Optional[ET.Element]) -> str:
+    return "" if elem is None else ET.tostring(elem, encoding="unicode")
+
+
+def slot(name: str) -> str:
+    return f"\x00{name}\x00"
+
+
+def compile_format(elem: ET.Element) -> str:
+    """Serialize *elem* into a str.format template, slots become fields."""
+    xml = ET.tostring(elem, encoding="unicode")
+    xml = xml.replace("{", "{{").replace("}", "}}")
+    return SLOT_RE.sub(r"{\1}", xml)
+
+
+def child(parent: ET.Element, tag: str, index: int = 0) -> ET.Element:
+    elem = parent.find(tag)
+    if elem is None:
+        elem = ET.Element(tag)
+        parent.insert(index, elem)
+    return elem
+
+
+def insert_after(parent: ET.Element, elem: ET.Element, new: ET.Element) -> None:
+    new.tail = elem.tail
+    parent.insert(list(parent).index(elem) + 1, new)
+
+
+class DomainTemplate:
+    """A domain definition parsed once and rendered many times.
+
+    The template carries what every instance shares (machine type,
+    controllers, graphics...). It is compiled into a format string with
+    slots for the name, uuid, memory, vcpus, the disk source, an optional
+    seed ISO and CPU topology, CPU pinning and NUMA tuning, the disk and
+    NIC drivers and limits, and the NICs, so rendering an instance neither
+    parses nor copies a tree.
+
+    The template's first disk is the instance disk and its first
+    `<interface>` the prototype of every NIC. A template without an
+    `<interface>` keeps its own networking (e.g. a qemu:commandline netdev)
+    and ignores NICs.
+    """
+
+    def __init__(self, root: ET.Element) -> None:
+        if root.tag != "domain":
+            raise InvalidDomain(f"unexpected root element <{root.tag}>")
+        root = deepcopy(root)
+
+        devices = root.find("devices")
+        if devices is None:
+            raise InvalidDomain("template has no <devices>")
+        disk = devices.find("disk[@device='disk']")
+        if disk is None:
+            raise InvalidDomain("template has no disk")
+
+        self.nic: Optional[str] = None
+        self.nic_driver: dict[str, str] = {}
+        self.nic_model: Optional[str] = None
+        self.nic_bandwidth = ""
+        iface = devices.find("interface")
+        if iface is not None:
+            iface = deepcopy(iface)
+            # addresses are assigned by libvirt, a copied one would clash
+            for elem in iface.findall("address"):
+                iface.remove(elem)
+            driver = pop(iface, "driver")
+            if driver is not None:
+                self.nic_driver = dict(driver.attrib)
+            model = iface.find("model")
+            if model is not None:
+                self.nic_model = model.get("type")
+            self.nic_bandwidth = serialize(pop(iface, "bandwidth"))
+            iface.text = slot("driver") + slot("bandwidth") + (iface.text or "")
+            iface.set("type", slot("type"))
+            child(iface, "mac").attrib = {"address": slot("mac")}
+            child(iface, "source").attrib = {slot("key"): slot("source")}
+            iface.tail = disk.tail
+            self.nic = compile_format(iface)
+        for elem in devices.findall("interface"):
+            devices.remove(elem)
+
+        for tag in ("uuid", "currentMemory"):
+            elem = root.find(tag)
+            if elem is not None:
+                root.remove(elem)
+        name = child(root, "name", 0)
+        memory = child(root, "memory", 1)
+        vcpu = child(root, "vcpu", 2)
+
+        name.text = slot("name")
+        uuid = ET.Element("uuid")
+        uuid.text = slot("uuid")
+        insert_after(root, name, uuid)
+        memory.attrib = {"unit": "KiB"}
+        memory.text = slot("ram")
+        current = ET.Element("currentMemory", unit="KiB")
+        current.text = slot("ram")
+        insert_after(root, memory, current)
+        vcpu.text = slot("vcpu")
+        for path in TUNING:
+            if root.find(path) is not None:
+                raise InvalidDomain(f"template has a <{path}>")
+        vcpu.tail = slot("tuning") + (vcpu.tail or "")
+
+        # the topology goes into the template's <cpu>, or a new one
+        cpu = root.find("cpu")
+        self.cpu_wrapped = cpu is None
+        if cpu is None:
+            vcpu.tail = slot("topology") + (vcpu.tail or "")
+        else:
+            cpu.text = slot("topology") + (cpu.text or "")
+
+        child(disk, "source").attrib = {"file": slot("disk")}
+        # driver, target and address depend on the performance profile
+        driver = pop(disk, "driver")
+        self.disk_driver = (dict(driver.attrib) if driver is not None else {
+            "name": "qemu"
+        })
+        target = pop(disk, "target")
+        self.disk_target = (dict(target.attrib) if target is not None else {
+            "dev": "vda",
+            "bus": "virtio"
+        })
+        self.disk_address = serialize(pop(disk, "address"))
+        self.disk_iotune = serialize(pop(disk, "iotune"))
+        disk.text = slot("drive") + slot("iotune") + (disk.text or "")
+        self.scsi = devices.find("controller[@type='scsi']") is not None
+        disk.tail = (slot("controller") + slot("seed") + slot("nics") +
+                     (disk.tail or ""))
+
+        self.xml = compile_format(root)
+
+    @classmethod
+    def parse(cls, xml: str) -> DomainTemplate:
+        try:
+            return cls(ET.fromstring(xml))
+        except ET.ParseError as e:
+            raise InvalidDomain(str(e)) from e
+
+    def render(self, spec: DomainSpec) -> str:
+        validate(spec)
+
+        topology = ""
+        guest_topology = spec.topology
+        if guest_topology is None and spec.pinning is not None:
+            guest_topology = spec.pinning.topology()
+        if guest_topology is not None:
+            topology = TOPOLOGY.format(sockets=guest_topology.sockets,
+                                       cores=guest_topology.cores,
+                                       threads=guest_topology.threads)
+        topology += numa(spec)
+        if topology and self.cpu_wrapped:
+            topology = f"<cpu>{topology}</cpu>"
+
+        seed = ""
+        if spec.seed_iso is not None:
+            seed = SEED.format(path=escape(spec.seed_iso, ATTR_ENTITIES))
+
+        iotune, bandwidth = self.disk_iotune, self.nic_bandwidth
+        if spec.qos is not None:
+            iotune = iotune_element(spec.qos)
+            bandwidth = bandwidth_element(spec.qos)
+
+        nics = ""
+        if self.nic is not None:
+            driver = self.render_nic_driver(spec)
+            nics = "".join(
+                self.nic.format(
+                    type=nic.type,
+                    mac=nic.mac,
+                    key="network" if nic.type == "network" else "bridge",
+                    source=escape(nic.source, ATTR_ENTITIES),
+                    driver=driver,
+                    bandwidth=bandwidth,
+                ) for nic in spec.nics)
+        drive, controller = self.render_drive(spec)
+
+        return self.xml.format(
+            name=spec.name,
+            uuid=spec.uuid,
+            ram=spec.ram,
+            vcpu=spec.vcpu,
+            topology=topology,
+            tuning=tuning(spec),
+            disk=escape(spec.disk, ATTR_ENTITIES),
+            drive=drive,
+            iotune=iotune,
+            controller=controller,
+            seed=seed,
+            nics=nics,
+        )
+
+    def render_drive(self, spec: DomainSpec) -> tuple[str, str]:
+        """<driver>, <target> and <address> of the disk, and the
+        controller it needs."""
+        driver = dict(self.disk_driver)
+        target = self.disk_target
+        address = self.disk_address
+        controller = ""
+        profile = spec.performance
+        if profile is not None:
+            for key in ("cache", "io", "discard"):
+                value = getattr(profile, key)
+                if value is not None:
+                    driver[key] = value
+            if profile.bus == "scsi":
+                # on the controller, libvirt assigns the drive address
+                target, address = SCSI_TARGET, ""
+                if not self.scsi:
+                    controller = SCSI.format(
+                        driver=element("driver", {"iothread": "1"}
+                                      ) if profile.iothread else "")
+            elif profile.iothread:
+                driver["iothread"] = "1"
+        return (element("driver", driver) + element("target", target) + address,
+                controller)
+
+    def render_nic_driver(self, spec: DomainSpec) -> str:
+        driver = dict(self.nic_driver)
+        profile = spec.performance
+        if profile is not None:
+            queues = min(profile.queues or spec.vcpu, spec.vcpu)
+            if (queues > 1 or profile.vhost) and self.nic_model != "virtio":
+                raise InvalidDomain(
+                    "multiqueue and vhost need a virtio interface model")
+            if profile.vhost:
+                driver["name"] = "vhost"
+            if queues > 1:
+                driver["queues"] = str(queues)
+        return element("driver", driver) if driver else ""
+
+
+def tuning(spec: DomainSpec) -> str:
+    """<iothreads>, <cputune>, <numatune> and <memoryBacking> of *spec*."""
+    iothreads = ""
+    if spec.performance is not None and spec.performance.iothread:
+        iothreads = "<iothreads>1</iothreads>"
+    return iothreads + cpu_tuning(spec)
+
+
+def cpu_tuning(spec: DomainSpec) -> str:
+    if spec.pinning is None:
+        if spec.cpuset is None:
+            return ""
+        pins = "".join(
+            VCPUPIN.format(vcpu=vcpu, cpuset=spec.cpuset)
+            for vcpu in range(spec.vcpu))
+        return (f"<cputune>{pins}"
+                f"{EMULATORPIN.format(cpuset=spec.cpuset)}</cputune>")
+    pinning = spec.pinning
+    pins = "".join(
+        VCPUPIN.format(vcpu=vcpu, cpuset=cpu)
+        for vcpu, cpu in enumerate(pinning.vcpus))
+    # emulator threads stay off the dedicated CPUs when there are others
+    emulator = spec.cpuset or format_cpuset(pinning.held)
+    nodes = format_cpuset(cell.node for cell in pinning.cells)
+    memnodes = "".join(
+        MEMNODE.format(id=i, node=cell.node)
+        for i, cell in enumerate(pinning.cells))
+    xml = (f"<cputune>{pins}{EMULATORPIN.format(cpuset=emulator)}</cputune>"
+           f'<numatune><memory mode="strict" nodeset="{nodes}" />'
+           f"{memnodes}</numatune>")
+    if pinning.page_size is not None:
+        xml += HUGEPAGES.format(size=pinning.page_size)
+    return xml
+
+
+def numa(spec: DomainSpec) -> str:
+    """Guest NUMA cells of a pinned *spec*, one per host cell."""
+    if spec.pinning is None:
+        return ""
+    cells = []
+    first = 0
+    for i, cell in enumerate(spec.pinning.cells):
+        vcpus = range(first, first + len(cell.cpus))
+        cells.append(
+            NUMA_CELL.format(id=i,
+                             cpus=format_cpuset(vcpus),
+                             memory=cell.memory))
+        first += len(cell.cpus)
+    return f"<numa>{''.join(cells)}</numa>"
+
+
+def validate(spec: DomainSpec) -> None:
+    """Local sanity checks, catching what libvirt would otherwise reject
+    only after the disk has been created."""
+    if not NAME_RE.fullmatch(spec.name):
+        raise InvalidDomain(f"invalid domain name {spec.name!r}")
+    if spec.vcpu <= 0:
+        raise InvalidDomain("vcpu must be positive")
+    if spec.ram <= 0:
+        raise InvalidDomain("memory must be positive")
+    if not spec.disk:
+        raise InvalidDomain("disk path is empty")
+    if spec.pinning is not None:
+        if len(spec.pinning.vcpus) != spec.vcpu:
+            raise InvalidDomain(f"{len(spec.pinning.vcpus)} vcpus pinned for "
+                                f"{spec.vcpu}")
+        if spec.pinning.memory != spec.ram:
+            raise InvalidDomain("NUMA cells don't add up to the memory")
+    if spec.cpuset is not None:
+        try:
+            parse_cpuset(spec.cpuset)
+        except ValueError:
+            raise InvalidDomain(f"invalid cpuset {spec.cpuset!r}")
+    if spec.topology is not None:
+        t = spec.topology
+        if t.sockets * t.cores * t.threads != spec.vcpu:
+            raise InvalidDomain(
+                f"topology {t.sockets}x{t.cores}x{t.threads} doesn't match "
+                f"{spec.vcpu} vcpus")
+    macs = [nic.mac.lower() for nic in spec.nics]
+    for mac in macs:
+        if not MAC_RE.fullmatch(mac):
+            raise InvalidDomain(f"invalid MAC address {mac!r}")
+    if len(set(macs)) != len(macs):
+        raise InvalidDomain("duplicate MAC address")
+    for nic in spec.nics:
+        if nic.type not in ("network", "bridge"):
+            raise InvalidDomain(f"unsupported interface type {nic.type!r}")
+
+
+@lru_cache
+def load_template(path: str) -> DomainTemplate:
+    with open(path, "r") as f:
+        return DomainTemplate.parse(f.read())
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import asyncio
+from collections import Counter
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from dataclasses import field
+import heapq
+import time
+from typing import AsyncIterator, Literal, Optional
+
+from app.settings import Config
+
+# "disk" stages copy a full image and compete for the host's disk, "light"
+# ones (linked clones, define, boot, ansible) mostly wait on the guest
+Lane = Literal["disk", "light"]
+
+PRIORITY_NORMAL = 0
+PRIORITY_ADMIN = 1
+
+# weight of the newest run in the mean stage duration
+EWMA_ALPHA = 0.2
+
+
+@dataclass(eq=False)
+class Ticket:
+    user_id: int
+    priority: int
+    lane: LaneQueue
+    granted: Optional[float] = None
+    future: asyncio.Future[None] = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future())
+
+    @property
+    def position(self) -> Optional[int]:
+        """Number of tickets served before this one, None once granted."""
+        if self.granted is not None:
+            return None
+        for position, ticket in enumerate(self.lane.order()):
+            if ticket is self:
+                return position
+        return None
+
+    def wait(self) -> Optional[float]:
+        """Estimated seconds until this ticket gets a slot."""
+        if self.granted is not None:
+            return 0.0
+        position = self.position
+        if position is None:
+            return None
+        return self.lane.estimate_start(position)
+
+
+def take(users: dict[int, deque[Ticket]], active: Counter[int],
+         served: dict[int, int], turn: int) -> Ticket:
+    # the user holding the fewest slots goes first, between equals the one
+    # served longest ago
+    user_id = min(users,
+                  key=lambda user_id:
+                  (active[user_id], served.get(user_id, -1)))
+    tickets = users[user_id]
+    ticket = tickets.popleft()
+    if not tickets:
+        del users[user_id]
+    served[user_id] = turn
+    return ticket
+
+
+class LaneQueue:
+    """Slots of one kind of stage on one host.
+
+    Waiters are queued per user. The next slot goes to the waiting user
+    holding the fewest slots, round-robin between equals, so a large batch
+    can't hold back everyone else. Admin tickets are served before any
+    other.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.running: list[Ticket] = []
+        # priority -> user -> waiting tickets
+        self.waiting: dict[int, dict[int, deque[Ticket]]] = {}
+        # turn each user was last served at
+        self.served: dict[int, int] = {}
+        self.turn = 0
+        # seconds a slot is held, None until a run finished
+        self.mean: Optional[float] = None
+
+    def __len__(self) -> int:
+        return sum(
+            len(tickets)
+            for users in self.waiting.values()
+            for tickets in users.values())
+
+    def order(self) -> list[Ticket]:
+        """Waiting tickets in the order they will be served, as long as no
+        other ticket comes in."""
+        order = []
+        active = Counter(ticket.user_id for ticket in self.running)
+        served = dict(self.served)
+        turn = self.turn
+        for priority in sorted(self.waiting, reverse=True):
+            users = {
+                user_id: deque(tickets)
+                for user_id, tickets in self.waiting[priority].items()
+            }
+            while users:
+                turn += 1
+                ticket = take(users, active, served, turn)
+                active[ticket.user_id] += 1
+                order.append(ticket)
+        return order
+
+    def estimate_start(self, position: int) -> Optional[float]:
+        if self.mean is None:
+            return None
+        now = time.monotonic()
+        # expected release time of every slot, the ticket gets the slot
+        # freed after the *position* tickets ahead of it took theirs
+        slots = [
+            max(now, ticket.granted + self.mean)
+            for ticket in self.running
+            if ticket.granted is not None
+        ]
+        slots.extend([now] * (self.limit - len(slots)))
+        heapq.heapify(slots)
+        for _ in range(position):
+            heapq.heappush(slots, heapq.heappop(slots) + self.mean)
+        return slots[0] - now
+
+    def submit(self, user_id: int, priority: int) -> Ticket:
+        ticket = Ticket(user_id, priority, self)
+        users = self.waiting.setdefault(priority, {})
+        users.setdefault(user_id, deque()).append(ticket)
+        self.dispatch()
+        return ticket
+
+    def dispatch(self) -> None:
+        while len(self.running) < self.limit:
+            ticket = self.next()
+            if ticket is None:
+                return
+            ticket.granted = time.monotonic()
+            self.running.append(ticket)
+            ticket.future.set_result(None)
+
+    def next(self) -> Optional[Ticket]:
+        active = Counter(ticket.user_id for ticket in self.running)
+        for priority in sorted(self.waiting, reverse=True):
+            users = self.waiting[priority]
+            while users:
+                self.turn += 1
+                ticket = take(users, active, self.served, self.turn)
+                if not ticket.future.done():
+                    return ticket
+            del self.waiting[priority]
+        return None
+
+    def remove(self, ticket: Ticket) -> None:
+        users = self.waiting.get(ticket.priority, {})
+        tickets = users.get(ticket.user_id)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del users[ticket.user_id]
+
+    def release(self, ticket: Ticket) -> None:
+        self.running.remove(ticket)
+        if ticket.granted is not None:
+            held = time.monotonic() - ticket.granted
+            self.mean = held if self.mean is None else (
+                EWMA_ALPHA * held + (1 - EWMA_ALPHA) * self.mean)
+        self.dispatch()
+
+
+class ProvisionQueue:
+    """Bounds the provisioning stages running at once on every host, with a
+    separate limit for the disk heavy ones."""
+
+    def __init__(self, limits: dict[str, dict[Lane, int]]) -> None:
+        self.lanes = {
+            (host, lane): LaneQueue(limit) for host, lanes in limits.items()
+            for lane, limit in lanes.items()
+        }
+
+    @classmethod
+    def from_config(cls, config: Config) -> ProvisionQueue:
+        return cls({
+            host.name: {
+                "disk":
+                    host.disk_concurrency or config.disk_concurrency,
+                "light": (host.provision_concurrency or
+                          config.provision_concurrency),
+            } for host in config.hosts
+        })
+
+    def lane(self, host: str, lane: Lane) -> LaneQueue:
+        return self.lanes[host, lane]
+
+    def submit(self,
+               host: str,
+               lane: Lane,
+               user_id: int,
+               priority: int = PRIORITY_NORMAL) -> Ticket:
+        return self.lane(host, lane).submit(user_id, priority)
+
+    @asynccontextmanager
+    async def slot(self, ticket: Ticket) -> AsyncIterator[None]:
+        try:
+            await asyncio.shield(ticket.future)
+        except asyncio.CancelledError:
+            if ticket.future.done():
+                ticket.lane.release(ticket)
+            else:
+                ticket.future.cancel()
+                ticket.lane.remove(ticket)
+            raise
+        try:
+            yield
+        finally:
+            ticket.lane.release(ticket)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import hashlib
+import time
+from typing import Any, Optional, TYPE_CHECKING
+
+import orjson
+
+from app.settings import IdempotencyConfig
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a different request."""
+
+
+class RequestInProgress(Exception):
+    """The first request with the key is still running."""
+
+
+@dataclass(frozen=True)
+class StoredResponse:
+    status: int
+    body: Any
+
+
+def fingerprint(*parts: Any) -> str:
+    # JSON-able request parts, hashed so the record stays small
+    return hashlib.sha256(orjson.dumps(
+        parts, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+class IdempotencyStore:
+    """Responses of requests sent with an Idempotency-Key, kept in Redis.
+
+    The first request with a key claims it with SET NX and stores its
+    response once done. A retry gets that response back. A duplicate that
+    arrives while the first one runs waits for it (create endpoints answer
+    as soon as their job is registered, so it gets the same job), up to
+    *wait* seconds.
+    """
+
+    PREFIX = "idempotency:"
+
+    def __init__(self, redis: Redis, config: IdempotencyConfig) -> None:
+        self.redis = redis
+        self.config = config
+
+    def key(self, user_id: int, endpoint: str, key: str) -> str:
+        return f"{self.PREFIX}{user_id}:{endpoint}:{key}"
+
+    async def begin(self, user_id: int, endpoint: str, key: str,
+                    fingerprint: str) -> Optional[StoredResponse]:
+        """None when the caller owns the key and must complete() or
+        abort(), otherwise the response of the first request."""
+        name = self.key(user_id, endpoint, key)
+        pending = orjson.dumps({"fingerprint": fingerprint})
+        deadline = time.monotonic() + self.config.wait
+        while True:
+            # a pending claim expires quickly, a crashed worker doesn't
+            # lock the key for the whole TTL
+            if await self.redis.set(name,
+                                    pending,
+                                    nx=True,
+                                    ex=self.config.pending_ttl):
+                return None
+            raw = await self.redis.get(name)
+            if raw is None:
+                # aborted or expired in between
+                continue
+            record = orjson.loads(raw)
+            if record["fingerprint"] != fingerprint:
+                raise IdempotencyConflict(
+                    "Idempotency-Key reused with a different request")
+            if "status" in record:
+                return StoredResponse(record["status"], record["body"])
+            if time.monotonic() >= deadline:
+                raise RequestInProgress(
+                    "a request with this Idempotency-Key is in progress")
+            await asyncio.sleep(self.config.poll)
+
+    async def complete(self, user_id: int, endpoint: str, key: str,
+                       fingerprint: str, response: StoredResponse) -> None:
+        await self.redis.set(self.key(user_id, endpoint, key),
+                             orjson.dumps({
+                                 "fingerprint": fingerprint,
+                                 "status": response.status,
+                                 "body": response.body,
+                             }),
+                             ex=self.config.ttl)
+
+    async def abort(self, user_id: int, endpoint: str, key: str) -> None:
+        # failed requests aren't stored, a retry runs again
+        await self.redis.delete(self.key(user_id, endpoint, key))
@@ -0,0 +1,350 @@
+"""Domains of every host, polled by one process and shared with the others.
+
+The worker lists the hypervisors and publishes the result into a file
+mapped in memory (on /dev/shm by default), API workers map the same file
+and read it instead of asking the hypervisors themselves, so their load
+doesn't grow with the number of API workers.
+
+The file is a header and a msgpack payload behind a seqlock: the sequence
+number is odd while the writer is changing the payload, a reader copies the
+payload and only keeps it when the sequence number was even and the same
+before and after. Readers never block the writer or each other, and only
+decode a payload once, when the sequence number changed.
+"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Any, Optional, TYPE_CHECKING
+from uuid import UUID
+
+import msgpack
+
+from app.service.addresses import AddressResolver
+from app.service.virt import VirtPool
+from app.settings import InventoryConfig
+
+if TYPE_CHECKING:
+    import libvirt
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"HKIV"
+# magic, flags, sequence number, payload length, published (epoch)
+HEADER = struct.Struct("<4sIQQd")
+SEQUENCE = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+# set in a file replaced by a larger one, or by the one of a new writer,
+# readers map the new one
+MOVED = 1
+READ_RETRIES = 100
+
+STATES = ("running", "paused", "hibernated", "off")
+
+
+def domain_fields(domain: libvirt.virDomain,
+                  ip: Optional[str] = None,
+                  resolver: Optional[AddressResolver] = None) -> dict[str, Any]:
+    """Fields of the InstanceSchema of *domain*, already of the right types.
+    *ip* is the address reserved by IPAM, otherwise a running domain's one
+    comes from *resolver*."""
+    import libvirt
+
+    name = domain.name()
+    uuid = UUID(domain.UUIDString())
+    state, max_mem, mem, vcpu, time = domain.info()
+    if state in (libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_PAUSED):
+        state = "running" if state == libvirt.VIR_DOMAIN_RUNNING else "paused"
+        vcpu = domain.maxVcpus()
+        ram = domain.maxMemory()
+        if ip is None:
+            ip = resolver.lookup(domain) if resolver is not None else ""
+    else:
+        ram = int(max_mem)
+        vcpu = int(vcpu)
+        ip = ip or ""
+        state = "hibernated" if domain.hasManagedSaveImage(0) else "off"
+    return {
+        "id": uuid,
+        "name": name,
+        "ip": ip,
+        "vcpu": vcpu,
+        "ram": str(ram),
+        "state": state,
+    }
+
+
+@dataclass
+class HostInventory:
+    # when the host was last listed, a host that can't be listed keeps its
+    # previous domains and time
+    updated: float
+    # id -> domain_fields
+    domains: dict[UUID, dict[str, Any]]
+
+    def usage(self) -> tuple[int, int]:
+        """vCPUs and memory (KiB) allocated to the domains, the maximum
+        vCPUs for running ones."""
+        vcpus = ram = 0
+        for fields in self.domains.values():
+            vcpus += fields["vcpu"]
+            ram += int(fields["ram"])
+        return vcpus, ram
+
+
+@dataclass
+class Snapshot:
+    published: float
+    hosts: dict[str, HostInventory]
+
+    def fresh(self, host: str, max_age: float) -> Optional[HostInventory]:
+        inventory = self.hosts.get(host)
+        if inventory is None or time.time() - inventory.updated > max_age:
+            return None
+        return inventory
+
+
+def row(fields: dict[str, Any]) -> list[Any]:
+    # rows instead of maps, field names would be most of the payload
+    return [
+        fields["id"].bytes,
+        fields["name"],
+        fields["ip"],
+        fields["vcpu"],
+        int(fields["ram"]),
+        STATES.index(fields["state"]),
+    ]
+
+
+def encode(hosts: dict[str, HostInventory]) -> bytes:
+    return msgpack.packb({
+        host: [inventory.updated, [row(f) for f in inventory.domains.values()]]
+        for host, inventory in hosts.items()
+    })
+
+
+def decode(payload: bytes) -> dict[str, HostInventory]:
+    hosts = {}
+    for host, (updated, rows) in msgpack.unpackb(payload).items():
+        domains = {}
+        for id, name, ip, vcpu, ram, state in rows:
+            uuid = UUID(bytes=id)
+            domains[uuid] = {
+                "id": uuid,
+                "name": name,
+                "ip": ip,
+                "vcpu": vcpu,
+                "ram": str(ram),
+                "state": STATES[state],
+            }
+        hosts[host] = HostInventory(updated, domains)
+    return hosts
+
+
+class InventoryWriter:
+    """Publishes snapshots to *path*, a single writer per file. The file
+    starts with room for *capacity* bytes of payload, a larger payload
+    replaces it with one twice the size."""
+
+    def __init__(self, path: str, capacity: int) -> None:
+        self.path = path
+        self.sequence = 0
+        self.mm: Optional[mmap.mmap] = None
+        self.map(capacity)
+
+    @property
+    def capacity(self) -> int:
+        assert self.mm is not None
+        return len(self.mm) - HEADER.size
+
+    def map(self, capacity: int) -> None:
+        # filled in under another name and renamed, readers never map a
+        # file without a header
+        tmp = f"{self.path}.{os.getpid()}"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, HEADER.size + capacity)
+            mm = mmap.mmap(fd, HEADER.size + capacity)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(mm, 0, MAGIC, 0, self.sequence, 0, 0.0)
+        old = self.mm
+        if old is None:
+            # left by a previous publisher, its readers are still on it
+            old = self.map_previous()
+        os.replace(tmp, self.path)
+        if old is not None:
+            struct.pack_into("<I", old, 4, MOVED)
+            old.close()
+        self.mm = mm
+
+    def map_previous(self) -> Optional[mmap.mmap]:
+        try:
+            with open(self.path, "r+b") as f:
+                mm = mmap.mmap(f.fileno(), 0)
+        except (FileNotFoundError, ValueError):
+            return None
+        if mm[:4] != MAGIC:
+            mm.close()
+            return None
+        return mm
+
+    def publish(self, payload: bytes) -> int:
+        if len(payload) > self.capacity:
+            self.map(max(len(payload), 2 * self.capacity))
+        assert self.mm is not None
+        self.sequence += 1
+        SEQUENCE.pack_into(self.mm, SEQUENCE_OFFSET, self.sequence)
+        self.mm[HEADER.size:HEADER.size + len(payload)] = payload
+        self.sequence += 1
+        HEADER.pack_into(self.mm, 0, MAGIC, 0, self.sequence, len(payload),
+                         time.time())
+        return self.sequence
+
+    def close(self) -> None:
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+class InventoryReader:
+    """Latest snapshot published to *path*, None until there is one. Hosts
+    listed more than *max_age* seconds ago aren't served from it."""
+
+    def __init__(self, path: str, max_age: float) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.mm: Optional[mmap.mmap] = None
+        # of the mapped file, sequence numbers start over with a new writer
+        self.sequence = -1
+        self.snapshot: Optional[Snapshot] = None
+
+    def map(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # not published yet, or an empty file
+            return False
+        if mm[:4] != MAGIC:
+            mm.close()
+            return False
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mm
+        self.sequence = -1
+        return True
+
+    def read(self) -> Optional[Snapshot]:
+        if self.mm is None and not self.map():
+            return None
+        assert self.mm is not None
+        for _ in range(READ_RETRIES):
+            _, flags, sequence, length, published = HEADER.unpack_from(self.mm)
+            if flags & MOVED:
+                if not self.map():
+                    break
+                continue
+            if sequence == self.sequence or length == 0:
+                return self.snapshot
+            if sequence & 1 or HEADER.size + length > len(self.mm):
+                # being written
+                time.sleep(0)
+                continue
+            payload = self.mm[HEADER.size:HEADER.size + length]
+            if SEQUENCE.unpack_from(self.mm, SEQUENCE_OFFSET)[0] != sequence:
+                continue
+            self.snapshot = Snapshot(published, decode(payload))
+            self.sequence = sequence
+            return self.snapshot
+        # the writer kept it busy, the previous snapshot is still good
+        return self.snapshot
+
+    def host(self, host: str) -> Optional[HostInventory]:
+        snapshot = self.read()
+        if snapshot is None:
+            return None
+        return snapshot.fresh(host, self.max_age)
+
+
+def host_fields(conn: libvirt.virConnect,
+                resolver: AddressResolver) -> list[dict[str, Any]]:
+    return [
+        domain_fields(domain, None, resolver)
+        for domain in conn.listAllDomains()
+    ]
+
+
+class InventoryPublisher:
+    """Lists every host of *pool* every `interval` seconds, or as soon as a
+    domain changed state (at most every `min_interval`), and publishes the
+    result.
+
+    Only one process publishes at a time, the others wait on a lock of the
+    file and take over if it goes away.
+    """
+
+    def __init__(self, pool: VirtPool, resolver: AddressResolver,
+                 config: InventoryConfig) -> None:
+        self.pool = pool
+        self.resolver = resolver
+        self.config = config
+        self.hosts: dict[str, HostInventory] = {}
+        self.changed = asyncio.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def on_lifecycle(self, host: str, id: UUID, event: int) -> None:
+        # runs in libvirt's event thread
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.changed.set)
+
+    async def poll(self, host: str) -> None:
+        try:
+            virt = await self.pool.connect(host)
+            fields = await virt.read("list", host_fields, self.resolver)
+        except Exception as e:
+            # published as last listed, readers see how old it is
+            logger.warning("failed to list the domains of %s: %s", host, e)
+            return
+        self.hosts[host] = HostInventory(time.time(),
+                                         {f["id"]: f for f in fields})
+
+    async def lock(self) -> int:
+        import fcntl
+
+        fd = os.open(f"{self.config.path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                await asyncio.sleep(self.config.interval)
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        fd = await self.lock()
+        writer = InventoryWriter(self.config.path, self.config.capacity)
+        try:
+            while True:
+                self.changed.clear()
+                await asyncio.gather(
+                    *(self.poll(host) for host in self.pool.hosts))
+                try:
+                    writer.publish(encode(self.hosts))
+                except Exception:
+                    logger.exception("failed to publish the inventory")
+                try:
+                    await asyncio.wait_for(self.changed.wait(),
+                                           self.config.interval)
+                except asyncio.TimeoutError:
+                    continue
+                # a burst of events, e.g. a batch booting, is one listing
+                await asyncio.sleep(self.config.min_interval)
+        finally:
+            writer.close()
+            os.close(fd)
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+from ipaddress import ip_address
+from ipaddress import ip_network
+import logging
+from typing import Optional, TYPE_CHECKING
+from uuid import UUID
+from xml.etree import ElementTree as ET
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models.addresses import Address
+from app.settings import NetworkConfig
+
+if TYPE_CHECKING:
+    import libvirt
+
+logger = logging.getLogger(__name__)
+
+# the MAC carries the slot in its last three bytes
+MAX_SLOTS = 1 << 24
+
+
+class NoAddress(Exception):
+    pass
+
+
+class AddressConflict(Exception):
+    pass
+
+
+class Bitmap:
+    """Fixed size bitmap backed by a Python int, finding the lowest clear
+    bit is a couple of word operations instead of a scan."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.bits = 0
+
+    def set(self, i: int) -> None:
+        self.bits |= 1 << i
+
+    def clear(self, i: int) -> None:
+        self.bits &= ~(1 << i)
+
+    def first_clear(self) -> Optional[int]:
+        # isolates the lowest zero bit of bits
+        i = (~self.bits & (self.bits + 1)).bit_length() - 1
+        return i if i < self.size else None
+
+
+@dataclass(frozen=True)
+class Lease:
+    slot: int
+    # None when the network's DHCP server picks the address
+    ip: Optional[str]
+    mac: str
+
+
+def slot_mac(slot: int) -> str:
+    return "52:54:00:%02x:%02x:%02x" % (slot >> 16 & 0xFF, slot >> 8 & 0xFF,
+                                        slot & 0xFF)
+
+
+class IPAM:
+    """Hands out addresses of the configured pool, each with a MAC derived
+    from its position in the subnet so neither can collide. Without a pool
+    it only hands out MACs, numbered by slots of their own.
+
+    Taken slots are mirrored in a bitmap, the addresses table is the source
+    of truth: its primary key settles races between API workers, and the
+    bitmap is reloaded from it when it looks full.
+    """
+
+    def __init__(self, network: NetworkConfig) -> None:
+        self.subnet = ip_network(network.subnet)
+        self.network = network
+        if network.managed:
+            if self.subnet.num_addresses > MAX_SLOTS:
+                raise ValueError(f"subnet {self.subnet} is too large")
+            # slots of the pool, the rest of the subnet is never handed out
+            base = int(self.subnet.network_address)
+            self.first = int(network.pool_start) - base
+            self.last = int(network.pool_end) - base
+            self.bitmap = Bitmap(self.subnet.num_addresses)
+        else:
+            # 00:00:00 is left out, like the network address
+            self.first = 1
+            self.last = MAX_SLOTS - 1
+            self.bitmap = Bitmap(MAX_SLOTS)
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def reserve(self) -> None:
+        if not self.network.managed:
+            self.bitmap.bits = 1
+            return
+        # everything outside the pool
+        self.bitmap.bits = ((1 << self.bitmap.size) - 1) ^ (
+            (1 << self.last + 1) - (1 << self.first))
+        # network address, gateway and the like, plus broadcast on IPv4
+        for slot in range(self.network.reserved + 1):
+            self.bitmap.set(slot)
+        if self.subnet.version == 4:
+            self.bitmap.set(self.subnet.num_addresses - 1)
+
+    def lease(self, slot: int) -> Lease:
+        if not self.network.managed:
+            return Lease(slot, None, slot_mac(slot))
+        return Lease(slot, str(self.subnet[slot]), slot_mac(slot))
+
+    async def load(self, session: AsyncSession) -> None:
+        self.reserve()
+        for slot in await Address.get_slots(session):
+            self.bitmap.set(slot)
+        self.loaded = True
+
+    async def allocate(self, session: AsyncSession, host: str,
+                       name: str) -> Lease:
+        async with self.lock:
+            if not self.loaded:
+                await self.load(session)
+            reloaded = False
+            while True:
+                slot = self.bitmap.first_clear()
+                if slot is None:
+                    if reloaded:
+                        raise NoAddress(self.exhausted())
+                    # other workers may have released addresses
+                    await self.load(session)
+                    reloaded = True
+                    continue
+                self.bitmap.set(slot)
+                lease = self.lease(slot)
+                try:
+                    await Address.create(session, slot, lease.ip, lease.mac,
+                                         host, name)
+                except IntegrityError:
+                    # taken by another worker, stays set in the bitmap
+                    await session.rollback()
+                    continue
+                return lease
+
+    def exhausted(self) -> str:
+        if not self.network.managed:
+            return "no MAC address left"
+        return ("no address left in "
+                f"{self.network.pool_start}-{self.network.pool_end}")
+
+    async def assign(self, session: AsyncSession, lease: Lease,
+                     instance_id: UUID) -> None:
+        await Address.assign(session, lease.slot, instance_id)
+
+    async def release(self, session: AsyncSession, lease: Lease) -> None:
+        await Address.delete_slot(session, lease.slot)
+        self.bitmap.clear(lease.slot)
+
+    async def release_instance(self, session: AsyncSession,
+                               instance_id: UUID) -> Optional[Address]:
+        address = await Address.get_by_instance(session, instance_id)
+        if address is not None:
+            await Address.delete_slot(session, address.slot)
+            self.bitmap.clear(address.slot)
+        return address
+
+
+def dhcp_host_xml(mac: str, ip: str) -> str:
+    # no name, instance names aren't necessarily valid host names
+    return f"<host mac='{mac}' ip='{ip}'/>"
+
+
+def check_dhcp(conn: libvirt.virConnect, network: str, mac: str,
+               ip: str) -> None:
+    """Raises AddressConflict when the DHCP server of a libvirt network may
+    give *ip* to another guest than *mac*: it lies in the dynamic range, is
+    pinned to another MAC or leased to one."""
+    net = conn.networkLookupByName(network)
+    address = ip_address(ip)
+    dhcp = ET.fromstring(net.XMLDesc(0)).iterfind("ip/dhcp")
+    for section in dhcp:
+        for dynamic in section.iterfind("range"):
+            start = ip_address(dynamic.get("start", ""))
+            end = ip_address(dynamic.get("end", ""))
+            if (start.version == address.version and start <= address <= end):
+                raise AddressConflict(
+                    f"{ip} is in the DHCP range {start}-{end} of {network}")
+        for host in section.iterfind("host"):
+            other = (host.get("mac") or "").lower()
+            if host.get("ip") == ip and other != mac:
+                raise AddressConflict(f"{ip} is pinned to {other} in {network}")
+    for lease in net.DHCPLeases():
+        if lease["ipaddr"] == ip and lease["mac"].lower() != mac:
+            raise AddressConflict(
+                f"{ip} is leased to {lease['mac']} in {network}")
+
+
+def add_dhcp_host(conn: libvirt.virConnect, network: str, mac: str,
+                  ip: str) -> None:
+    """Pins *ip* to *mac* in the DHCP server of a libvirt network, live and
+    in its persistent definition."""
+    import libvirt
+
+    net = conn.networkLookupByName(network)
+    xml = dhcp_host_xml(mac, ip)
+    flags = (libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE |
+             libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG)
+    try:
+        net.update(libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                   libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, xml, flags)
+    except libvirt.libvirtError:
+        # left over by an instance that wasn't cleaned up
+        net.update(libvirt.VIR_NETWORK_UPDATE_COMMAND_MODIFY,
+                   libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, xml, flags)
+
+
+def remove_dhcp_host(conn: libvirt.virConnect, network: str, mac: str,
+                     ip: str) -> None:
+    import libvirt
+
+    try:
+        conn.networkLookupByName(network).update(
+            libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+            libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST,
+            -1,
+            dhcp_host_xml(mac, ip),
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE |
+            libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG,
+        )
+    except libvirt.libvirtError as e:
+        logger.warning("failed to remove DHCP host %s (%s): %s", mac, ip, e)
@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+import logging
+import time
+from typing import Any, AsyncIterator, Iterable, Literal, Optional, TYPE_CHECKING
+from uuid import UUID
+from uuid import uuid4
+
+import orjson
+
+from app.service.fairqueue import Ticket
+from app.service.timeline import Stage
+from app.settings import JobsConfig
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+JobStatus = Literal["QUEUED", "PROCESSING", "COMPLETED"]
+JobItemStatus = Literal["QUEUED", "PROCESSING", "COMPLETED", "FAILED"]
+
+# longer lines are cut, e.g. a module's JSON result in ansible -vvv output
+MAX_LINE = 4096
+
+
+def job_status(statuses: Iterable[str]) -> JobStatus:
+    statuses = list(statuses)
+    if all(status == "QUEUED" for status in statuses):
+        return "QUEUED"
+    if all(status in ("COMPLETED", "FAILED") for status in statuses):
+        return "COMPLETED"
+    return "PROCESSING"
+
+
+class JobLog:
+    """Output of the provisioning runs of a job, held by the process running
+    them until the JobStore writes it out. Lines are numbered from 0 for the
+    whole job."""
+
+    def __init__(self) -> None:
+        # lines not written out yet, the last ones appended
+        self.pending: list[str] = []
+        # number of the next line appended
+        self.end = 0
+        self.closed = False
+        # set by every change, wakes the writer
+        self.changed = asyncio.Event()
+
+    def append(self, line: str) -> None:
+        self.pending.append(line[:MAX_LINE])
+        self.end += 1
+        self.changed.set()
+
+    def close(self) -> None:
+        self.closed = True
+        self.changed.set()
+
+
+@dataclass
+class JobItem:
+    name: str
+    status: JobItemStatus = "QUEUED"
+    host: Optional[str] = None
+    instance_id: Optional[UUID] = None
+    error: Optional[str] = None
+    # appended to as the stages end
+    timeline: list[Stage] = field(default_factory=list)
+    # provisioning slot waited for or held
+    ticket: Optional[Ticket] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("COMPLETED", "FAILED")
+
+    @property
+    def stages(self) -> list[Stage]:
+        return sorted(self.timeline, key=lambda stage: stage.start)
+
+    @property
+    def position(self) -> Optional[int]:
+        return self.ticket.position if self.ticket is not None else None
+
+    @property
+    def eta(self) -> Optional[float]:
+        return self.ticket.wait() if self.ticket is not None else None
+
+    def record(self) -> dict[str, Any]:
+        """The item as other processes read it, the queue position and ETA
+        as of now."""
+        return {
+            "name": self.name,
+            "status": self.status,
+            "host": self.host,
+            "instance_id": self.instance_id,
+            "error": self.error,
+            "stages": [
+                dict(asdict(stage), duration=stage.duration)
+                for stage in self.stages
+            ],
+            "position": self.position,
+            "eta": self.eta,
+        }
+
+
+@dataclass
+class Job:
+    user_id: int
+    items: list[JobItem]
+    id: UUID = field(default_factory=uuid4)
+    created: float = field(default_factory=time.time)
+    log: JobLog = field(default_factory=JobLog)
+
+    @property
+    def status(self) -> JobStatus:
+        return job_status(item.status for item in self.items)
+
+
+@dataclass(frozen=True)
+class JobState:
+    """A job as last written out by the process running it."""
+    user_id: int
+    # JobItem.record() of every item
+    items: list[dict[str, Any]]
+
+    @property
+    def status(self) -> JobStatus:
+        return job_status(item["status"] for item in self.items)
+
+
+class JobStore:
+    """Provisioning jobs kept in Redis, so every API worker serves any of
+    them.
+
+    The process running a job holds it in memory and writes it out: its
+    state to the hash job:<id> every *interval* seconds, its log to the
+    stream job:<id>:log as lines come, one entry per line with the line's
+    number as id. An `end` entry holding the job's status closes the log.
+    Both keys expire *ttl* seconds after the last write.
+    """
+
+    PREFIX = "job:"
+
+    def __init__(self, redis: Redis, config: JobsConfig) -> None:
+        self.redis = redis
+        self.config = config
+
+    def key(self, id: UUID) -> str:
+        return f"{self.PREFIX}{id}"
+
+    def log_key(self, id: UUID) -> str:
+        return f"{self.PREFIX}{id}:log"
+
+    async def create(self, user_id: int, names: Iterable[str]) -> Job:
+        job = Job(user_id=user_id, items=[JobItem(name) for name in names])
+        await self.write(job)
+        return job
+
+    async def write(self, job: Job) -> None:
+        """Writes the state of *job* and the lines of its log appended since
+        the last write, then the end of the log once it's closed."""
+        lines = list(job.log.pending)
+        closed = job.log.closed
+        first = job.log.end - len(lines)
+        key = self.key(job.id)
+        log_key = self.log_key(job.id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for number, line in enumerate(lines, first):
+                pipe.xadd(log_key, {"line": line},
+                          id=f"{number}-1",
+                          maxlen=self.config.max_lines,
+                          approximate=False)
+            pipe.hset(key,
+                      mapping={
+                          "user_id":
+                              job.user_id,
+                          "items":
+                              orjson.dumps(
+                                  [item.record() for item in job.items]),
+                      })
+            if closed:
+                # after the state, a reader of the end gets the final one
+                pipe.xadd(log_key, {"end": job.status}, id=f"{job.log.end}-1")
+            pipe.expire(key, self.config.ttl)
+            pipe.expire(log_key, self.config.ttl)
+            await pipe.execute()
+        del job.log.pending[:len(lines)]
+
+    @asynccontextmanager
+    async def running(self, job: Job) -> AsyncIterator[None]:
+        """Writes *job* out while the block runs it, and closes its log at
+        the end."""
+        writer = asyncio.create_task(self.writer(job))
+        try:
+            yield
+        finally:
+            job.log.close()
+            await writer
+
+    async def writer(self, job: Job) -> None:
+        from redis.exceptions import RedisError
+
+        while True:
+            job.log.changed.clear()
+            closed = job.log.closed
+            try:
+                await self.write(job)
+            except RedisError as e:
+                # the next write takes the lines along, as many as the log
+                # keeps anyway
+                logger.warning("failed to write job %s: %r", job.id, e)
+                del job.log.pending[:-self.config.max_lines]
+            if closed:
+                return
+            try:
+                await asyncio.wait_for(job.log.changed.wait(),
+                                       self.config.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def get(self, id: UUID) -> Optional[JobState]:
+        raw = await self.redis.hgetall(self.key(id))
+        if not raw:
+            return None
+        fields = {
+            (k.decode() if isinstance(k, bytes) else k): v
+            for k, v in raw.items()
+        }
+        return JobState(user_id=int(fields["user_id"]),
+                        items=orjson.loads(fields["items"]))
+
+    async def exists(self, id: UUID) -> bool:
+        return bool(await self.redis.exists(self.key(id)))
+
+    async def read_log(
+            self,
+            id: UUID,
+            offset: int,
+            limit: int = 1000) -> tuple[int, list[str], Optional[JobStatus]]:
+        """(number of the first line, lines, status of the job once the log
+        ended) from line *offset* on, or from the oldest one kept when it
+        was dropped already."""
+        entries = await self.redis.xrange(self.log_key(id),
+                                          min=f"{offset}-1",
+                                          count=limit)
+        start = offset
+        lines: list[str] = []
+        for entry_id, values in entries:
+            if isinstance(entry_id, bytes):
+                entry_id = entry_id.decode()
+            fields = {
+                (k.decode() if isinstance(k, bytes) else k):
+                    (v.decode() if isinstance(v, bytes) else v)
+                for k, v in values.items()
+            }
+            if not lines:
+                start = int(entry_id.split("-")[0])
+            if "end" in fields:
+                return start, lines, fields["end"]
+            lines.append(fields["line"])
+        return start, lines, None
+
+    async def wait(self, id: UUID, offset: int, timeout: float) -> bool:
+        """Waits up to *timeout* seconds for line *offset* or the end of the
+        log, False when neither came."""
+        last = f"{offset - 1}-1" if offset else "0-0"
+        found = await self.redis.xread({self.log_key(id): last},
+                                       count=1,
+                                       block=max(int(timeout * 1000), 1))
+        return bool(found)
@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+from dataclasses import asdict
+from dataclasses import dataclass
+import json
+import logging
+import time
+from typing import Optional, TYPE_CHECKING
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Instance
+from app.service.virt import VirtPool
+from app.settings import Config
+from app.settings import parse_size
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+RESOURCES = ("vcpu", "ram", "disk")
+
+# admissions whose domain no reconcile run has seen defined yet, by UUID
+PENDING_KEY = "ledger:pending"
+
+# KEYS: host usage hash, user usage hash, pending admissions hash
+# ARGV: vcpu, ram and disk deltas followed by the host and the user limits for
+# the same resources, -1 meaning unlimited, then the UUID of the instance and
+# its pending record: set along with an admission, removed by a release when
+# empty. Only growing resources are checked, so releases always go through.
+ADJUST_SCRIPT = """
+local fields = {"vcpu", "ram", "disk"}
+for i, field in ipairs(fields) do
+  local delta = tonumber(ARGV[i])
+  if delta > 0 then
+    for k = 1, 2 do
+      local limit = tonumber(ARGV[k * 3 + i])
+      if limit >= 0 then
+        local used = tonumber(redis.call("HGET", KEYS[k], field) or "0")
+        if used + delta > limit then
+          return {k, field}
+        end
+      end
+    end
+  end
+end
+for i, field in ipairs(fields) do
+  local delta = tonumber(ARGV[i])
+  if delta ~= 0 then
+    redis.call("HINCRBY", KEYS[1], field, delta)
+    redis.call("HINCRBY", KEYS[2], field, delta)
+  end
+end
+if ARGV[10] ~= "" then
+  if ARGV[11] ~= "" then
+    redis.call("HSET", KEYS[3], ARGV[10], ARGV[11])
+  else
+    redis.call("HDEL", KEYS[3], ARGV[10])
+  end
+end
+return 0
+"""
+
+# KEYS: pending admissions hash
+# ARGV: JSON of the rebuilt counters ({key: {vcpu, ram, disk}} for hosts and
+# users), of the UUIDs of the domains found (true when their row names the
+# owner), of the counter keys to clear and the epoch before which pending
+# admissions never defined are dropped.
+# Admissions still pending are added to the totals, so those still copying
+# their disk or made since the scan aren't lost, and found domains without
+# a row are charged to the user of their admission. Runs as one script, no
+# admission or release goes between the read and the write.
+RECONCILE_SCRIPT = """
+local fields = {"vcpu", "ram", "disk"}
+local state = cjson.decode(ARGV[1])
+local function add(totals, key, record)
+  local t = totals[key]
+  if t == nil then
+    t = {vcpu = 0, ram = 0, disk = 0}
+    totals[key] = t
+  end
+  for _, field in ipairs(fields) do
+    t[field] = t[field] + record[field]
+  end
+end
+local pending = redis.call("HGETALL", KEYS[1])
+for i = 1, #pending, 2 do
+  local id = pending[i]
+  local record = cjson.decode(pending[i + 1])
+  local owned = state.found[id]
+  if owned ~= nil then
+    if not owned then
+      add(state.users, record.user, record)
+    end
+    redis.call("HDEL", KEYS[1], id)
+  elseif record.at < state.expired then
+    redis.call("HDEL", KEYS[1], id)
+  else
+    add(state.hosts, record.host, record)
+    add(state.users, record.user, record)
+  end
+end
+for _, key in ipairs(state.stale) do
+  redis.call("DEL", key)
+end
+for _, totals in ipairs({state.hosts, state.users}) do
+  for key, t in pairs(totals) do
+    -- tostring would round counters past 14 digits
+    redis.call("HSET", key, "vcpu", string.format("%d", t.vcpu),
+               "ram", string.format("%d", t.ram),
+               "disk", string.format("%d", t.disk))
+  end
+end
+return 0
+"""
+
+# vcpu, ram (KiB) and disk (bytes) limits
+Limits = tuple[int, int, int]
+
+UNLIMITED: Limits = (-1, -1, -1)
+
+
+class QuotaExceeded(Exception):
+
+    def __init__(self, scope: str, resource: str) -> None:
+        super().__init__(f"{scope} {resource} quota exceeded")
+        self.scope = scope
+        self.resource = resource
+
+
+@dataclass(frozen=True)
+class Allocation:
+    vcpu: int
+    # KiB
+    ram: int
+    # bytes
+    disk: int
+
+    def __neg__(self) -> Allocation:
+        return Allocation(-self.vcpu, -self.ram, -self.disk)
+
+
+class Ledger:
+    """Per-host and per-user vCPU, RAM and disk counters kept in Redis.
+
+    Admission checks and updates run as a single Lua script, so they are
+    atomic across API workers and cost one round trip regardless of the
+    number of instances. `reconcile` rebuilds the counters from the
+    hypervisors to correct any drift, adding the admissions whose domain it
+    hasn't seen defined yet; those are kept in Redis too, for at most
+    *pending_ttl* seconds.
+    """
+
+    def __init__(self,
+                 redis: Redis,
+                 host_limits: dict[str, Limits],
+                 user_limits: Limits,
+                 pending_ttl: int = 3600) -> None:
+        self.redis = redis
+        self.host_limits = host_limits
+        self.user_limits = user_limits
+        self.pending_ttl = pending_ttl
+        self.script = redis.register_script(ADJUST_SCRIPT)
+        self.reconcile_script = redis.register_script(RECONCILE_SCRIPT)
+
+    @classmethod
+    def from_config(cls, redis: Redis, config: Config) -> Ledger:
+
+        def limit(size: Optional[str], shift: int = 0) -> int:
+            return -1 if size is None else parse_size(size) >> shift
+
+        host_limits = {
+            host.name: (
+                host.maxvcpus or config.maxvcpus,
+                limit(host.maxram or config.maxram, 10),
+                limit(host.maxdisk or config.maxdisk),
+            ) for host in config.hosts
+        }
+        user_limits = (
+            config.quota.vcpu if config.quota.vcpu is not None else -1,
+            limit(config.quota.ram, 10),
+            limit(config.quota.disk),
+        )
+        # as long as the reconciler leaves a disk without domain alone
+        return cls(redis, host_limits, user_limits, config.reconcile.disk_grace)
+
+    @staticmethod
+    def host_key(host: str) -> str:
+        return f"ledger:host:{host}"
+
+    @staticmethod
+    def user_key(user_id: int) -> str:
+        return f"ledger:user:{user_id}"
+
+    async def adjust(self,
+                     host: str,
+                     user_id: int,
+                     delta: Allocation,
+                     check: bool = True,
+                     unlimited_user: bool = False,
+                     id: Optional[UUID] = None,
+                     pending: str = "") -> None:
+        host_limits = self.host_limits[host] if check else UNLIMITED
+        user_limits = (self.user_limits
+                       if check and not unlimited_user else UNLIMITED)
+        res = await self.script(
+            keys=[self.host_key(host),
+                  self.user_key(user_id), PENDING_KEY],
+            args=[
+                delta.vcpu, delta.ram, delta.disk, *host_limits, *user_limits,
+                "" if id is None else str(id), pending
+            ],
+        )
+        if res != 0:
+            scope, resource = res
+            if isinstance(resource, bytes):
+                resource = resource.decode()
+            raise QuotaExceeded("host" if scope == 1 else "user", resource)
+
+    async def admit(self,
+                    host: str,
+                    user_id: int,
+                    id: UUID,
+                    allocation: Allocation,
+                    unlimited_user: bool = False) -> None:
+        """Charges the instance *id* about to be defined, pending until a
+        reconcile run finds its domain."""
+        pending = json.dumps({
+            "host": self.host_key(host),
+            "user": self.user_key(user_id),
+            "at": int(time.time()),
+            **asdict(allocation),
+        })
+        await self.adjust(host,
+                          user_id,
+                          allocation,
+                          unlimited_user=unlimited_user,
+                          id=id,
+                          pending=pending)
+
+    async def release(self, host: str, user_id: int, id: UUID,
+                      allocation: Allocation) -> None:
+        await self.adjust(host, user_id, -allocation, check=False, id=id)
+
+    async def reconcile(
+            self, pool: VirtPool,
+            session_maker: async_sessionmaker[AsyncSession]) -> None:
+        async with session_maker() as session:
+            owners = {
+                id: user_id for id, user_id in await session.execute(
+                    select(Instance.id, Instance.user_id))
+            }
+
+        hosts: dict[str, dict[str, int]] = {}
+        users: dict[str, dict[str, int]] = {}
+        found: dict[str, bool] = {}
+        for host in pool.hosts:
+            virt = await pool.connect(host)
+            allocations = await virt.call("list", virt.allocations)
+            totals = hosts.setdefault(self.host_key(host),
+                                      dict.fromkeys(RESOURCES, 0))
+            for id, vcpu, ram, disk in allocations:
+                totals["vcpu"] += vcpu
+                totals["ram"] += ram
+                totals["disk"] += disk
+                user_id = owners.get(id)
+                found[str(id)] = user_id is not None
+                if user_id is None:
+                    continue
+                user = users.setdefault(self.user_key(user_id),
+                                        dict.fromkeys(RESOURCES, 0))
+                user["vcpu"] += vcpu
+                user["ram"] += ram
+                user["disk"] += disk
+
+        stale = [
+            key.decode() if isinstance(key, bytes) else
+            key for pattern in ("ledger:host:*", "ledger:user:*")
+            async for key in self.redis.scan_iter(pattern)
+        ]
+        state = {
+            "hosts": hosts,
+            "users": users,
+            "found": found,
+            "stale": stale,
+            "expired": int(time.time()) - self.pending_ttl,
+        }
+        await self.reconcile_script(keys=[PENDING_KEY],
+                                    args=[json.dumps(state)])
+        logger.info("ledger rebuilt for %d hosts and %d users", len(hosts),
+                    len(users))
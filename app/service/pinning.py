@@ -0,0 +1,530 @@
+"""Host CPUs of "dedicated" instances.
+
+A host's NUMA cells, the CPUs of each core and their memory and hugepages
+come from its capabilities XML. The CPUs listed in the host's
+`dedicated_cpus` are handed out to dedicated instances a whole core at a
+time, from as few cells as possible, and each vCPU is pinned to one of
+them. The guest gets a NUMA cell per host cell used, its memory bound to
+that cell and optionally backed by hugepages. Every other instance floats
+on the remaining, shared, CPUs.
+
+The allocation map is kept in memory: CPUs pinned by the domains of a
+host are read back from their definitions, allocations not defined yet are
+held on top until their domain is. Those are shared in Redis, so API
+workers don't hand out the same cores: a worker allocates against the
+allocations of every worker and claims its own only if none was made in
+the meantime.
+"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import logging
+import math
+import time
+from typing import Any, Iterable, Optional, TYPE_CHECKING
+from uuid import UUID
+from xml.etree import ElementTree as ET
+
+import orjson
+
+from app.service.domain import format_cpuset
+from app.service.domain import parse_cpuset
+from app.service.domain import Topology
+from app.service.virt import VirtPool
+from app.settings import Config
+
+if TYPE_CHECKING:
+    import libvirt
+    from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+# normal pages, hugepages are the larger ones
+PAGE_SIZE = 4
+
+# times an allocation is made again when another worker claimed first
+CLAIM_ATTEMPTS = 5
+
+# KEYS: allocations of a host not defined yet, their version
+# ARGV: version the allocation was made against, instance UUID, record
+CLAIM_SCRIPT = """
+if tonumber(redis.call("GET", KEYS[2]) or "0") ~= tonumber(ARGV[1]) then
+  return 0
+end
+redis.call("HSET", KEYS[1], ARGV[2], ARGV[3])
+redis.call("INCR", KEYS[2])
+return 1
+"""
+
+
+class NoCores(Exception):
+    pass
+
+
+@dataclass
+class HostCell:
+    id: int
+    # KiB
+    memory: int
+    # CPUs of every core, thread siblings together
+    cores: list[tuple[int, ...]]
+    # page size (KiB) -> number of pages set aside
+    pages: dict[int, int]
+
+
+@dataclass
+class HostTopology:
+    cells: list[HostCell]
+
+    @property
+    def cpus(self) -> set[int]:
+        return {
+            cpu for cell in self.cells for core in cell.cores for cpu in core
+        }
+
+    @classmethod
+    def parse(cls, xml: str) -> HostTopology:
+        """From the capabilities XML of a host (virConnect.getCapabilities),
+        no cells when it doesn't report its topology."""
+        cells = []
+        for elem in ET.fromstring(xml).iterfind("host/topology/cells/cell"):
+            memory = elem.find("memory")
+            pages = {
+                int(page.get("size", PAGE_SIZE)): int(page.text or 0)
+                for page in elem.iterfind("pages")
+            }
+            cores: dict[tuple[int, ...], None] = {}
+            for cpu in elem.iterfind("cpus/cpu"):
+                siblings = cpu.get("siblings") or cpu.get("id", "")
+                cores[tuple(sorted(parse_cpuset(siblings)))] = None
+            cells.append(
+                HostCell(
+                    id=int(elem.get("id", 0)),
+                    memory=int(memory.text or 0) if memory is not None else 0,
+                    cores=list(cores),
+                    pages=pages,
+                ))
+        return cls(cells)
+
+
+@dataclass(frozen=True)
+class GuestCell:
+    # host NUMA cell
+    node: int
+    # host CPU of each of its vCPUs
+    cpus: tuple[int, ...]
+    # KiB
+    memory: int
+
+
+@dataclass(frozen=True)
+class Pinning:
+    cells: tuple[GuestCell, ...]
+    # every CPU held, those of the vCPUs and the idle siblings of their cores
+    held: frozenset[int]
+    # thread siblings per core of the host
+    threads: int = 1
+    # KiB, None for normal pages
+    page_size: Optional[int] = None
+
+    @property
+    def vcpus(self) -> list[int]:
+        return [cpu for cell in self.cells for cpu in cell.cpus]
+
+    @property
+    def memory(self) -> int:
+        return sum(cell.memory for cell in self.cells)
+
+    def topology(self) -> Optional[Topology]:
+        """A socket per guest cell and the host's threads per core, when
+        the vCPUs split evenly."""
+        counts = {len(cell.cpus) for cell in self.cells}
+        if len(counts) != 1:
+            return None
+        per_cell = counts.pop()
+        threads = self.threads if per_cell % self.threads == 0 else 1
+        return Topology(len(self.cells), per_cell // threads, threads)
+
+    @classmethod
+    def from_record(cls, record: dict[str, Any]) -> Pinning:
+        """From its JSON form, as shared in Redis."""
+        return cls(
+            tuple(
+                GuestCell(cell["node"], tuple(cell["cpus"]), cell["memory"])
+                for cell in record["cells"]),
+            frozenset(record["held"]),
+            record["threads"],
+            record["page_size"],
+        )
+
+
+@dataclass
+class PinnedDomain:
+    """What a defined domain holds of its host, read from its XML."""
+    cpus: set[int]
+    # host cell -> KiB
+    memory: dict[int, int]
+    page_size: Optional[int]
+    id: Optional[UUID] = None
+
+    @classmethod
+    def parse(cls, xml: str) -> PinnedDomain:
+        root = ET.fromstring(xml)
+        cpus = set()
+        for pin in root.iterfind("cputune/vcpupin"):
+            pinned = parse_cpuset(pin.get("cpuset", ""))
+            # shared instances are pinned to a set, dedicated ones to a CPU
+            if len(pinned) == 1:
+                cpus |= pinned
+        nodes = {
+            int(memnode.get("cellid", 0)):
+                parse_cpuset(memnode.get("nodeset", ""))
+            for memnode in root.iterfind("numatune/memnode")
+        }
+        memory: dict[int, int] = {}
+        for cell in root.iterfind("cpu/numa/cell"):
+            node = nodes.get(int(cell.get("id", 0)))
+            if node is not None and len(node) == 1:
+                host = next(iter(node))
+                memory[host] = memory.get(host, 0) + int(cell.get("memory", 0))
+        page = root.find("memoryBacking/hugepages/page")
+        page_size = int(page.get("size", 0)) if page is not None else None
+        uuid = root.findtext("uuid")
+        return cls(cpus, memory, page_size, UUID(uuid) if uuid else None)
+
+
+class CoreMap:
+    """CPUs and cell memory of a host taken by dedicated instances."""
+
+    def __init__(self, topology: HostTopology, dedicated: set[int]) -> None:
+        self.topology = topology
+        self.dedicated = dedicated
+        self.cells = {cell.id: cell for cell in topology.cells}
+        self.cores = {
+            cpu: core
+            for cell in topology.cells for core in cell.cores for cpu in core
+        }
+        self.threads = min(
+            (len(core) for cell in topology.cells for core in cell.cores),
+            default=1)
+        # of the defined domains, read back from the host
+        self.used: set[int] = set()
+        self.used_memory: dict[int, int] = {}
+        self.used_pages: dict[tuple[int, int], int] = {}
+        # allocated, domain not defined yet, by any API worker
+        self.pending: dict[UUID, Pinning] = {}
+        # domains read back, and those defined since, whose allocations
+        # other workers may still share
+        self.defined: set[UUID] = set()
+
+    @property
+    def shared(self) -> set[int]:
+        return self.topology.cpus - self.dedicated
+
+    def load(self, domains: Iterable[PinnedDomain]) -> None:
+        self.used = set()
+        self.used_memory = {}
+        self.used_pages = {}
+        self.defined = set()
+        for domain in domains:
+            if domain.id is not None:
+                self.defined.add(domain.id)
+            for cpu in domain.cpus & self.dedicated:
+                # with the idle siblings of its core
+                self.used.update(self.cores.get(cpu, (cpu,)))
+            for node, memory in domain.memory.items():
+                self.take_memory(node, memory, domain.page_size)
+
+    def take_memory(self, node: int, memory: int,
+                    page_size: Optional[int]) -> None:
+        self.used_memory[node] = self.used_memory.get(node, 0) + memory
+        if page_size is not None:
+            key = (node, page_size)
+            self.used_pages[key] = self.used_pages.get(key,
+                                                       0) + memory // page_size
+
+    def held(self) -> set[int]:
+        held = set(self.used)
+        for pinning in self.pending.values():
+            held |= pinning.held
+        return held
+
+    def free_cores(self, held: set[int]) -> dict[int, list[tuple[int, ...]]]:
+        return {
+            cell.id: [
+                core
+                for core in cell.cores
+                if self.dedicated.issuperset(core) and held.isdisjoint(core)
+            ] for cell in self.topology.cells
+        }
+
+    def free_memory(self, node: int, page_size: Optional[int]) -> int:
+        pending = [(guest, pinning.page_size)
+                   for pinning in self.pending.values()
+                   for guest in pinning.cells
+                   if guest.node == node]
+        if page_size is None:
+            # only counts what dedicated instances bound to the cell, shared
+            # ones take their memory anywhere
+            used = self.used_memory.get(node, 0) + sum(
+                guest.memory for guest, _ in pending)
+            return self.cells[node].memory - used
+        pages = (self.cells[node].pages.get(page_size, 0) - self.used_pages.get(
+            (node, page_size), 0) - sum(guest.memory // page_size
+                                        for guest, size in pending
+                                        if size == page_size))
+        return pages * page_size
+
+    def page_sizes(self, ram: int) -> list[int]:
+        """Hugepage sizes *ram* can be backed by, the largest first."""
+        sizes = {
+            size for cell in self.topology.cells
+            for size, count in cell.pages.items()
+            if size > PAGE_SIZE and count > 0 and ram % size == 0
+        }
+        return sorted(sizes, reverse=True)
+
+    def allocate(self,
+                 id: UUID,
+                 vcpu: int,
+                 ram: int,
+                 hugepages: bool = False) -> Pinning:
+        """Pins *vcpu* vCPUs and binds *ram* KiB, held until commit or
+        release."""
+        sizes: list[Optional[int]] = [None]
+        if hugepages:
+            sizes = list(self.page_sizes(ram))
+            if not sizes:
+                raise NoCores(f"no hugepages can back {ram} KiB")
+        for page_size in sizes:
+            pinning = self.place(vcpu, ram, page_size)
+            if pinning is not None:
+                self.pending[id] = pinning
+                return pinning
+        raise NoCores(f"no dedicated cores left for {vcpu} vcpus and "
+                      f"{ram} KiB")
+
+    def place(self, vcpu: int, ram: int,
+              page_size: Optional[int]) -> Optional[Pinning]:
+        free = self.free_cores(self.held())
+        need = math.ceil(vcpu / self.threads)
+        unit = page_size or 1
+        # the fullest cell that fits it whole, so the emptier ones are left
+        # for larger instances
+        fits = [
+            node for node, cores in free.items()
+            if len(cores) >= need and self.free_memory(node, page_size) >= ram
+        ]
+        if fits:
+            node = min(fits, key=lambda node: len(free[node]))
+            return self.pinning([(node, free[node][:need], vcpu, ram)],
+                                page_size)
+
+        # spread over the cells with the most free cores, memory follows
+        # the vCPUs
+        taken: list[tuple[int, list[tuple[int, ...]]]] = []
+        left = need
+        for node in sorted(free, key=lambda node: -len(free[node])):
+            if left == 0:
+                break
+            if not free[node]:
+                continue
+            cores = free[node][:left]
+            taken.append((node, cores))
+            left -= len(cores)
+        if left > 0:
+            return None
+        cells = []
+        vcpus_left, ram_left = vcpu, ram
+        for i, (node, cores) in enumerate(taken):
+            count = min(vcpus_left, len(cores) * self.threads)
+            if i == len(taken) - 1:
+                memory = ram_left
+            else:
+                memory = ram * count // vcpu // unit * unit
+            if memory <= 0 or self.free_memory(node, page_size) < memory:
+                return None
+            cells.append((node, cores, count, memory))
+            vcpus_left -= count
+            ram_left -= memory
+        return self.pinning(cells, page_size)
+
+    def pinning(self, cells: list[tuple[int, list[tuple[int, ...]], int, int]],
+                page_size: Optional[int]) -> Pinning:
+        guests = []
+        held: set[int] = set()
+        for node, cores, count, memory in cells:
+            threads = [cpu for core in cores for cpu in core]
+            held.update(threads)
+            guests.append(GuestCell(node, tuple(threads[:count]), memory))
+        return Pinning(tuple(guests), frozenset(held), self.threads, page_size)
+
+    def release(self, id: UUID) -> None:
+        self.pending.pop(id, None)
+
+    def commit(self, id: UUID) -> None:
+        # defined now, held as used until the next load reads it back
+        pinning = self.pending.pop(id, None)
+        if pinning is None:
+            return
+        self.defined.add(id)
+        self.used |= pinning.held
+        for guest in pinning.cells:
+            self.take_memory(guest.node, guest.memory, pinning.page_size)
+
+
+def host_state(conn: libvirt.virConnect) -> tuple[str, list[str]]:
+    return conn.getCapabilities(), [
+        domain.XMLDesc(0) for domain in conn.listAllDomains()
+    ]
+
+
+class CpuPlacement:
+    """Core maps of the hosts with `dedicated_cpus`, loaded on first use
+    and read back from the host when older than *max_age* seconds.
+
+    Allocations not defined yet are shared in Redis, per host, along with a
+    version bumped by every claim. They expire after *pending_ttl* seconds
+    when their worker never got to commit or release them, and *max_age*
+    after being committed, every worker has read their domain back by
+    then.
+    """
+
+    def __init__(self,
+                 pool: VirtPool,
+                 config: Config,
+                 max_age: float,
+                 redis: Redis,
+                 pending_ttl: int = 3600) -> None:
+        self.pool = pool
+        self.max_age = max_age
+        self.redis = redis
+        self.pending_ttl = pending_ttl
+        self.script = redis.register_script(CLAIM_SCRIPT)
+        self.dedicated = {
+            host.name: parse_cpuset(host.dedicated_cpus)
+            for host in config.hosts
+            if host.dedicated_cpus
+        }
+        self.maps: dict[str, CoreMap] = {}
+        self.loaded: dict[str, float] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+
+    @property
+    def hosts(self) -> list[str]:
+        """Those dedicated instances can go to."""
+        return list(self.dedicated)
+
+    async def map(self, host: str) -> Optional[CoreMap]:
+        if host not in self.dedicated:
+            return None
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            core_map = self.maps.get(host)
+            if (core_map is not None and
+                    time.monotonic() - self.loaded.get(host, -math.inf)
+                    < self.max_age):
+                return core_map
+            virt = await self.pool.connect(host)
+            capabilities, domains = await virt.read("list", host_state)
+            if core_map is None:
+                topology = HostTopology.parse(capabilities)
+                dedicated = self.dedicated[host] & topology.cpus
+                if dedicated != self.dedicated[host]:
+                    logger.warning(
+                        "dedicated CPUs %s of %s aren't all on the host",
+                        format_cpuset(self.dedicated[host]), host)
+                core_map = self.maps[host] = CoreMap(topology, dedicated)
+            core_map.load(PinnedDomain.parse(xml) for xml in domains)
+            self.loaded[host] = time.monotonic()
+            return core_map
+
+    @staticmethod
+    def pending_key(host: str) -> str:
+        return f"pinning:{host}"
+
+    @staticmethod
+    def version_key(host: str) -> str:
+        return f"pinning:{host}:version"
+
+    async def sync(self, host: str, core_map: CoreMap) -> int:
+        """Takes the allocations of every worker as pending, returns the
+        version they are at."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(self.version_key(host))
+            pipe.hgetall(self.pending_key(host))
+            version, records = await pipe.execute()
+        now = time.time()
+        pending: dict[UUID, Pinning] = {}
+        expired = []
+        for field, raw in records.items():
+            record = orjson.loads(raw)
+            if record["expires"] < now:
+                expired.append(field)
+                continue
+            id = UUID(field.decode() if isinstance(field, bytes) else field)
+            if id not in core_map.defined:
+                pending[id] = Pinning.from_record(record["pinning"])
+        if expired:
+            # gone from every worker's count already, no new version
+            await self.redis.hdel(self.pending_key(host), *expired)
+        core_map.pending = pending
+        return int(version or 0)
+
+    def record(self, pinning: Pinning, ttl: float) -> bytes:
+        record = {"pinning": pinning, "expires": time.time() + ttl}
+        # held is a frozenset, stored as a list
+        return orjson.dumps(record, default=sorted)
+
+    async def allocate(self, host: str, id: UUID, vcpu: int, ram: int,
+                       hugepages: bool) -> Pinning:
+        core_map = await self.map(host)
+        if core_map is None:
+            raise NoCores(f"{host} has no dedicated CPUs")
+        async with self.locks[host]:
+            for _ in range(CLAIM_ATTEMPTS):
+                version = await self.sync(host, core_map)
+                pinning = core_map.allocate(id, vcpu, ram, hugepages)
+                claimed = await self.script(
+                    keys=[self.pending_key(host),
+                          self.version_key(host)],
+                    args=[
+                        version,
+                        str(id),
+                        self.record(pinning, self.pending_ttl)
+                    ])
+                if claimed:
+                    return pinning
+                # another worker claimed since the sync, allocated again
+                # against its allocation too
+                core_map.release(id)
+        raise NoCores(f"dedicated cores of {host} kept being claimed by "
+                      "other workers")
+
+    async def shared(self, host: str) -> Optional[str]:
+        """cpuset the other instances of *host* float on, None when every
+        CPU is shared."""
+        core_map = await self.map(host)
+        if core_map is None:
+            return None
+        return format_cpuset(core_map.shared)
+
+    async def release(self, host: str, id: UUID) -> None:
+        if host in self.maps:
+            self.maps[host].release(id)
+        await self.redis.hdel(self.pending_key(host), str(id))
+
+    async def commit(self, host: str, id: UUID) -> None:
+        if host not in self.maps:
+            return
+        pinning = self.maps[host].pending.get(id)
+        self.maps[host].commit(id)
+        if pinning is not None:
+            # counted until every worker has read the domain back
+            await self.redis.hset(self.pending_key(host), str(id),
+                                  self.record(pinning, self.max_age))
+
+    def forget(self, host: str) -> None:
+        # a domain went away, read the host back on next use
+        self.loaded.pop(host, None)
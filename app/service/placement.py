@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import logging
+import time
+from typing import Iterable, Literal, Optional
+
+from app.service.inventory import InventoryReader
+from app.service.virt import VirtPool
+from app.settings import Config
+from app.settings import parse_size
+
+logger = logging.getLogger(__name__)
+
+RAM_UNITS = {
+    "KiB": 1,
+    "MiB": 1 << 10,
+    "GiB": 1 << 20,
+}
+
+
+def to_kib(ram: int, unit: str) -> int:
+    return ram * RAM_UNITS[unit]
+
+
+async def host_usage(pool: VirtPool, host: str) -> tuple[int, int]:
+    virt = await pool.connect(host)
+    return await virt.call("list", virt.usage)
+
+
+class NoCapacity(Exception):
+    pass
+
+
+@dataclass
+class HostCapacity:
+    name: str
+    max_vcpus: int
+    # KiB, same unit libvirt reports domain memory in
+    max_ram: int
+    used_vcpus: int = 0
+    used_ram: int = 0
+    # reserved by placements whose domain isn't defined yet
+    pending_vcpus: int = 0
+    pending_ram: int = 0
+    available: bool = False
+    updated: float = 0.0
+
+    @property
+    def free_vcpus(self) -> int:
+        return self.max_vcpus - self.used_vcpus - self.pending_vcpus
+
+    @property
+    def free_ram(self) -> int:
+        return self.max_ram - self.used_ram - self.pending_ram
+
+    def fits(self, vcpu: int, ram: int) -> bool:
+        return self.available and vcpu <= self.free_vcpus and ram <= self.free_ram
+
+    def load_after(self, vcpu: int, ram: int) -> float:
+        return ((self.used_vcpus + self.pending_vcpus + vcpu) / self.max_vcpus +
+                (self.used_ram + self.pending_ram + ram) / self.max_ram)
+
+
+@dataclass(frozen=True)
+class Reservation:
+    host: str
+    vcpu: int
+    ram: int
+
+
+class Scheduler:
+    """Chooses a hypervisor for new instances from an in-memory capacity
+    index. The index is refreshed in the background from host stats, so
+    placing an instance never talks to the hypervisors."""
+
+    def __init__(self, hosts: Iterable[HostCapacity],
+                 strategy: Literal["pack", "spread"]) -> None:
+        self.hosts = {host.name: host for host in hosts}
+        self.strategy = strategy
+
+    @classmethod
+    def from_config(cls, config: Config) -> Scheduler:
+        return cls([
+            HostCapacity(
+                name=host.name,
+                max_vcpus=host.maxvcpus or config.maxvcpus,
+                max_ram=parse_size(host.maxram or config.maxram) >> 10,
+            ) for host in config.hosts
+        ], config.placement)
+
+    def place(self,
+              vcpu: int,
+              ram: int,
+              hosts: Optional[Iterable[str]] = None) -> Reservation:
+        """Reserves *vcpu* and *ram* on the best host, or the best of
+        *hosts*."""
+        allowed = set(hosts) if hosts is not None else self.hosts
+        candidates = [
+            host for host in self.hosts.values()
+            if host.name in allowed and host.fits(vcpu, ram)
+        ]
+        if not candidates:
+            raise NoCapacity(f"no host can fit {vcpu} vcpu and {ram} KiB")
+
+        if self.strategy == "pack":
+            host = max(candidates, key=lambda h: h.load_after(vcpu, ram))
+        else:
+            host = min(candidates, key=lambda h: h.load_after(vcpu, ram))
+
+        host.pending_vcpus += vcpu
+        host.pending_ram += ram
+        return Reservation(host.name, vcpu, ram)
+
+    def release(self, reservation: Reservation) -> None:
+        host = self.hosts[reservation.host]
+        host.pending_vcpus -= reservation.vcpu
+        host.pending_ram -= reservation.ram
+
+    def commit(self, reservation: Reservation) -> None:
+        # the domain exists now, count it as used until the next refresh
+        # reads it back from the host
+        self.release(reservation)
+        host = self.hosts[reservation.host]
+        host.used_vcpus += reservation.vcpu
+        host.used_ram += reservation.ram
+
+    async def refresh(self,
+                      pool: VirtPool,
+                      inventory: Optional[InventoryReader] = None) -> None:
+        for host in self.hosts.values():
+            listed = inventory.host(host.name) if inventory else None
+            try:
+                if listed is not None:
+                    vcpus, ram = listed.usage()
+                else:
+                    vcpus, ram = await host_usage(pool, host.name)
+            except Exception:
+                logger.exception("failed to refresh capacity of %s", host.name)
+                host.available = False
+                continue
+            host.used_vcpus = vcpus
+            host.used_ram = ram
+            host.available = True
+            host.updated = listed.updated if listed else time.time()
+
+    async def run(self,
+                  pool: VirtPool,
+                  interval: int,
+                  inventory: Optional[InventoryReader] = None) -> None:
+        while True:
+            await self.refresh(pool, inventory)
+            await asyncio.sleep(interval)
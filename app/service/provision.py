@@ -0,0 +1,383 @@
+"""Creating a domain: its disk, its definition, the first boot and the
+guest's configuration by ansible.
+
+Runs in the calling process, on the connections of a VirtPool, so a create
+pays neither for starting an interpreter nor for connecting to the host.
+createvm.py is the command line to it.
+"""
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import os
+import time
+from typing import Callable, Optional, TYPE_CHECKING
+from uuid import UUID
+
+from app.service.clone import clone_file
+from app.service.domain import DomainSpec
+from app.service.domain import load_template
+from app.service.domain import Nic
+from app.service.ipam import add_dhcp_host
+from app.service.ipam import check_dhcp
+from app.service.ipam import remove_dhcp_host
+from app.service.pinning import Pinning
+from app.service.placement import to_kib
+from app.service.qos import get_tier
+from app.service.qos import QosError
+from app.service.timeline import Timeline
+from app.service.virt import Virt
+from app.service.virt import VirtPool
+from app.settings import BaseImage
+from app.settings import Config
+from app.settings import NetworkConfig
+from app.settings import PerformanceProfile
+from app.settings import QosTier
+
+if TYPE_CHECKING:
+    import libvirt
+
+# seconds between two looks at the guest's DHCP lease, or its SSH port
+POLL_INTERVAL = 5.0
+SSH_TIMEOUT = 5.0
+
+# receives every line of output of a run
+Output = Callable[[str], None]
+
+
+class ProvisionError(Exception):
+    pass
+
+
+@dataclass
+class ProvisionRequest:
+    host: str
+    name: str
+    vcpu: int
+    ram: int
+    ram_unit: str
+    # with its unit, as qemu-img takes it, e.g. 20G
+    size: str
+    os: str
+    new_password: str
+    # handed out by IPAM, along with ip when it manages the addresses
+    mac: str
+    hostname: Optional[str] = None
+    # qcow2 overlay of the base image instead of a copy
+    linked: bool = False
+    ip: Optional[str] = None
+    # reserved by the API along with the name
+    uuid: Optional[UUID] = None
+    # host CPUs of a dedicated instance, allocated by the API
+    pinning: Optional[Pinning] = None
+    # host CPUs shared by the other instances
+    cpuset: Optional[str] = None
+    # name of a profile of the config, its default_profile when None
+    performance: Optional[str] = None
+    # QoS tier of the instance, unlimited when None
+    qos: Optional[str] = None
+
+
+def gen_nic(network: NetworkConfig, mac: str) -> Nic:
+    if network.mode == "bridge":
+        return Nic(mac=mac, source=network.interface, type="bridge")
+    return Nic(mac=mac, source="default")
+
+
+def create_xml(template: str,
+               name: str,
+               ram_unit: str,
+               ram: int,
+               vcpu: int,
+               disk: str,
+               nic: Nic,
+               uuid: Optional[UUID] = None,
+               pinning: Optional[Pinning] = None,
+               cpuset: Optional[str] = None,
+               performance: Optional[PerformanceProfile] = None,
+               qos: Optional[QosTier] = None) -> str:
+    spec = DomainSpec(
+        name=name,
+        vcpu=int(vcpu),
+        ram=to_kib(int(ram), ram_unit),
+        disk=disk,
+        nics=[nic],
+        pinning=pinning,
+        cpuset=cpuset,
+        performance=performance,
+        qos=qos,
+    )
+    if uuid is not None:
+        spec.uuid = uuid
+    return load_template(template).render(spec)
+
+
+async def read_lines(stream: asyncio.StreamReader, output: Output) -> None:
+    while True:
+        try:
+            data = await stream.readline()
+        except ValueError:
+            # longer than the stream's limit, the rest of it is dropped
+            data = b"[line too long]\n"
+        if not data:
+            return
+        output(data.decode(errors="replace").rstrip())
+
+
+async def run_command(command: list[str], output: Output) -> None:
+    """Runs *command*, its lines of output go to *output* as they are
+    printed. Killed if the caller is cancelled."""
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT)
+    assert proc.stdout is not None
+    try:
+        await read_lines(proc.stdout, output)
+        returncode = await proc.wait()
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    if returncode != 0:
+        raise ProvisionError(f"{command[0]} exited with status {returncode}")
+
+
+def remove_image(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def create_image(image: BaseImage,
+                       size: str,
+                       name: str,
+                       image_dir: str,
+                       linked: bool = False,
+                       timeline: Optional[Timeline] = None,
+                       output: Output = print) -> None:
+    """Creates the disk of *name*, never over an existing file. Once the
+    target is claimed, a failure removes it again."""
+    timeline = timeline or Timeline()
+    target = f"{image_dir}/{name}"
+    if linked:
+        # qcow2 overlay backed by the (read-only) base image, nothing is copied.
+        # qemu-img overwrites, the target is claimed first so an existing
+        # disk is never clobbered
+        with timeline.stage("image"):
+            with open(target, "xb"):
+                pass
+            try:
+                await run_command([
+                    "qemu-img", "create", "-f", "qcow2", "-F", "qcow2", "-b",
+                    str(image.path), target, size
+                ], output)
+            except BaseException:
+                remove_image(target)
+                raise
+        return
+    # reflink or a sparse copy, a plain copy would write every zero of the
+    # mostly empty base image
+    with timeline.stage("image"):
+        result = await asyncio.to_thread(clone_file, str(image.path), target)
+    output(f"cloned {result.size} bytes by {result.method}, wrote "
+           f"{result.written} in {result.elapsed:.2f}s "
+           f"({result.throughput / (1 << 20):.0f} MiB/s)")
+    with timeline.stage("resize"):
+        try:
+            await run_command(["qemu-img", "resize", target, size], output)
+        except BaseException:
+            remove_image(target)
+            raise
+
+
+def undefine_domain(virt: Virt, id: UUID) -> None:
+    """Stops and undefines the domain *id*, if it is defined."""
+    import libvirt
+
+    try:
+        domain = virt.get_vm_by_id(id)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            return
+        raise
+    if domain.isActive():
+        domain.destroy()
+    domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_MANAGED_SAVE |
+                         libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA |
+                         libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+
+
+async def wait_for_lease(virt: Virt, domain: libvirt.virDomain,
+                         timeout: float) -> str:
+    import libvirt
+
+    end = time.monotonic() + timeout
+    while True:
+        if time.monotonic() >= end:
+            raise ProvisionError(f"no DHCP lease after {timeout:.0f}s")
+        await asyncio.sleep(POLL_INTERVAL)
+        interfaces = await virt.call(
+            "read", domain.interfaceAddresses,
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+        for interface in interfaces.values():
+            if interface["addrs"]:
+                return interface["addrs"][0]["addr"]
+
+
+async def wait_for_ssh(host: str,
+                       timeout: float,
+                       output: Output = print) -> None:
+    """Waits until *host* accepts connections on port 22, for at most
+    *timeout* seconds."""
+    output(f"waiting for ssh on {host}")
+    end = time.monotonic() + timeout
+    while True:
+        left = end - time.monotonic()
+        if left <= 0:
+            raise ProvisionError(f"no ssh on {host} after {timeout:.0f}s")
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, 22), min(SSH_TIMEOUT, left))
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+        writer.close()
+        return
+
+
+def playbook_command(ip: str, default_password: str, new_password: str,
+                     hostname: str) -> list[str]:
+    return [
+        "ansible-playbook",
+        "-vvv",
+        "task/playbook.yml",
+        "-e",
+        f"newhost={ip}",
+        "-e",
+        f"defaultpass={default_password}",
+        "-e",
+        f"newpassword={new_password}",
+        "-e",
+        f"newhostname={hostname}",
+    ]
+
+
+class Provisioner:
+    """Provisions domains on the hosts of *pool*. A create is two steps,
+    create_disk and boot, which callers may run in separate slots, or run
+    for both."""
+
+    def __init__(self, config: Config, pool: VirtPool) -> None:
+        self.config = config
+        self.pool = pool
+
+    def image(self, request: ProvisionRequest) -> BaseImage:
+        image = self.config.images.get(request.os)
+        if image is None:
+            raise ProvisionError(f"Unknown OS {request.os}")
+        return image
+
+    def profile(self, request: ProvisionRequest) -> PerformanceProfile:
+        name = request.performance or self.config.default_profile
+        profile = self.config.profiles.get(name)
+        if profile is None:
+            raise ProvisionError(f"Unknown performance profile {name}")
+        return profile
+
+    def tier(self, request: ProvisionRequest) -> Optional[QosTier]:
+        try:
+            return get_tier(self.config, request.qos)
+        except QosError as e:
+            raise ProvisionError(str(e))
+
+    def render(self, request: ProvisionRequest, timeline: Timeline) -> str:
+        with timeline.stage("render"):
+            return create_xml(
+                template=self.config.get_domain_template(request.host),
+                name=request.name,
+                ram_unit=request.ram_unit,
+                ram=request.ram,
+                vcpu=request.vcpu,
+                disk=f"{self.config.image_dir}/{request.name}",
+                nic=gen_nic(self.config.network, request.mac),
+                uuid=request.uuid,
+                pinning=request.pinning,
+                cpuset=request.cpuset,
+                performance=self.profile(request),
+                qos=self.tier(request),
+            )
+
+    async def create_disk(self,
+                          request: ProvisionRequest,
+                          timeline: Timeline,
+                          output: Output = print) -> None:
+        image = self.image(request)
+        # rendered (and validated) first, a bad definition never leaves a disk
+        self.render(request, timeline)
+        await create_image(image, request.size, request.name,
+                           self.config.image_dir, request.linked, timeline,
+                           output)
+
+    async def boot(self,
+                   request: ProvisionRequest,
+                   timeline: Timeline,
+                   output: Output = print) -> None:
+        """Defines and starts the domain of a disk made by create_disk,
+        then configures the guest."""
+        image = self.image(request)
+        xml = self.render(request, timeline)
+        virt = await self.pool.connect(request.host)
+        with timeline.stage("define"):
+            domain = await virt.call("write", virt.define_vm, xml)
+        if request.ip is not None:
+            # the address was reserved by the API, pin it before the first boot
+            with timeline.stage("dhcp"):
+                await virt.call("read", check_dhcp, virt.conn,
+                                self.config.network.name, request.mac,
+                                request.ip)
+                await virt.call("write", add_dhcp_host, virt.conn,
+                                self.config.network.name, request.mac,
+                                request.ip)
+        with timeline.stage("boot"):
+            await virt.call("write", domain.create)
+
+        ip = request.ip
+        if ip is None:
+            with timeline.stage("lease"):
+                ip = await wait_for_lease(virt, domain,
+                                          self.config.lease_timeout)
+
+        with timeline.stage("ssh"):
+            await wait_for_ssh(ip, self.config.ssh_ready_timeout, output)
+
+        hostname = request.hostname or request.name
+        with timeline.stage("ansible"):
+            await run_command(
+                playbook_command(ip, image.root_password, request.new_password,
+                                 hostname), output)
+
+    async def discard(self, request: ProvisionRequest, disk: bool) -> None:
+        """Undoes a failed create: stops and undefines its domain, removes
+        its DHCP host and, with *disk* (create_disk succeeded), its disk.
+        Raises when any of it fails, what the create holds must then stay
+        held."""
+        if request.uuid is None:
+            # nothing tells its domain from another one of the same name
+            raise ProvisionError(f"{request.name} has no UUID to discard by")
+        virt = await self.pool.connect(request.host)
+        await virt.call("write", undefine_domain, virt, request.uuid)
+        if request.ip is not None:
+            await virt.call("write", remove_dhcp_host, virt.conn,
+                            self.config.network.name, request.mac, request.ip)
+        if disk:
+            await asyncio.to_thread(remove_image,
+                                    f"{self.config.image_dir}/{request.name}")
+
+    async def run(self,
+                  request: ProvisionRequest,
+                  timeline: Timeline,
+                  output: Output = print) -> None:
+        await self.create_disk(request, timeline, output)
+        await self.boot(request, timeline, output)
@@ -0,0 +1,113 @@
+"""QoS tiers: disk I/O and NIC bandwidth limits of instances, so a guest
+saturating the host's disk or uplink doesn't starve its neighbours.
+
+Rendered into the definition at create time (<iotune> of the disks,
+<bandwidth> of the NICs) and changed on defined domains through
+setBlockIoTune and setInterfaceParameters, live when they run.
+"""
+from __future__ import annotations
+
+from typing import Optional, TYPE_CHECKING
+from xml.etree import ElementTree as ET
+
+from app.service.snapshots import disk_targets
+from app.settings import Config
+from app.settings import QosTier
+
+if TYPE_CHECKING:
+    import libvirt
+
+MIB = 1 << 20
+
+
+class QosError(Exception):
+    pass
+
+
+def tier_name(config: Config, instance: Optional[str],
+              owner: Optional[str]) -> Optional[str]:
+    """Tier of an instance: its own, else its owner's, else the default."""
+    return instance or owner or config.default_qos
+
+
+def get_tier(config: Config, name: Optional[str]) -> Optional[QosTier]:
+    if name is None:
+        return None
+    tier = config.qos.get(name)
+    if tier is None:
+        raise QosError(f"Unknown QoS tier {name}")
+    return tier
+
+
+def kib_per_sec(mbit: int) -> int:
+    return mbit * 1000 * 1000 // 8 // 1024
+
+
+def iotune_params(tier: Optional[QosTier]) -> dict[str, int]:
+    """setBlockIoTune parameters, 0 lifts a limit."""
+    tier = tier or QosTier()
+    return {
+        "total_bytes_sec": (tier.disk_bandwidth or 0) * MIB,
+        "total_iops_sec": tier.disk_iops or 0,
+        "total_bytes_sec_max": (tier.disk_bandwidth_burst or 0) * MIB,
+        "total_iops_sec_max": tier.disk_iops_burst or 0,
+    }
+
+
+def bandwidth_params(tier: Optional[QosTier]) -> dict[str, int]:
+    """setInterfaceParameters parameters, an average of 0 lifts the limit
+    of a direction."""
+    tier = tier or QosTier()
+    params = {}
+    for direction in ("inbound", "outbound"):
+        params[f"{direction}.average"] = kib_per_sec(tier.net_average or 0)
+        params[f"{direction}.peak"] = kib_per_sec(tier.net_peak or 0)
+        params[f"{direction}.burst"] = (tier.net_burst or 0) * 1024
+    return params
+
+
+def iotune_element(tier: QosTier) -> str:
+    """<iotune> of a disk, empty without disk limits."""
+    limits = "".join(
+        f"<{key}>{value}</{key}>" for key, value in iotune_params(tier).items()
+        if value)
+    return f"<iotune>{limits}</iotune>" if limits else ""
+
+
+def bandwidth_element(tier: QosTier) -> str:
+    """<bandwidth> of a NIC, empty without network limits."""
+    if tier.net_average is None:
+        return ""
+    attrs = {
+        "average": kib_per_sec(tier.net_average),
+    }
+    if tier.net_peak is not None:
+        attrs["peak"] = kib_per_sec(tier.net_peak)
+    if tier.net_burst is not None:
+        attrs["burst"] = tier.net_burst * 1024
+    limit = "".join(f' {key}="{value}"' for key, value in attrs.items())
+    return (f"<bandwidth><inbound{limit} /><outbound{limit} />"
+            "</bandwidth>")
+
+
+def interface_macs(domain_xml: str) -> list[str]:
+    return [
+        mac.get("address", "")
+        for mac in ET.fromstring(domain_xml).iterfind("devices/interface/mac")
+    ]
+
+
+def apply_tier(domain: libvirt.virDomain, tier: Optional[QosTier]) -> None:
+    """Sets the limits of *tier* on every disk and NIC of *domain*, None
+    lifts them. Persistent, and live too when the domain runs."""
+    import libvirt
+
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if domain.isActive():
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    xml = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+    disks, _ = disk_targets(xml)
+    for disk in disks:
+        domain.setBlockIoTune(disk, iotune_params(tier), flags)
+    for mac in interface_macs(xml):
+        domain.setInterfaceParameters(mac, bandwidth_params(tier), flags)
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass
+import logging
+import math
+import time
+from typing import Optional, TYPE_CHECKING
+
+from app.settings import RateLimitConfig
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS: the buckets to take from, the user's then the global one
+# ARGV: cost followed by the rate (tokens per second) and burst of every key
+# Returns "0" once every bucket paid, otherwise the seconds until all of them
+# hold enough tokens, as a string since Lua numbers are truncated on return.
+# A cost above a bucket's burst takes the whole bucket.
+TAKE_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local cost = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for k = 1, #KEYS do
+  local rate = tonumber(ARGV[k * 2])
+  local burst = tonumber(ARGV[k * 2 + 1])
+  local state = redis.call("HMGET", KEYS[k], "tokens", "ts")
+  local level = tonumber(state[1]) or burst
+  local ts = tonumber(state[2]) or now
+  level = math.min(burst, level + math.max(0, now - ts) * rate)
+  levels[k] = level
+  local need = math.min(cost, burst)
+  if level < need then
+    wait = math.max(wait, (need - level) / rate)
+  end
+end
+if wait > 0 then
+  return tostring(wait)
+end
+for k = 1, #KEYS do
+  local rate = tonumber(ARGV[k * 2])
+  local burst = tonumber(ARGV[k * 2 + 1])
+  local level = levels[k] - math.min(cost, burst)
+  redis.call("HSET", KEYS[k], "tokens", tostring(level), "ts", tostring(now))
+  -- a bucket left alone refills, it can be forgotten once full
+  redis.call("EXPIRE", KEYS[k], math.ceil((burst - level) / rate) + 1)
+end
+return "0"
+"""
+
+# seconds the in-process buckets are used once Redis failed
+FALLBACK_FOR = 5.0
+
+
+class RateLimited(Exception):
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__(f"rate limited, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    burst: int
+    tokens: float
+    ts: float
+
+    def wait(self, cost: int, now: float) -> float:
+        """Refills the bucket, then returns the seconds until it holds
+        *cost* tokens."""
+        self.tokens = min(self.burst,
+                          self.tokens + max(0.0, now - self.ts) * self.rate)
+        self.ts = now
+        need = min(cost, self.burst)
+        return max(0.0, (need - self.tokens) / self.rate)
+
+    def take(self, cost: int) -> None:
+        self.tokens -= min(cost, self.burst)
+
+
+class LocalBuckets:
+    """In-process buckets with the same semantics as the Redis ones. Each
+    API worker has its own, so limits are per worker while they're used."""
+
+    def __init__(self, config: RateLimitConfig) -> None:
+        self.config = config
+        self.users: dict[int, TokenBucket] = {}
+        self.all = self.bucket(config.global_rate, config.global_burst)
+
+    def bucket(self, rate: float, burst: int) -> TokenBucket:
+        return TokenBucket(rate, burst, burst, time.monotonic())
+
+    def take(self, user_id: Optional[int], cost: int) -> float:
+        now = time.monotonic()
+        buckets = [self.all]
+        if user_id is not None:
+            bucket = self.users.get(user_id)
+            if bucket is None:
+                bucket = self.users[user_id] = self.bucket(
+                    self.config.user_rate, self.config.user_burst)
+            buckets.append(bucket)
+        wait = max(bucket.wait(cost, now) for bucket in buckets)
+        if wait == 0:
+            for bucket in buckets:
+                bucket.take(cost)
+        return wait
+
+
+class RateLimiter:
+    """Per-user and global token buckets kept in Redis, shared by every API
+    worker. A check is a single script call, so it's atomic and costs one
+    round trip. When Redis can't be reached in time the check falls back to
+    in-process buckets for a while, instead of failing the request."""
+
+    USER_KEY = "ratelimit:user:{}"
+    GLOBAL_KEY = "ratelimit:global"
+
+    def __init__(self, redis: Redis, config: RateLimitConfig) -> None:
+        self.redis = redis
+        self.config = config
+        self.script = redis.register_script(TAKE_SCRIPT)
+        self.local = LocalBuckets(config)
+        self.fallback_until = 0.0
+
+    def cost(self, endpoint: str, units: int = 1) -> int:
+        return self.config.costs.get(endpoint, 0) * units
+
+    async def admit(self,
+                    user_id: int,
+                    endpoint: str,
+                    units: int = 1,
+                    unlimited_user: bool = False) -> None:
+        """Takes the cost of *units* calls to *endpoint* from the buckets
+        of *user_id* and of the API, raises RateLimited when they're short
+        of tokens."""
+        cost = self.cost(endpoint, units)
+        if not self.config.enabled or cost <= 0:
+            return
+        user = None if unlimited_user else user_id
+        if time.monotonic() < self.fallback_until:
+            wait = self.local.take(user, cost)
+        else:
+            wait = await self.take(user, cost)
+        if wait > 0:
+            raise RateLimited(wait)
+
+    async def take(self, user_id: Optional[int], cost: int) -> float:
+        from redis.exceptions import RedisError
+
+        keys, args = [], [cost]
+        if user_id is not None:
+            keys.append(self.USER_KEY.format(user_id))
+            args += [self.config.user_rate, self.config.user_burst]
+        keys.append(self.GLOBAL_KEY)
+        args += [self.config.global_rate, self.config.global_burst]
+        try:
+            wait = await asyncio.wait_for(self.script(keys=keys, args=args),
+                                          self.config.timeout)
+        except (RedisError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(
+                "rate limiting in-process for %.0fs, redis failed: %r",
+                FALLBACK_FOR, e)
+            self.fallback_until = time.monotonic() + FALLBACK_FOR
+            return self.local.take(user_id, cost)
+        return float(wait)
+
+
+def retry_after(seconds: float) -> str:
+    # whole seconds, rounded up so a client retrying right away succeeds
+    return str(max(1, math.ceil(seconds)))
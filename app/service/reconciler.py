@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import asdict
+from dataclasses import dataclass
+import logging
+import os
+import struct
+import time
+from typing import Iterable, Iterator, Optional, TypeVar
+from uuid import UUID
+
+from sqlalchemy import delete
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import Address
+from app.models import Instance
+from app.models import NameReservation
+from app.service.virt import VirtPool
+from app.settings import ReconcileConfig
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# magic, version, backing file offset and size
+QCOW2_HEADER = struct.Struct(">4sIQI")
+QCOW2_MAGIC = b"QFI\xfb"
+
+
+def chunked(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    chunk: list[T] = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@dataclass
+class DriftReport:
+    generation: int
+    full: bool
+    domains: int
+    checked: int
+    orphan_rows: int
+    unowned_domains: int
+    # rows named differently than their domain, the row's name is the one
+    # users set and is kept
+    renamed: int
+    adopted: int
+    stale_disks: int
+    stale_names: int
+    elapsed: float
+
+    def metrics(self) -> dict[str, float]:
+        return {k: float(v) for k, v in asdict(self).items()}
+
+
+def backing_file(path: str) -> Optional[str]:
+    """Backing file named in the header of a qcow2 image, None for other
+    files and images without one."""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(QCOW2_HEADER.size)
+            if len(header) < QCOW2_HEADER.size:
+                return None
+            magic, _, offset, size = QCOW2_HEADER.unpack(header)
+            if magic != QCOW2_MAGIC or offset == 0 or size == 0:
+                return None
+            f.seek(offset)
+            return f.read(size).decode(errors="replace")
+    except OSError:
+        return None
+
+
+@dataclass
+class HostDrift:
+    domains: dict[UUID, str]
+    checked: int = 0
+    orphans: int = 0
+    unowned: int = 0
+    renamed: int = 0
+    adopted: int = 0
+
+
+class Reconciler:
+    """Keeps the instances table in line with the domains defined on every
+    hypervisor.
+
+    Rows are the authority on names: users rename an instance by its row,
+    the domain (and its disk) keep the name they were created with.
+
+    The first run (and every `full_every` runs after that) compares the whole
+    inventory. In between, only domains that appeared, disappeared or were
+    renamed since the previous generation, plus the ones still drifting, are
+    checked against the database, so a quiet host costs one domain listing
+    and no queries.
+    """
+
+    def __init__(
+        self,
+        pool: VirtPool,
+        session_maker: async_sessionmaker[AsyncSession],
+        config: ReconcileConfig,
+        image_dir: str,
+        base_images: Iterable[str] = (),
+    ) -> None:
+        self.pool = pool
+        self.session_maker = session_maker
+        self.config = config
+        self.image_dir = image_dir
+        # never stale, whatever their name
+        self.base_images = {os.path.realpath(path) for path in base_images}
+        self.generation = 0
+        self.domains: dict[str, dict[UUID, str]] = {}
+        self.drifting: dict[str, set[UUID]] = {}
+
+    def inventory(self, host: str) -> dict[UUID, str]:
+        return {
+            UUID(domain.UUIDString()): domain.name()
+            for domain in self.pool.get(host).get_vms()
+        }
+
+    async def load_rows(self, session: AsyncSession, host: str,
+                        ids: Optional[set[UUID]]) -> dict[UUID, str]:
+        stmt = select(Instance.id, Instance.name).where(Instance.host == host)
+        rows: dict[UUID, str] = {}
+        if ids is None:
+            stream = await session.stream(stmt)
+            async for id, name in stream:
+                rows[id] = name
+            return rows
+        for chunk in chunked(ids, self.config.batch_size):
+            result = await session.execute(stmt.where(Instance.id.in_(chunk)))
+            rows.update({id: name for id, name in result})
+        return rows
+
+    def stale_disks(self, names: Iterable[str]) -> list[str]:
+        # disks left behind by provisioning runs that never got to defineXML
+        known = set(names)
+        deadline = time.time() - self.config.disk_grace
+        stale: list[str] = []
+        try:
+            entries = list(os.scandir(self.image_dir))
+        except OSError:
+            return stale
+        # base images, and whatever an overlay (stale or not) is backed by
+        kept = set(self.base_images)
+        for entry in entries:
+            backing = backing_file(entry.path) if entry.is_file() else None
+            if backing is not None:
+                kept.add(os.path.realpath(os.path.join(self.image_dir,
+                                                       backing)))
+        for entry in entries:
+            # snapshot files are named <domain>@<snapshot>.*
+            if entry.name.partition("@")[0] in known or not entry.is_file():
+                continue
+            if os.path.realpath(entry.path) in kept:
+                continue
+            if entry.stat().st_mtime < deadline:
+                stale.append(entry.path)
+        return stale
+
+    async def release_stale_names(self, names: Iterable[str]) -> int:
+        # reserved by provisioning runs that never got to insert their row,
+        # e.g. the API restarted meanwhile
+        known = set(names)
+        deadline = int(time.time()) - self.config.disk_grace
+        stmt = select(NameReservation.name).where(
+            NameReservation.created < deadline,
+            NameReservation.instance_id.not_in(select(Instance.id)))
+        async with self.session_maker() as session:
+            stale = [
+                name for name in await session.scalars(stmt)
+                if name not in known
+            ]
+            for chunk in chunked(stale, self.config.batch_size):
+                await session.execute(
+                    delete(NameReservation).where(
+                        NameReservation.name.in_(chunk)))
+            await session.commit()
+        return len(stale)
+
+    async def provisioning(self, session: AsyncSession,
+                           ids: list[UUID]) -> set[UUID]:
+        """Those of *ids* still being provisioned: their name is reserved,
+        for less than disk_grace, and the run inserts their row when done."""
+        deadline = int(time.time()) - self.config.disk_grace
+        held: set[UUID] = set()
+        for chunk in chunked(ids, self.config.batch_size):
+            held.update(await session.scalars(
+                select(NameReservation.instance_id).where(
+                    NameReservation.instance_id.in_(chunk),
+                    NameReservation.created >= deadline)))
+        return held
+
+    async def reconcile_host(self, host: str, full: bool) -> HostDrift:
+        virt = await self.pool.connect(host)
+        domains = await virt.call("list", self.inventory, host)
+        previous = self.domains.get(host, {})
+        drifting = self.drifting.get(host, set())
+        drift = HostDrift(domains)
+
+        candidates: Optional[set[UUID]] = None
+        if not full:
+            candidates = set(drifting)
+            candidates.update(domains.keys() ^ previous.keys())
+            candidates.update(id for id, name in domains.items()
+                              if id in previous and previous[id] != name)
+            if not candidates:
+                self.domains[host] = domains
+                return drift
+
+        orphans: list[UUID] = []
+        unowned: list[UUID] = []
+        renamed: list[UUID] = []
+
+        async with self.session_maker() as session:
+            rows = await self.load_rows(session, host, candidates)
+            checked = rows.keys() | (domains.keys()
+                                     if candidates is None else candidates)
+            for id in checked:
+                if id not in domains:
+                    if id in rows:
+                        orphans.append(id)
+                elif id not in rows:
+                    unowned.append(id)
+                elif rows[id] != domains[id]:
+                    renamed.append(id)
+
+            for chunk in chunked(orphans, self.config.batch_size):
+                await session.execute(
+                    delete(Instance).where(Instance.id.in_(chunk)))
+                # their addresses go back to the pool
+                await session.execute(
+                    delete(Address).where(Address.instance_id.in_(chunk)))
+                await session.execute(
+                    delete(NameReservation).where(
+                        NameReservation.instance_id.in_(chunk)))
+
+            # a domain is only adopted once it stayed unowned for a whole
+            # generation, and never while being provisioned: the run inserts
+            # its row once the guest is configured, minutes after define
+            adoptable: list[UUID] = []
+            if self.config.owner is not None:
+                adoptable = [id for id in unowned if id in drifting]
+                if adoptable:
+                    busy = await self.provisioning(session, adoptable)
+                    adoptable = [id for id in adoptable if id not in busy]
+                for chunk in chunked(adoptable, self.config.batch_size):
+                    await session.execute(
+                        insert(Instance).values([{
+                            "id": id,
+                            "name": domains[id],
+                            "host": host,
+                            "user_id": self.config.owner,
+                        } for id in chunk]))
+
+            await session.commit()
+
+        self.domains[host] = domains
+        self.drifting[host] = set(unowned).difference(adoptable)
+
+        drift.checked = len(checked)
+        drift.orphans = len(orphans)
+        drift.unowned = len(unowned)
+        drift.renamed = len(renamed)
+        drift.adopted = len(adoptable)
+        return drift
+
+    async def run(self) -> DriftReport:
+        start = time.perf_counter()
+        self.generation += 1
+        full = (self.generation - 1) % self.config.full_every == 0
+
+        drifts = []
+        for host in self.pool.hosts:
+            try:
+                drifts.append(await self.reconcile_host(host, full))
+            except Exception:
+                logger.exception("failed to reconcile host %s", host)
+
+        stale: list[str] = []
+        stale_names = 0
+        if full and len(drifts) == len(self.pool.hosts):
+            names = [name for d in drifts for name in d.domains.values()]
+            stale = await asyncio.to_thread(self.stale_disks, names)
+            stale_names = await self.release_stale_names(names)
+            if self.config.remove_disks:
+                for path in stale:
+                    logger.warning("removing stale disk %s", path)
+                    os.unlink(path)
+
+        report = DriftReport(
+            generation=self.generation,
+            full=full,
+            domains=sum(len(d.domains) for d in drifts),
+            checked=sum(d.checked for d in drifts),
+            orphan_rows=sum(d.orphans for d in drifts),
+            unowned_domains=sum(d.unowned for d in drifts),
+            renamed=sum(d.renamed for d in drifts),
+            adopted=sum(d.adopted for d in drifts),
+            stale_disks=len(stale),
+            stale_names=stale_names,
+            elapsed=time.perf_counter() - start,
+        )
+        logger.info("reconcile %s", report)
+        return report
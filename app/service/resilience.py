@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from collections import deque
+import math
+import time
+from typing import Optional
+
+
+class HostUnavailable(Exception):
+    """A hypervisor didn't answer in time, or its breaker is open."""
+
+    def __init__(self, host: str, reason: str, retry_after: float) -> None:
+        super().__init__(f"Host {host} is unavailable: {reason}")
+        self.host = host
+        self.retry_after = retry_after
+
+
+def host_failure(e: BaseException) -> bool:
+    """Whether *e* says the host (or the connection to it) is unhealthy,
+    as opposed to a call it refused, e.g. an unknown domain."""
+    import libvirt
+
+    if isinstance(e, OSError):
+        return True
+    if not isinstance(e, libvirt.libvirtError):
+        return False
+    return e.get_error_code() in (
+        libvirt.VIR_ERR_SYSTEM_ERROR,
+        libvirt.VIR_ERR_RPC,
+        libvirt.VIR_ERR_NO_CONNECT,
+        libvirt.VIR_ERR_INVALID_CONN,
+        libvirt.VIR_ERR_OPERATION_TIMEOUT,
+    )
+
+
+def connection_lost(e: BaseException) -> bool:
+    """Whether *e* says the connection to the host is gone, it has to be
+    opened again (libvirtd restarted, the socket closed...)."""
+    import libvirt
+
+    if not isinstance(e, libvirt.libvirtError):
+        return False
+    return e.get_error_code() in (
+        libvirt.VIR_ERR_SYSTEM_ERROR,
+        libvirt.VIR_ERR_NO_CONNECT,
+        libvirt.VIR_ERR_INVALID_CONN,
+    )
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures: calls are refused for
+    `reset_after` seconds, then a single one is let through as a probe,
+    which closes the breaker again or keeps it open. Only used from the
+    event loop, no locking."""
+
+    def __init__(self, threshold: int, reset_after: float) -> None:
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened is None:
+            return "closed"
+        return "half-open" if self.probing else "open"
+
+    def retry_after(self) -> float:
+        if self.opened is None:
+            return 0.0
+        return max(0.0, self.opened + self.reset_after - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.opened is None:
+            return True
+        if self.probing or self.retry_after() > 0:
+            return False
+        self.probing = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened = time.monotonic()
+        self.probing = False
+
+    def abandon(self) -> None:
+        # the caller went away before the probe answered, let another one
+        # probe instead
+        self.probing = False
+
+
+class LatencyWindow:
+    """Durations of the last *size* calls of a kind."""
+
+    def __init__(self, size: int = 200) -> None:
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
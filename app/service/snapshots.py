@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+import glob
+import os
+import re
+from typing import Optional, TYPE_CHECKING
+from xml.etree import ElementTree as ET
+
+if TYPE_CHECKING:
+    import libvirt
+
+# becomes part of file names
+NAME_PATTERN = r"^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class SnapshotInfo:
+    name: str
+    # epoch seconds
+    created: int
+    # domain state when it was taken, "running" snapshots hold its memory
+    state: str
+    memory: bool
+    current: bool
+    description: Optional[str] = None
+
+
+def snapshot_path(image_dir: str, domain: str, name: str, suffix: str) -> str:
+    # every file of a domain starts with its name, they go away with it
+    return os.path.join(image_dir, f"{domain}@{name}.{suffix}")
+
+
+def snapshot_files(image_dir: str, domain: str) -> list[str]:
+    return glob.glob(os.path.join(image_dir, glob.escape(domain) + "@*"))
+
+
+def disk_targets(domain_xml: str) -> tuple[list[str], list[str]]:
+    """Target devices of the writable disks of a domain, and of the others
+    (cdroms, the cloud-init seed) which are left out of snapshots."""
+    disks, skipped = [], []
+    for disk in ET.fromstring(domain_xml).iterfind("devices/disk"):
+        target = disk.find("target")
+        if target is None:
+            continue
+        writable = disk.find("readonly") is None
+        if disk.get("device", "disk") == "disk" and writable:
+            disks.append(target.get("dev"))
+        else:
+            skipped.append(target.get("dev"))
+    return disks, skipped
+
+
+def snapshot_xml(name: str,
+                 domain: str,
+                 domain_xml: str,
+                 image_dir: str,
+                 memory: bool,
+                 description: Optional[str] = None) -> str:
+    """External snapshot of every writable disk: each gets a qcow2 overlay
+    the guest writes to from now on, the current image is left as is. With
+    *memory* the RAM is saved next to them, while the guest keeps running."""
+    root = ET.Element("domainsnapshot")
+    ET.SubElement(root, "name").text = name
+    if description:
+        ET.SubElement(root, "description").text = description
+    if memory:
+        ET.SubElement(root,
+                      "memory",
+                      snapshot="external",
+                      file=snapshot_path(image_dir, domain, name, "mem"))
+    else:
+        ET.SubElement(root, "memory", snapshot="no")
+    disks = ET.SubElement(root, "disks")
+    targets, skipped = disk_targets(domain_xml)
+    if not targets:
+        raise SnapshotError("the domain has no disk to snapshot")
+    for target in targets:
+        disk = ET.SubElement(disks, "disk", name=target, snapshot="external")
+        ET.SubElement(disk, "driver", type="qcow2")
+        ET.SubElement(disk,
+                      "source",
+                      file=snapshot_path(image_dir, domain, name,
+                                         f"{target}.qcow2"))
+    for target in skipped:
+        ET.SubElement(disks, "disk", name=target, snapshot="no")
+    return ET.tostring(root, encoding="unicode")
+
+
+def snapshot_info(snapshot: libvirt.virDomainSnapshot) -> SnapshotInfo:
+    root = ET.fromstring(snapshot.getXMLDesc())
+    memory = root.find("memory")
+    return SnapshotInfo(
+        name=snapshot.getName(),
+        created=int(root.findtext("creationTime", "0")),
+        state=root.findtext("state", ""),
+        memory=memory is not None and memory.get("snapshot") == "external",
+        current=bool(snapshot.isCurrent()),
+        description=root.findtext("description"),
+    )
+
+
+def create_snapshot(domain: libvirt.virDomain,
+                    image_dir: str,
+                    name: str,
+                    memory: bool = False,
+                    description: Optional[str] = None) -> SnapshotInfo:
+    import libvirt
+
+    if not re.match(NAME_PATTERN, name):
+        raise SnapshotError(f"invalid snapshot name {name!r}")
+    flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC
+    if memory:
+        if not domain.isActive():
+            raise SnapshotError("only a running instance has memory to save")
+        # the guest only pauses for the final pass of the memory copy
+        flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_LIVE
+    else:
+        flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
+    xml = snapshot_xml(name, domain.name(), domain.XMLDesc(), image_dir, memory,
+                       description)
+    return snapshot_info(domain.snapshotCreateXML(xml, flags))
+
+
+def list_snapshots(domain: libvirt.virDomain) -> list[SnapshotInfo]:
+    snapshots = [snapshot_info(s) for s in domain.listAllSnapshots()]
+    return sorted(snapshots, key=lambda s: s.created)
+
+
+def revert_snapshot(domain: libvirt.virDomain, name: str) -> SnapshotInfo:
+    """Brings the disks (and the memory, if saved) back to the snapshot.
+    A memory snapshot comes back running right where it was taken, without
+    a boot, a disk-only one comes back shut off."""
+    import libvirt
+
+    snapshot = domain.snapshotLookupByName(name)
+    info = snapshot_info(snapshot)
+    flags = 0
+    if info.memory:
+        flags |= libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING
+    domain.revertToSnapshot(snapshot, flags)
+    return info
+
+
+def delete_snapshot(domain: libvirt.virDomain, name: str) -> None:
+    domain.snapshotLookupByName(name).delete()
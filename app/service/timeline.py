@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from dataclasses import asdict
+from dataclasses import dataclass
+import json
+import time
+from typing import Iterable, Iterator, Optional, TextIO, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+# upper bounds in seconds, provisioning stages range from a few ms
+# (defineXML) to minutes (image copy, ansible)
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+@dataclass
+class Stage:
+    name: str
+    # epoch seconds
+    start: float
+    end: float
+    error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Timeline:
+    """Times provisioning stages, each finished stage is appended to *out*
+    as a JSON line so a reader sees progress while the run goes on. Stages
+    are also appended to *stages*, e.g. those of a job item when the run is
+    in the same process."""
+
+    def __init__(self,
+                 out: Optional[TextIO] = None,
+                 stages: Optional[list[Stage]] = None) -> None:
+        self.out = out
+        self.stages: list[Stage] = stages if stages is not None else []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.record(Stage(name, start, time.time(), error))
+
+    def record(self, stage: Stage) -> None:
+        self.stages.append(stage)
+        if self.out is not None:
+            self.out.write(json.dumps(asdict(stage)) + "\n")
+            self.out.flush()
+
+
+def read_timeline(path: str) -> list[Stage]:
+    stages = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    stages.append(Stage(**json.loads(line)))
+                except (ValueError, TypeError):
+                    # a line being written right now
+                    break
+    except FileNotFoundError:
+        pass
+    return stages
+
+
+def bucket(duration: float) -> str:
+    for bound in BUCKETS:
+        if duration <= bound:
+            return str(bound)
+    return "+Inf"
+
+
+class StageHistograms:
+    """Per-stage latency histograms kept in Redis, shared by every API
+    worker. Each stage is a hash holding the number of runs per bucket, plus
+    the count, sum and errors."""
+
+    PREFIX = "timeline:stage:"
+
+    def __init__(self, redis: Redis) -> None:
+        self.redis = redis
+
+    async def observe(self, stages: Iterable[Stage]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for stage in stages:
+                key = self.PREFIX + stage.name
+                pipe.hincrby(key, bucket(stage.duration), 1)
+                pipe.hincrby(key, "count", 1)
+                pipe.hincrbyfloat(key, "sum", stage.duration)
+                if stage.error is not None:
+                    pipe.hincrby(key, "errors", 1)
+            await pipe.execute()
+
+    async def snapshot(self) -> dict[str, dict[str, float]]:
+        stages: dict[str, dict[str, float]] = {}
+        async for key in self.redis.scan_iter(self.PREFIX + "*"):
+            if isinstance(key, bytes):
+                key = key.decode()
+            values = await self.redis.hgetall(key)
+            stages[key[len(self.PREFIX):]] = {
+                (k.decode() if isinstance(k, bytes) else k): float(v)
+                for k, v in values.items()
+            }
+        return stages
+
+
+def quantile(histogram: dict[str, float], q: float) -> Optional[float]:
+    """Upper bound of the bucket holding the *q* quantile, None past the
+    last bucket."""
+    count = histogram.get("count", 0)
+    if not count:
+        return None
+    seen = 0.0
+    for bound in BUCKETS:
+        seen += histogram.get(str(bound), 0)
+        if seen >= q * count:
+            return bound
+    return None
@@ -1,9 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntFlag
-from typing import Any, List
+import logging
+import threading
+import time
+from typing import Any, Callable, Coroutine, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING, TypeVar
 from uuid import UUID
 from uuid import uuid4
 
-import libvirt
+from app.service.resilience import CircuitBreaker
+from app.service.resilience import connection_lost
+from app.service.resilience import host_failure
+from app.service.resilience import HostUnavailable
+from app.service.resilience import LatencyWindow
+from app.settings import ResilienceConfig
+
+# libvirt is imported where it's used, the C bindings are slow to load and
+# most importers of this module never open a connection
+if TYPE_CHECKING:
+    import libvirt
+
+logger = logging.getLogger(__name__)
+
+# host, domain, libvirt.VIR_DOMAIN_EVENT_*
+LifecycleCallback = Callable[[str, UUID, int], None]
+
+T = TypeVar("T")
+
+_events_lock = threading.Lock()
+_events_started = False
+
+
+def start_events() -> None:
+    """Runs the libvirt event loop in a daemon thread. Only connections
+    opened afterwards deliver events."""
+    import libvirt
+
+    global _events_started
+    with _events_lock:
+        if _events_started:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run() -> None:
+            while True:
+                if libvirt.virEventRunDefaultImpl() < 0:
+                    logger.error("libvirt event loop failed")
+
+        threading.Thread(target=run, name="libvirt-events", daemon=True).start()
+        _events_started = True
 
 
 class VirtMode(IntFlag):
@@ -12,21 +59,114 @@ class VirtMode(IntFlag):
     WRITE = 2
 
 
+def lookup_domains(conn: libvirt.virConnect,
+                   ids: Iterable[UUID]) -> List[libvirt.virDomain]:
+    """Domains of *ids* defined on *conn*, unknown ones are skipped."""
+    import libvirt
+
+    domains = []
+    for id in ids:
+        try:
+            domains.append(conn.lookupByUUIDString(str(id)))
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+    return domains
+
+
 class Virt:
+    """Connection to a hypervisor.
+
+    The blocking libvirt calls of the API go through call() and read(),
+    which run them on threads of this host only, so a hung libvirtd can't
+    take the threads of the other hosts. A call not done by the deadline
+    of its kind fails with HostUnavailable; its thread can't be stopped and
+    finishes (or hangs) in the background. Consecutive failures open the
+    breaker of the host, its calls then fail right away instead of queueing
+    behind the hung ones.
+
+    The connection is opened by connect(), the same way, and opened again
+    by the next call once a call reports it lost (libvirtd restarted...).
+    """
+    uri: str
     mode: VirtMode
     conn: libvirt.virConnect
+    # bounds the number of concurrent blocking calls made against this host
+    limit: asyncio.Semaphore
 
     def __init__(self,
                  uri: str,
                  mode: VirtMode = VirtMode.READ,
-                 auth: Any = None) -> None:
-        if mode & (VirtMode.READ | VirtMode.WRITE):
-            self.conn = libvirt.open(uri)
-        elif mode & (VirtMode.READ | VirtMode.WRITE) and auth is not None:
+                 auth: Any = None,
+                 concurrency: int = 8,
+                 name: Optional[str] = None,
+                 resilience: Optional[ResilienceConfig] = None) -> None:
+        if auth is not None:
             raise NotImplementedError("auth is not supported yet!")
-        elif mode & VirtMode.READ:
-            self.conn = libvirt.openReadOnly(uri)
+        # set by open(), cleared when a call reports the connection lost
+        self.connected = False
+        self.connecting = asyncio.Lock()
+        self.watchers: List[Tuple[str, LifecycleCallback]] = []
+        self.uri = uri
         self.mode = mode
+        self.limit = asyncio.Semaphore(concurrency)
+        self.concurrency = concurrency
+        self.name = name or uri
+        self.config = resilience or ResilienceConfig()
+        self.breaker = CircuitBreaker(self.config.failure_threshold,
+                                      self.config.reset_after)
+        self.latencies: Dict[str, LatencyWindow] = {}
+        # calls given up on keep their thread until libvirt returns, twice
+        # the limit leaves room for them next to the admitted ones
+        self.executor = ThreadPoolExecutor(
+            2 * concurrency, thread_name_prefix=f"virt-{self.name}")
+        # hedged reads get their own connection and threads, the ones of
+        # the primary may all be stuck behind the slow call
+        self.hedge_executor: Optional[ThreadPoolExecutor] = None
+        self.hedge_conn: Optional[libvirt.virConnect] = None
+        self.hedge_lock = threading.Lock()
+        self.hedges = 0
+        # fields of the domains as last listed, served while the host is
+        # unavailable
+        self.known: Dict[UUID, Dict[str, Any]] = {}
+
+    def open(self) -> None:
+        """Opens the connection, replacing a lost one. Blocking, see
+        connect()."""
+        import libvirt
+
+        if self.mode & (VirtMode.READ | VirtMode.WRITE):
+            conn = libvirt.open(self.uri)
+        elif self.mode & VirtMode.READ:
+            conn = libvirt.openReadOnly(self.uri)
+        else:
+            raise RuntimeError(f"no access mode to open {self.uri}")
+        lost = getattr(self, "conn", None)
+        self.conn = conn
+        for host, callback in self.watchers:
+            self.register(host, callback)
+        self.connected = True
+        if lost is not None:
+            try:
+                lost.close()
+            except libvirt.libvirtError:
+                pass
+
+    async def connect(self) -> None:
+        """Opens the connection unless it's open, on a thread of this host
+        within the deadline of "connect"."""
+        if self.connected:
+            return
+        async with self.connecting:
+            if self.connected:
+                return
+            try:
+                await self.guard("connect", self.run(self.executor, self.open))
+            except HostUnavailable:
+                raise
+            except Exception as e:
+                raise HostUnavailable(self.name, f"connect failed: {e}",
+                                      self.breaker.retry_after())
 
     def get_vm_by_name(self, name: str) -> libvirt.virDomain:
         return self.conn.lookupByName(name)
@@ -37,6 +177,56 @@ class Virt:
     def get_vms(self) -> List[libvirt.virDomain]:
         return self.conn.listAllDomains()
 
+    def get_vms_by_ids(self, ids: Iterable[UUID]) -> List[libvirt.virDomain]:
+        return lookup_domains(self.conn, ids)
+
+    def usage(self) -> Tuple[int, int]:
+        """vCPUs and memory (KiB) allocated to every defined domain."""
+        vcpus = ram = 0
+        for domain in self.conn.listAllDomains():
+            _, max_mem, _, nr_vcpu, _ = domain.info()
+            vcpus += nr_vcpu
+            ram += max_mem
+        return vcpus, ram
+
+    def allocations(self) -> List[Tuple[UUID, int, int, int]]:
+        """(uuid, vcpus, memory in KiB, disk capacity in bytes) of every
+        defined domain."""
+        import libvirt
+
+        allocations = []
+        for domain in self.conn.listAllDomains():
+            _, max_mem, _, nr_vcpu, _ = domain.info()
+            try:
+                disk = domain.blockInfo("vda")[0]
+            except libvirt.libvirtError:
+                disk = 0
+            allocations.append(
+                (UUID(domain.UUIDString()), nr_vcpu, max_mem, disk))
+        return allocations
+
+    def watch(self, host: str, callback: LifecycleCallback) -> None:
+        """Calls *callback* on the lifecycle events of this host's domains,
+        registered again on every connection opened."""
+        self.watchers.append((host, callback))
+        if self.connected:
+            self.register(host, callback)
+
+    def register(self, host: str, callback: LifecycleCallback) -> None:
+        import libvirt
+
+        def on_event(conn: libvirt.virConnect, domain: libvirt.virDomain,
+                     event: int, detail: int, opaque: Any) -> None:
+            # runs in the event loop thread
+            try:
+                callback(host, UUID(domain.UUIDString()), event)
+            except Exception:
+                logger.exception("lifecycle callback failed")
+
+        self.conn.domainEventRegisterAny(None,
+                                         libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                         on_event, None)
+
     def define_vm(self, xml: str) -> libvirt.virDomain:
         if not (self.mode & VirtMode.WRITE):
             raise RuntimeError(
@@ -44,9 +234,207 @@ class Virt:
         domain = self.conn.defineXML(xml)
         return domain
 
+    def deadline(self, kind: str) -> float:
+        return self.config.deadlines.get(kind, self.config.default_deadline)
+
+    async def call(self, kind: str, fn: Callable[..., T], *args: Any) -> T:
+        """Runs the blocking *fn* on a thread of this host, within the
+        deadline of *kind*."""
+        await self.connect()
+        return await self.guard(kind, self.run(self.executor, fn, *args))
+
+    async def read(self, kind: str, fn: Callable[..., T], *args: Any) -> T:
+        """call() for reads without side effects, *fn* gets the connection
+        to read from first. With hedging, one still running after the usual
+        latency of *kind* is sent again on a second connection, the first
+        answer wins. Without side effects, a read that finds the connection
+        lost is sent again on a new one."""
+        import libvirt
+
+        try:
+            return await self.read_once(kind, fn, *args)
+        except libvirt.libvirtError as e:
+            if not connection_lost(e):
+                raise
+        return await self.read_once(kind, fn, *args)
+
+    async def read_once(self, kind: str, fn: Callable[..., T], *args: Any) -> T:
+        await self.connect()
+        if not self.config.hedge:
+            return await self.guard(
+                kind, self.run(self.executor, fn, self.conn, *args))
+        return await self.guard(kind, self.hedged(kind, fn, *args))
+
+    async def run(self, executor: ThreadPoolExecutor, fn: Callable[..., T],
+                  *args: Any) -> T:
+        # waiting for a slot counts against the deadline, and a call given
+        # up on meanwhile never takes a thread
+        async with self.limit:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, fn, *args)
+
+    async def guard(self, kind: str, operation: Coroutine[Any, Any, T]) -> T:
+        if not self.breaker.allow():
+            operation.close()
+            raise HostUnavailable(self.name, "circuit open",
+                                  self.breaker.retry_after())
+        start = time.monotonic()
+        try:
+            result = await asyncio.wait_for(operation, self.deadline(kind))
+        except asyncio.TimeoutError:
+            self.failure(f"{kind} call timed out")
+            raise HostUnavailable(self.name, f"{kind} call timed out",
+                                  self.breaker.retry_after())
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except Exception as e:
+            # the host answered, even if it was to refuse the call
+            if host_failure(e):
+                self.failure(str(e))
+            else:
+                self.breaker.success()
+            if connection_lost(e):
+                # opened again by the next call
+                self.connected = False
+            raise
+        self.breaker.success()
+        self.latencies.setdefault(kind,
+                                  LatencyWindow()).add(time.monotonic() - start)
+        return result
+
+    def failure(self, reason: str) -> None:
+        was_open = self.breaker.state == "open"
+        self.breaker.failure()
+        if not was_open and self.breaker.state == "open":
+            logger.warning("breaker of %s open for %.0fs: %s", self.name,
+                           self.breaker.reset_after, reason)
+
+    def hedge_delay(self, kind: str) -> Optional[float]:
+        window = self.latencies.get(kind)
+        if window is None or len(window) < self.config.hedge_min_samples:
+            return None
+        return max(self.config.hedge_min_delay,
+                   window.quantile(self.config.hedge_quantile))
+
+    async def hedged(self, kind: str, fn: Callable[..., T], *args: Any) -> T:
+        primary = asyncio.ensure_future(
+            self.run(self.executor, fn, self.conn, *args))
+        delay = self.hedge_delay(kind)
+        pending = {primary}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    self.hedges += 1
+                    # bounded by the hedge threads instead of the limit,
+                    # the slow calls still hold their slots
+                    loop = asyncio.get_running_loop()
+                    pending.add(
+                        loop.run_in_executor(self.hedge_threads(),
+                                             self.on_hedge_conn, fn, *args))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def hedge_threads(self) -> ThreadPoolExecutor:
+        if self.hedge_executor is None:
+            self.hedge_executor = ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix=f"virt-{self.name}-hedge")
+        return self.hedge_executor
+
+    def on_hedge_conn(self, fn: Callable[..., T], *args: Any) -> T:
+        import libvirt
+
+        with self.hedge_lock:
+            if self.hedge_conn is not None and not self.hedge_conn.isAlive():
+                try:
+                    self.hedge_conn.close()
+                except libvirt.libvirtError:
+                    pass
+                self.hedge_conn = None
+            if self.hedge_conn is None:
+                self.hedge_conn = libvirt.openReadOnly(self.uri)
+        return fn(self.hedge_conn, *args)
+
+    def close(self) -> None:
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+        if self.hedge_conn is not None:
+            self.hedge_conn.close()
+        self.executor.shutdown(wait=False)
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False)
+
+
+class VirtPool:
+    """Lazily opened connections to every configured hypervisor, keyed by
+    host name."""
+
+    def __init__(self,
+                 uris: Dict[str, str],
+                 mode: VirtMode = VirtMode.READ,
+                 concurrency: int = 8,
+                 resilience: Optional[ResilienceConfig] = None) -> None:
+        self.uris = uris
+        self.mode = mode
+        self.concurrency = concurrency
+        self.resilience = resilience
+        self._conns: Dict[str, Virt] = {}
+        self._watchers: List[LifecycleCallback] = []
+
+    @property
+    def hosts(self) -> List[str]:
+        return list(self.uris)
+
+    @property
+    def default(self) -> str:
+        return next(iter(self.uris))
+
+    def get(self, host: str) -> Virt:
+        """Virt of *host*, its connection opened by the first call or by
+        connect()."""
+        virt = self._conns.get(host)
+        if virt is None:
+            virt = Virt(self.uris[host],
+                        self.mode,
+                        concurrency=self.concurrency,
+                        name=host,
+                        resilience=self.resilience)
+            for callback in self._watchers:
+                virt.watch(host, callback)
+            self._conns[host] = virt
+        return virt
+
+    async def connect(self, host: str) -> Virt:
+        """Virt of *host* with an open connection, HostUnavailable when it
+        can't be opened in time."""
+        virt = self.get(host)
+        await virt.connect()
+        return virt
+
+    def watch(self, callback: LifecycleCallback) -> None:
+        """Calls *callback* on every lifecycle event (start, stop, suspend,
+        undefine...) of a domain of any host. Only connections opened
+        afterwards deliver events, watch before using the pool."""
+        start_events()
+        self._watchers.append(callback)
+
     def close(self) -> None:
-        self.conn.close()
+        for virt in self._conns.values():
+            virt.close()
+        self._conns.clear()
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    pass
@@ -1,16 +1,70 @@
+from __future__ import annotations
+
 from functools import lru_cache
+import re
 from typing import Dict, Literal, Optional
 
 from pydantic import BaseModel
 from pydantic import FilePath
+from pydantic import IPvAnyAddress
 from pydantic import IPvAnyNetwork
+from pydantic import model_validator
 import yaml
 
+SIZE_UNITS = {
+    "": 1,
+    "K": 1 << 10,
+    "M": 1 << 20,
+    "G": 1 << 30,
+    "T": 1 << 40,
+}
+
+
+def parse_size(size: str) -> int:
+    """Parse sizes like `8GB`, `512MiB` or `2G` into bytes, always using
+    binary multiples."""
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)(?:i?B)?\s*", size,
+                         re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"invalid size {size!r}")
+    value, unit = match.groups()
+    return int(value) * SIZE_UNITS[unit.upper()]
+
 
 class NetworkConfig(BaseModel):
     mode: Literal["bridge", "nat"]
     interface: Optional[str] = None
     subnet: IPvAnyNetwork
+    # libvirt network serving DHCP in nat mode
+    name: str = "default"
+    # addresses after the network address never handed out (gateway...)
+    reserved: int = 1
+    # first and last address handed out in nat mode, outside the <range> of
+    # the libvirt network's DHCP server so no guest leases them dynamically.
+    # Without them instances get whatever address the DHCP server leases.
+    pool_start: Optional[IPvAnyAddress] = None
+    pool_end: Optional[IPvAnyAddress] = None
+
+    @property
+    def managed(self) -> bool:
+        # addresses are only assigned when libvirt runs the DHCP server
+        return self.mode == "nat" and self.pool_start is not None
+
+    @model_validator(mode="after")
+    def check_pool(self) -> NetworkConfig:
+        if self.pool_start is None and self.pool_end is None:
+            return self
+        if self.pool_start is None or self.pool_end is None:
+            raise ValueError("pool_start and pool_end go together")
+        if self.mode != "nat":
+            raise ValueError("an address pool needs nat mode")
+        for address in (self.pool_start, self.pool_end):
+            if address.version != self.subnet.version or (address
+                                                          not in self.subnet):
+                raise ValueError(f"{address} isn't in {self.subnet}")
+        if self.pool_start > self.pool_end:
+            raise ValueError("pool_start is after pool_end")
+        return self
 
 
 class BaseImage(BaseModel):
@@ -24,11 +78,262 @@ class OAuthConfig(BaseModel):
     client_secret: str
 
 
+class ReconcileConfig(BaseModel):
+    # minutes between two reconcile runs
+    interval: int = 5
+    # compare the full inventory every n runs, incremental in between
+    full_every: int = 12
+    batch_size: int = 500
+    # user that receives domains defined outside of the API, if any
+    owner: Optional[int] = None
+    # seconds before an image without a domain is considered stale
+    disk_grace: int = 3600
+    remove_disks: bool = False
+
+
+class RateLimitConfig(BaseModel):
+    enabled: bool = True
+    # refill rate (tokens per second) and size of the bucket of every user,
+    # admins only draw from the global one
+    user_rate: float = 1.0
+    user_burst: int = 30
+    global_rate: float = 20.0
+    global_burst: int = 200
+    # tokens taken by a call, per instance for batch, unlisted endpoints
+    # are free
+    costs: Dict[str, int] = {
+        "create": 10,
+        "batch": 5,
+        "state": 1,
+        "bulk_state": 5,
+        "snapshot": 5,
+        "revert": 5,
+    }
+    # seconds to wait on redis before using in-process buckets
+    timeout: float = 0.25
+
+
+class IdempotencyConfig(BaseModel):
+    # seconds the response of a request with an Idempotency-Key is kept
+    ttl: int = 86400
+    # seconds a key stays claimed by a request that never finished
+    pending_ttl: int = 120
+    # seconds a duplicate waits for the first request to finish
+    wait: float = 5.0
+    poll: float = 0.05
+
+
+class JobsConfig(BaseModel):
+    # seconds the state and log of a job are kept after their last change
+    ttl: int = 86400
+    # lines of the log of a job kept, the oldest are dropped
+    max_lines: int = 5000
+    # seconds between two writes of the state of a running job
+    interval: float = 1.0
+
+
+class AddressConfig(BaseModel):
+    # where the addresses of domains IPAM didn't assign are looked up, in
+    # order: libvirt's DHCP leases, the host's ARP table, the guest agent
+    sources: list[Literal["lease", "arp", "agent"]] = ["lease", "arp", "agent"]
+    # seconds a found address is reused, lifecycle events drop it earlier
+    ttl: int = 300
+    # seconds before a domain without a known address is asked again
+    miss_ttl: int = 15
+
+
+class ConsoleConfig(BaseModel):
+    # consoles relayed at the same time by an API process
+    max_sessions: int = 512
+    # bytes read from a VNC server at once, per console
+    buffer_size: int = 65536
+    connect_timeout: float = 5.0
+
+
+class ResilienceConfig(BaseModel):
+    # seconds a hypervisor call of each kind may take, it's given up on (and
+    # counted as a failure of the host) after that
+    deadlines: Dict[str, float] = {
+        "connect": 10.0,
+        "read": 5.0,
+        "list": 15.0,
+        "write": 120.0,
+        "snapshot": 300.0,
+    }
+    default_deadline: float = 30.0
+    # consecutive failures opening the breaker of a host, and seconds its
+    # calls then fail right away before one is let through again
+    failure_threshold: int = 5
+    reset_after: float = 10.0
+    # reads still running after the hedge_quantile of their kind's latency
+    # are sent again on a second connection, the first answer wins
+    hedge: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_samples: int = 20
+    hedge_min_delay: float = 0.02
+
+
+class InventoryConfig(BaseModel):
+    # the worker publishes the domains of every host to `path`, API workers
+    # list from there instead of asking the hypervisors each
+    enabled: bool = False
+    path: str = "/dev/shm/hyperk-inventory"
+    # bytes of payload the file starts with, it grows as needed
+    capacity: int = 4 << 20
+    # seconds between listings, or since the last one when a domain changed
+    # state
+    interval: float = 10.0
+    min_interval: float = 1.0
+    # hosts listed longer ago are asked directly
+    max_age: float = 60.0
+
+
+class PerformanceProfile(BaseModel):
+    """How the instance disk and NICs are driven. Unset fields keep what
+    the domain template says."""
+    # virtio-blk, or a virtio-scsi controller
+    bus: Literal["virtio", "scsi"] = "virtio"
+    cache: Optional[Literal["none", "writeback", "writethrough", "directsync",
+                            "unsafe"]] = None
+    io: Optional[Literal["threads", "native", "io_uring"]] = None
+    # pass the guest's TRIM down to the image, keeping it sparse
+    discard: Optional[Literal["unmap", "ignore"]] = None
+    # the disk (or its controller) runs on an I/O thread of its own instead
+    # of QEMU's main loop
+    iothread: bool = False
+    # virtio-net queues, 0 for one per vCPU, never more than the vCPUs
+    queues: int = 1
+    # packets handled by the host kernel instead of QEMU
+    vhost: bool = False
+
+    @model_validator(mode="after")
+    def check_combination(self) -> PerformanceProfile:
+        # native AIO needs O_DIRECT, QEMU refuses it on the page cache
+        if self.io == "native" and self.cache not in ("none", "directsync"):
+            raise ValueError("io native needs cache none or directsync")
+        if self.queues < 0:
+            raise ValueError("queues can't be negative")
+        return self
+
+
+PROFILES = {
+    # as the template has it
+    "standard":
+        PerformanceProfile(),
+    "disk":
+        PerformanceProfile(cache="none",
+                           io="native",
+                           discard="unmap",
+                           iothread=True),
+    "network":
+        PerformanceProfile(queues=0, vhost=True),
+    "performance":
+        PerformanceProfile(bus="scsi",
+                           cache="none",
+                           io="io_uring",
+                           discard="unmap",
+                           iothread=True,
+                           queues=0,
+                           vhost=True),
+}
+
+
+class QosTier(BaseModel):
+    """Disk and network limits of the instances of a tier, None for no
+    limit. Bursts may exceed the sustained rates for a second."""
+    # of every disk, reads and writes together
+    disk_iops: Optional[int] = None
+    disk_iops_burst: Optional[int] = None
+    # MiB/s
+    disk_bandwidth: Optional[int] = None
+    disk_bandwidth_burst: Optional[int] = None
+    # Mbit/s of every NIC, each way
+    net_average: Optional[int] = None
+    net_peak: Optional[int] = None
+    # MiB sent at net_peak before falling back to net_average
+    net_burst: Optional[int] = None
+
+    @model_validator(mode="after")
+    def check_limits(self) -> QosTier:
+        for name, value in self:
+            if value is not None and value <= 0:
+                raise ValueError(f"{name} must be positive")
+        for rate, burst in (("disk_iops", "disk_iops_burst"),
+                            ("disk_bandwidth", "disk_bandwidth_burst"),
+                            ("net_average", "net_peak")):
+            if getattr(self, burst) is not None and getattr(self, rate) is None:
+                raise ValueError(f"{burst} needs {rate}")
+        return self
+
+
+QOS_TIERS = {
+    "bronze":
+        QosTier(disk_iops=500,
+                disk_iops_burst=1000,
+                disk_bandwidth=50,
+                disk_bandwidth_burst=100,
+                net_average=50,
+                net_peak=100,
+                net_burst=16),
+    "silver":
+        QosTier(disk_iops=2000,
+                disk_iops_burst=4000,
+                disk_bandwidth=150,
+                disk_bandwidth_burst=300,
+                net_average=200,
+                net_peak=400,
+                net_burst=64),
+    "gold":
+        QosTier(disk_iops=8000,
+                disk_iops_burst=16000,
+                disk_bandwidth=500,
+                disk_bandwidth_burst=1000,
+                net_average=1000,
+                net_peak=2000,
+                net_burst=256),
+}
+
+
+class HostConfig(BaseModel):
+    name: str
+    uri: str
+    # capacity of this host, defaults to the global maxvcpus/maxram
+    maxvcpus: Optional[int] = None
+    maxram: Optional[str] = None
+    maxdisk: Optional[str] = None
+    # domain template of this host, defaults to the global domain_template
+    domain_template: Optional[str] = None
+    # provisioning slots of this host, default to the global ones
+    provision_concurrency: Optional[int] = None
+    disk_concurrency: Optional[int] = None
+    # address the API reaches the VNC servers of this host on, defaults to
+    # their listen address, loopback when they listen on every interface
+    console_address: Optional[str] = None
+    # cpuset (e.g. 4-15,20-31) handed out to dedicated instances a core at a
+    # time, every other instance runs on the other CPUs. None takes no
+    # dedicated instances
+    dedicated_cpus: Optional[str] = None
+
+
+class QuotaConfig(BaseModel):
+    # per user limits, unset means unlimited
+    vcpu: Optional[int] = None
+    ram: Optional[str] = None
+    disk: Optional[str] = None
+
+
 class Config(BaseModel):
     env: Literal["development", "production"]
 
-    libvirt: str
+    # single hypervisor shorthand, used when no hosts are configured
+    libvirt: Optional[str] = None
+    hosts: list[HostConfig] = []
+    placement: Literal["pack", "spread"] = "spread"
+    # seconds between two refreshes of the host capacity index
+    capacity_refresh: int = 30
+
     db: str
+    redis: str = "redis://127.0.0.1:6379"
 
     session_secret: str
     jwt_secret: str
@@ -37,10 +342,79 @@ class Config(BaseModel):
 
     maxvcpus: int
     maxram: str
+    maxdisk: Optional[str] = None
+    quota: QuotaConfig = QuotaConfig()
+
+    # provisioning stages running at the same time on a host, and how many
+    # of them may copy a full disk image
+    provision_concurrency: int = 8
+    disk_concurrency: int = 2
+    # seconds a booted guest gets to take a DHCP lease, then to open SSH,
+    # before its create fails and frees its slot
+    lease_timeout: float = 300.0
+    ssh_ready_timeout: float = 600.0
+    # number of concurrent libvirt calls issued against a single host
+    host_concurrency: int = 8
 
     network: NetworkConfig
 
     images: Dict[str, BaseImage]
+    image_dir: str = "/usr/local/var/lib/libvirt/images"
+    # shared part of every domain definition, templates/default.xml on KVM
+    domain_template: str = "task/template.xml"
+
+    reconcile: ReconcileConfig = ReconcileConfig()
+
+    ratelimit: RateLimitConfig = RateLimitConfig()
+    idempotency: IdempotencyConfig = IdempotencyConfig()
+    jobs: JobsConfig = JobsConfig()
+    console: ConsoleConfig = ConsoleConfig()
+    addresses: AddressConfig = AddressConfig()
+    resilience: ResilienceConfig = ResilienceConfig()
+    inventory: InventoryConfig = InventoryConfig()
+    # performance profiles instances choose from, by name
+    profiles: Dict[str, PerformanceProfile] = PROFILES
+    default_profile: str = "standard"
+    # QoS tiers of instances, an instance is in its own tier, else in its
+    # owner's, else in default_qos. None is unlimited
+    qos: Dict[str, QosTier] = QOS_TIERS
+    default_qos: Optional[str] = None
+
+    @model_validator(mode="after")
+    def check_hosts(self) -> Config:
+        if not self.hosts:
+            if self.libvirt is None:
+                raise ValueError("either libvirt or hosts must be configured")
+            self.hosts = [HostConfig(name="default", uri=self.libvirt)]
+        names = [host.name for host in self.hosts]
+        if len(set(names)) != len(names):
+            raise ValueError("host names must be unique")
+        return self
+
+    @model_validator(mode="after")
+    def check_profiles(self) -> Config:
+        if self.default_profile not in self.profiles:
+            raise ValueError(f"unknown default_profile {self.default_profile}")
+        return self
+
+    @model_validator(mode="after")
+    def check_qos(self) -> Config:
+        if self.default_qos is not None and self.default_qos not in self.qos:
+            raise ValueError(f"unknown default_qos {self.default_qos}")
+        return self
+
+    def get_host(self, name: str) -> HostConfig:
+        for host in self.hosts:
+            if host.name == name:
+                return host
+        raise KeyError(name)
+
+    def get_domain_template(self, host: str) -> str:
+        return self.get_host(host).domain_template or self.domain_template
+
+    @property
+    def default_host(self) -> str:
+        return self.hosts[0].name
 
     @property
     def base_url(self) -> str:
@@ -51,11 +425,11 @@ class Config(BaseModel):
 
 
 def parse_config(path: str = "config.yaml") -> Config:
-    with open("config.yaml", "r") as f:
+    with open(path, "r") as f:
         o = yaml.safe_load(f)
     return Config.model_validate(o)
 
 
 @lru_cache
 def get_config() -> Config:
-    return parse_config()
\ No newline at end of file
+    return parse_config()
@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from typing import Any
+
+from arq import cron
+from arq.connections import RedisSettings
+
+from app.db import get_address_resolver
+from app.db import get_ledger
+from app.db import get_sessionmaker
+from app.db import get_virt_pool
+from app.service.inventory import InventoryPublisher
+from app.service.reconciler import Reconciler
+from app.settings import get_config
+
+logger = logging.getLogger(__name__)
+
+config = get_config()
+
+
+async def startup(ctx: dict[str, Any]) -> None:
+    ctx["reconciler"] = Reconciler(
+        get_virt_pool(),
+        get_sessionmaker(),
+        config.reconcile,
+        config.image_dir,
+        [str(image.path) for image in config.images.values()],
+    )
+    if config.inventory.enabled:
+        # both watch lifecycle events, before the pool opens a connection
+        publisher = InventoryPublisher(get_virt_pool(), get_address_resolver(),
+                                       config.inventory)
+        get_virt_pool().watch(publisher.on_lifecycle)
+        ctx["inventory"] = asyncio.create_task(publisher.run())
+
+
+async def shutdown(ctx: dict[str, Any]) -> None:
+    if "inventory" in ctx:
+        ctx["inventory"].cancel()
+
+
+async def reconcile(ctx: dict[str, Any]) -> None:
+    report = await ctx["reconciler"].run()
+    await ctx["redis"].hset("reconcile:metrics", mapping=report.metrics())
+    # rebuilt after the instances table caught up with the hypervisors
+    await get_ledger().reconcile(get_virt_pool(), get_sessionmaker())
+
+
+class WorkerSettings:
+    functions: list[Any] = []
+    cron_jobs = [
+        cron(
+            reconcile,
+            minute=set(range(0, 60, config.reconcile.interval)),
+            run_at_startup=True,
+            unique=True,
+        ),
+    ]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(config.redis)
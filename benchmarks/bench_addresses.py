@@ -0,0 +1,107 @@
+"""Address lookups paid by a listing of running domains.
+
+Lists --count running domains attached to a bridge, where libvirt serves no
+DHCP and the address comes from the host's ARP table. Every
+interfaceAddresses call sleeps --rpc milliseconds, a round trip to the
+hypervisor.
+
+- lease, uncached: what listings did before, one lease query per domain
+  every time, and no address on a bridge
+- cached, cold: the first listing, lease then ARP per domain
+- cached, warm: every listing within the TTL
+- after events: 1% of the domains restarted since, their entries dropped
+
+    python -m benchmarks.bench_addresses [--count N] [--rpc MS]
+"""
+import argparse
+import time
+from typing import Any
+from uuid import UUID
+from uuid import uuid4
+
+import libvirt
+
+from app.service.addresses import AddressResolver
+from app.service.inventory import domain_fields
+from app.settings import AddressConfig
+
+
+class FakeDomain:
+
+    def __init__(self, i: int, rpc: float) -> None:
+        self.uuid = str(uuid4())
+        self._name = f"vm-{i}"
+        self.mac = "52:54:00:%02x:%02x:%02x" % (i >> 16 & 255, i >> 8 & 255,
+                                                i & 255)
+        self.ip = f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+        self.rpc = rpc
+        self.rpcs = 0
+
+    def name(self) -> str:
+        return self._name
+
+    def UUIDString(self) -> str:
+        return self.uuid
+
+    def info(self) -> list[int]:
+        return [libvirt.VIR_DOMAIN_RUNNING, 4194304, 4194304, 2, 0]
+
+    def maxVcpus(self) -> int:
+        return 2
+
+    def maxMemory(self) -> int:
+        return 4194304
+
+    def interfaceAddresses(self, source: int) -> dict[str, Any]:
+        self.rpcs += 1
+        time.sleep(self.rpc)
+        if source != libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP:
+            return {}
+        addr = {
+            "type": libvirt.VIR_IP_ADDR_TYPE_IPV4,
+            "addr": self.ip,
+            "prefix": 24,
+        }
+        return {"vnet0": {"hwaddr": self.mac, "addrs": [addr]}}
+
+
+def listing(domains: list[FakeDomain],
+            resolver: AddressResolver) -> tuple[float, int, int]:
+    before = sum(domain.rpcs for domain in domains)
+    start = time.perf_counter()
+    fields = [domain_fields(domain, None, resolver) for domain in domains]
+    elapsed = time.perf_counter() - start
+    found = sum(1 for f in fields if f["ip"])
+    return elapsed, sum(domain.rpcs for domain in domains) - before, found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--rpc", type=float, default=0.2)
+    args = parser.parse_args()
+
+    domains = [FakeDomain(i, args.rpc / 1000) for i in range(args.count)]
+    uncached = AddressResolver(
+        AddressConfig(sources=["lease"], ttl=0, miss_ttl=0))
+    cached = AddressResolver(AddressConfig(sources=["lease", "arp"]))
+
+    print(f"{args.count} running domains on a bridge, "
+          f"{args.rpc} ms per address RPC")
+    print(f"{'':<20} {'ms':>10} {'rpcs':>8} {'with ip':>8}")
+
+    def report(label: str, result: tuple[float, int, int]) -> None:
+        elapsed, rpcs, found = result
+        print(f"{label:<20} {elapsed * 1000:10.1f} {rpcs:8d} {found:8d}")
+
+    report("lease, uncached", listing(domains, uncached))
+    report("cached, cold", listing(domains, cached))
+    report("cached, warm", listing(domains, cached))
+    for domain in domains[::100]:
+        cached.on_lifecycle("default", UUID(domain.uuid),
+                            libvirt.VIR_DOMAIN_EVENT_STARTED)
+    report("after events", listing(domains, cached))
+
+
+if __name__ == "__main__":
+    main()
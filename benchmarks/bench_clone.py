@@ -0,0 +1,92 @@
+"""Full-copy disk cloning against the plain copy it replaced.
+
+Creates a large sparse file, mostly holes with some scattered data like a
+freshly built base image, then clones it with shutil.copyfile and with each
+clone method on its own. Run it on the filesystem holding the images, a
+reflink only works within a filesystem that supports it (btrfs, XFS).
+
+    python -m benchmarks.bench_clone [--dir DIR] [--size GiB] [--data MiB]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from app.service.clone import clone_file
+
+EXTENT = 4 << 20
+
+
+def make_sparse(path: str, size: int, data: int) -> list[int]:
+    rng = random.Random(0)
+    block = os.urandom(EXTENT)
+    offsets = [
+        rng.randrange(0, size - EXTENT, 4096) for _ in range(data // EXTENT)
+    ]
+    with open(path, "wb") as f:
+        f.truncate(size)
+        for offset in offsets:
+            f.seek(offset)
+            f.write(block)
+    return offsets
+
+
+def same(src: str, dst: str, offsets: list[int]) -> bool:
+    if os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    with open(src, "rb") as a, open(dst, "rb") as b:
+        for offset in offsets:
+            a.seek(offset)
+            b.seek(offset)
+            if a.read(EXTENT) != b.read(EXTENT):
+                return False
+    return True
+
+
+def allocated(path: str) -> int:
+    return os.stat(path).st_blocks * 512
+
+
+def report(label: str, size: int, elapsed: float, written: int,
+           dst: str) -> None:
+    print(f"{label:<18} {elapsed:8.3f} s {size / elapsed / (1 << 30):8.2f} "
+          f"GiB/s  written {written >> 20:6d} MiB  "
+          f"allocated {allocated(dst) >> 20:6d} MiB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", default=None)
+    parser.add_argument("--size", type=int, default=4, help="GiB")
+    parser.add_argument("--data", type=int, default=256, help="MiB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        src = os.path.join(tmp, "base.img")
+        size = args.size << 30
+        offsets = make_sparse(src, size, args.data << 20)
+        print(f"source: {size >> 30} GiB apparent, "
+              f"{allocated(src) >> 20} MiB allocated")
+
+        dst = os.path.join(tmp, "copyfile.img")
+        start = time.perf_counter()
+        shutil.copyfile(src, dst)
+        report("shutil.copyfile", size, time.perf_counter() - start, size, dst)
+        os.unlink(dst)
+
+        for methods in [("reflink",), ("copy_file_range",), ("sparse",)]:
+            dst = os.path.join(tmp, f"{methods[0]}.img")
+            try:
+                result = clone_file(src, dst, methods)
+            except ValueError:
+                print(f"{methods[0]:<18} unsupported here")
+                continue
+            report(result.method, size, result.elapsed, result.written, dst)
+            assert same(src, dst, offsets), f"{result.method} copy differs"
+            os.unlink(dst)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Console relay throughput and latency against a local echo server.
+
+Serves ConsoleProxy from uvicorn in a separate process, relaying to a TCP
+echo server standing in for VNC, and opens a growing number of consoles to
+it at once. The same load against a WebSocket echoing in the endpoint
+itself is the baseline, what uvicorn and the client cost without a relay.
+Every console:
+
+- streams --size MiB in --chunk KiB messages and reads them back, the
+  aggregate rate is what a framebuffer heavy session would see
+- then sends --pings small messages one at a time, the round trip of a
+  keystroke
+
+    python -m benchmarks.bench_console [--consoles 1,50,200] [--size 8]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import socket
+import statistics
+import time
+
+from fastapi import FastAPI
+from fastapi import WebSocket
+import uvicorn
+import websockets
+
+from app.service.console import ConsoleProxy
+from app.settings import ConsoleConfig
+
+
+async def echo(reader: asyncio.StreamReader,
+               writer: asyncio.StreamWriter) -> None:
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(port: int, echo_port: int, max_sessions: int) -> None:
+    proxy = ConsoleProxy(ConsoleConfig(max_sessions=max_sessions))
+    app = FastAPI()
+
+    @app.websocket("/console")
+    async def console(websocket: WebSocket) -> None:
+        await proxy.serve(websocket, "127.0.0.1", echo_port)
+
+    @app.websocket("/echo")
+    async def baseline(websocket: WebSocket) -> None:
+        await websocket.accept()
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            await websocket.send_bytes(message["bytes"])
+
+    async def main() -> None:
+        await asyncio.start_server(echo, "127.0.0.1", echo_port)
+        config = uvicorn.Config(app,
+                                port=port,
+                                log_level="warning",
+                                ws_max_size=1 << 24,
+                                backlog=4096)
+        await uvicorn.Server(config).serve()
+
+    asyncio.run(main())
+
+
+async def stream(url: str, size: int, chunk: int, pings: int,
+                 latencies: list[float]) -> None:
+    message = bytes(chunk)
+    async with websockets.connect(url, max_size=None) as ws:
+
+        async def send() -> None:
+            for _ in range(size // chunk):
+                await ws.send(message)
+
+        async def receive() -> None:
+            received = 0
+            while received < size:
+                received += len(await ws.recv())
+
+        await asyncio.gather(send(), receive())
+
+        for _ in range(pings):
+            start = time.perf_counter()
+            await ws.send(b"k" * 8)
+            await ws.recv()
+            latencies.append(time.perf_counter() - start)
+
+
+async def run(label: str, url: str, consoles: int, size: int, chunk: int,
+              pings: int) -> None:
+    latencies: list[float] = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(stream(url, size, chunk, pings, latencies) for _ in range(consoles)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{label:<8} {consoles:>8} {consoles * size / elapsed / (1 << 20):10.0f} "
+        f"{size / elapsed / (1 << 20):12.1f} "
+        f"{statistics.median(latencies) * 1000:8.2f} {p99 * 1000:8.2f}")
+
+
+async def wait_for(port: int) -> None:
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+    raise RuntimeError("the proxy didn't start")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--consoles", default="1,50,200")
+    # MiB streamed per console
+    parser.add_argument("--size", type=int, default=8)
+    # KiB per message
+    parser.add_argument("--chunk", type=int, default=64)
+    parser.add_argument("--pings", type=int, default=20)
+    args = parser.parse_args()
+
+    counts = [int(n) for n in args.consoles.split(",")]
+    port, echo_port = free_port(), free_port()
+    server = multiprocessing.Process(target=serve,
+                                     args=(port, echo_port, max(counts)),
+                                     daemon=True)
+    server.start()
+    try:
+        asyncio.run(wait_for(port))
+        print(f"{args.size} MiB per console in {args.chunk} KiB messages")
+        print(f"{'':<8} {'consoles':>8} {'MiB/s':>10} {'MiB/s each':>12} "
+              f"{'rtt p50':>8} {'rtt p99':>8}")
+        for consoles in counts:
+            for label in ("echo", "console"):
+                asyncio.run(
+                    run(label, f"ws://127.0.0.1:{port}/{label}", consoles,
+                        args.size << 20, args.chunk << 10, args.pings))
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Cold import cost of the API and the provisioning helpers.
+
+Imports each module in a fresh interpreter under `-X importtime`, prints the
+cumulative time and the slowest imports, and exits non-zero when a module
+goes over its budget or pulls in a dependency that should only be loaded on
+first use.
+
+    python -m benchmarks.bench_importtime [--budget MS] [--runs N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+MODULES = ["app.main", "app.db", "app.settings"]
+
+# only needed once a request actually talks to a hypervisor or Google
+LAZY = ["libvirt", "requests_oauthlib"]
+
+DEFAULT_BUDGET_MS = 800
+
+
+def importtime(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every module imported."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        env={
+            **os.environ, "PYTHONDONTWRITEBYTECODE": "1"
+        },
+    )
+    times: dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget",
+                        type=int,
+                        default=int(
+                            os.environ.get("IMPORT_BUDGET_MS",
+                                           DEFAULT_BUDGET_MS)),
+                        help="maximum cumulative import time of app.main")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        runs = [importtime(module) for _ in range(args.runs)]
+        # the best run is the least disturbed by the rest of the machine
+        best = min(runs, key=lambda t: t[module])
+        total = best[module] / 1000
+        print(f"{module:<16} {total:8.1f} ms")
+
+        top = sorted(((t, n) for n, t in best.items() if n != module),
+                     reverse=True)
+        for t, name in top[:5]:
+            print(f"    {name:<40} {t / 1000:8.1f} ms")
+
+        for name in LAZY:
+            if name in best:
+                print(f"    FAIL: {name} is imported eagerly")
+                failed = True
+
+        if module == "app.main" and total > args.budget:
+            print(f"    FAIL: over the {args.budget} ms budget")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
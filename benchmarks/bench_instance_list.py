@@ -0,0 +1,118 @@
+"""Per-user instance listing cost against host size.
+
+Runs InstanceList against an in-memory database and a simulated hypervisor
+connection that counts RPCs, for a growing number of domains on the host and
+a growing number of domains owned by the listing user.
+
+    python -m benchmarks.bench_instance_list
+"""
+import asyncio
+import time
+from uuid import UUID
+from uuid import uuid4
+
+import libvirt
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.api.instance.use_cases import InstanceList
+from app.models import Base
+from app.models import Instance
+from app.models import User
+from app.service.addresses import AddressResolver
+from app.service.virt import Virt
+from app.service.virt import VirtPool
+from app.settings import AddressConfig
+
+
+class FakeDomain:
+
+    def __init__(self, conn: "FakeConnection", name: str) -> None:
+        self.conn = conn
+        self.uuid = str(uuid4())
+        self._name = name
+
+    def name(self) -> str:
+        return self._name
+
+    def UUIDString(self) -> str:
+        return self.uuid
+
+    def info(self) -> list[int]:
+        self.conn.rpcs += 1
+        return [libvirt.VIR_DOMAIN_SHUTOFF, 1048576, 1048576, 1, 0]
+
+    def hasManagedSaveImage(self, flags: int) -> int:
+        self.conn.rpcs += 1
+        return 0
+
+
+class FakeConnection:
+
+    def __init__(self, count: int) -> None:
+        self.rpcs = 0
+        self.domains = {}
+        for i in range(count):
+            domain = FakeDomain(self, f"vm-{i}")
+            self.domains[domain.uuid] = domain
+
+    def listAllDomains(self) -> list[FakeDomain]:
+        self.rpcs += len(self.domains)
+        return list(self.domains.values())
+
+    def lookupByUUIDString(self, uuid: str) -> FakeDomain:
+        self.rpcs += 1
+        return self.domains[uuid]
+
+
+async def bench(host_size: int, owned: int) -> tuple[float, int]:
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_maker = async_sessionmaker[AsyncSession](bind=engine,
+                                                     autoflush=False,
+                                                     expire_on_commit=False)
+
+    fake = FakeConnection(host_size)
+    # never connected to libvirt's test driver, the counting connection
+    # stands in for it
+    virt = Virt("test:///default")
+    virt.conn = fake  # type: ignore
+    virt.connected = True
+
+    async with session_maker() as session:
+        user = User(id=1, username="bench", realname="bench", is_admin=False)
+        session.add(user)
+        await session.commit()
+        domains = list(fake.domains.values())[:owned]
+        await Instance.bulk_create(
+            session, user,
+            [(UUID(d.uuid), d.name(), "default") for d in domains])
+
+    pool = VirtPool({"default": "test:///default"})
+    pool._conns["default"] = virt
+
+    # listed from the hypervisor, not a shared inventory
+    use_case = InstanceList(session_maker, pool,
+                            AddressResolver(AddressConfig()), None)
+    fake.rpcs = 0
+    start = time.perf_counter()
+    listed = [instance async for instance in use_case.execute(user)]
+    elapsed = time.perf_counter() - start
+    assert len(listed) == owned
+
+    await engine.dispose()
+    return elapsed, fake.rpcs
+
+
+async def main() -> None:
+    print(f"{'host':>8} {'owned':>8} {'ms':>10} {'rpcs':>8}")
+    for host_size, owned in [(1000, 10), (10000, 10), (50000, 10), (10000, 100),
+                             (10000, 1000)]:
+        elapsed, rpcs = await bench(host_size, owned)
+        print(f"{host_size:>8} {owned:>8} {elapsed * 1000:>10.2f} {rpcs:>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+"""Cost of sharing the inventory through the mapped snapshot.
+
+For a growing number of domains:
+
+- publish: encoding the listing and copying it into the file, paid by the
+  worker once per listing
+- size: of the payload, per domain
+- decode: reading a new snapshot, paid by every API worker once per
+  snapshot published
+- read: every other read, the snapshot didn't change
+
+Then --readers processes read in a loop while the writer publishes every
+--every ms, reads per second and snapshots decoded show what readers pay
+for the lock-free protocol.
+
+    python -m benchmarks.bench_inventory [--readers N] [--every MS]
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Any, Callable
+from uuid import uuid4
+
+from app.service.inventory import encode
+from app.service.inventory import HostInventory
+from app.service.inventory import InventoryReader
+from app.service.inventory import InventoryWriter
+
+
+def inventory(count: int) -> dict[str, HostInventory]:
+    domains = {}
+    for i in range(count):
+        id = uuid4()
+        domains[id] = {
+            "id": id,
+            "name": f"vm-{i}",
+            "ip": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+            "vcpu": 2,
+            "ram": "4194304",
+            "state": "running",
+        }
+    return {"default": HostInventory(time.time(), domains)}
+
+
+def per_call(fn: Callable[[], Any], n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def costs(path: str, counts: list[int]) -> None:
+    print(f"{'domains':>8} {'publish ms':>11} {'B/domain':>9} "
+          f"{'decode ms':>10} {'read us':>8}")
+    for count in counts:
+        hosts = inventory(count)
+        writer = InventoryWriter(path, 1 << 20)
+        payload = encode(hosts)
+        publish = per_call(lambda: writer.publish(encode(hosts)), 20)
+        reader = InventoryReader(path, 60)
+
+        def changed() -> None:
+            # a new reader decodes what it maps
+            InventoryReader(path, 60).read()
+
+        decode = per_call(changed, 20)
+        reader.read()
+        read = per_call(reader.read, 100000)
+        writer.close()
+        print(f"{count:>8} {publish * 1000:>11.2f} "
+              f"{len(payload) / count:>9.1f} {decode * 1000:>10.2f} "
+              f"{read * 1e6:>8.2f}")
+
+
+def read_loop(path: str, seconds: float, results) -> None:
+    reader = InventoryReader(path, 60)
+    reads = decoded = 0
+    seen = -1
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        reader.read()
+        reads += 1
+        if reader.sequence != seen:
+            seen = reader.sequence
+            decoded += 1
+    results.put((reads, decoded))
+
+
+def contention(path: str, count: int, readers: int, every: float,
+               seconds: float) -> None:
+    hosts = inventory(count)
+    writer = InventoryWriter(path, 1 << 20)
+    writer.publish(encode(hosts))
+    published = 1
+    results: multiprocessing.Queue = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=read_loop, args=(path, seconds, results))
+        for _ in range(readers)
+    ]
+    for proc in procs:
+        proc.start()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        writer.publish(encode(hosts))
+        published += 1
+        time.sleep(every)
+    totals = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    writer.close()
+    reads = sum(reads for reads, _ in totals)
+    decoded = sum(decoded for _, decoded in totals) / readers
+    print(f"\n{readers} readers on {os.cpu_count()} CPUs, {count} domains, "
+          f"a snapshot every {every * 1000:.0f} ms: "
+          f"{reads / seconds / readers:,.0f} reads/s each, "
+          f"{decoded:.0f} of {published} snapshots decoded each")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="1000,10000,50000")
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--every", type=float, default=100.0)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(
+            dir="/dev/shm" if os.path.isdir("/dev/shm") else None) as tmp:
+        path = os.path.join(tmp, "inventory")
+        costs(path, [int(n) for n in args.counts.split(",")])
+        contention(path, 10000, args.readers, args.every / 1000, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Performance profiles: do they render, and what do they buy.
+
+The validation matrix renders every profile of config.yaml with every
+domain template given, and with --uri has libvirt validate the definition
+against its schema and the host's QEMU (defined under a generated name no
+domain of the host has, then undefined again).
+
+With --guest PROFILE=IP for instances created with each profile, runs fio
+and iperf3 in them over ssh, iperf3 against --iperf-server:
+
+    python -m benchmarks.bench_profiles [--template PATH ...] [--uri URI]
+        [--guest standard=10.0.0.5 --guest performance=10.0.0.6
+         --iperf-server 10.0.0.1]
+
+The guests need fio and iperf3, and root's key, the server `iperf3 -s`.
+"""
+import argparse
+import json
+import subprocess
+import sys
+from typing import Optional
+from uuid import uuid4
+
+import libvirt
+
+from app.service.domain import DomainSpec
+from app.service.domain import InvalidDomain
+from app.service.domain import load_template
+from app.service.domain import Nic
+from app.settings import get_config
+from app.settings import PerformanceProfile
+
+FIO = [
+    "fio", "--name=bench", "--filename=/var/tmp/fio", "--size=1G", "--direct=1",
+    "--ioengine=libaio", "--runtime=20", "--time_based", "--group_reporting",
+    "--output-format=json"
+]
+# random 4k at depth 32, and sequential 1M
+FIO_JOBS = {
+    "randread": ["--rw=randread", "--bs=4k", "--iodepth=32", "--numjobs=4"],
+    "randwrite": ["--rw=randwrite", "--bs=4k", "--iodepth=32", "--numjobs=4"],
+    "read": ["--rw=read", "--bs=1M", "--iodepth=8"],
+}
+
+
+def render(template: str, profile: PerformanceProfile, name: str) -> str:
+    spec = DomainSpec(name=name,
+                      vcpu=4,
+                      ram=4 << 20,
+                      disk=f"/var/lib/libvirt/images/{name}",
+                      nics=[Nic(mac="52:54:00:00:00:01", source="default")],
+                      performance=profile)
+    return load_template(template).render(spec)
+
+
+def is_defined(conn: libvirt.virConnect, name: str) -> bool:
+    try:
+        conn.lookupByName(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            return False
+        raise
+    return True
+
+
+def validate(templates: list[str], profiles: dict[str, PerformanceProfile],
+             uri: Optional[str]) -> None:
+    # defined and undefined on the host, never one of its domains
+    domain = f"bench-profile-{uuid4().hex[:12]}"
+    conn = None
+    if uri is not None:
+        conn = libvirt.open(uri)
+        if is_defined(conn, domain):
+            conn.close()
+            sys.exit(f"a domain named {domain} exists already")
+    print(f"{'template':<32} {'profile':<14} result")
+    for template in templates:
+        for name, profile in profiles.items():
+            try:
+                xml = render(template, profile, domain)
+                if conn is not None:
+                    conn.defineXMLFlags(
+                        xml, libvirt.VIR_DOMAIN_DEFINE_VALIDATE).undefine()
+                result = "ok"
+            except InvalidDomain as e:
+                result = f"invalid: {e}"
+            except Exception as e:
+                result = f"rejected: {e}"
+            print(f"{template:<32} {name:<14} {result}")
+    if conn is not None:
+        conn.close()
+
+
+def ssh(ip: str, command: list[str]) -> str:
+    return subprocess.run(["ssh", "-o", "BatchMode=yes", f"root@{ip}", "--"] +
+                          command,
+                          check=True,
+                          capture_output=True,
+                          text=True).stdout
+
+
+def fio(ip: str, args: list[str]) -> tuple[float, float]:
+    """IOPS and mean completion latency (us) of a run."""
+    job = json.loads(ssh(ip, FIO + args))["jobs"][0]
+    side = job["read"] if job["read"]["io_bytes"] else job["write"]
+    return side["iops"], side["clat_ns"]["mean"] / 1000
+
+
+def iperf(ip: str, server: str, streams: int) -> float:
+    """Gbit/s received by the server."""
+    result = json.loads(
+        ssh(ip, ["iperf3", "-J", "-c", server, "-t", "10", "-P",
+                 str(streams)]))
+    return result["end"]["sum_received"]["bits_per_second"] / 1e9
+
+
+def measure(guests: dict[str, str], server: Optional[str],
+            streams: int) -> None:
+    columns = [f"{job} IOPS/us" for job in FIO_JOBS]
+    if server is not None:
+        columns.append(f"iperf3 x{streams} Gbit/s")
+    print("\n" + f"{'profile':<14}" + "".join(f"{c:>22}" for c in columns))
+    for name, ip in guests.items():
+        row = []
+        for args in FIO_JOBS.values():
+            iops, latency = fio(ip, args)
+            row.append(f"{iops:,.0f}/{latency:,.0f}")
+        if server is not None:
+            row.append(f"{iperf(ip, server, streams):.2f}")
+        print(f"{name:<14}" + "".join(f"{v:>22}" for v in row))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--template", action="append")
+    parser.add_argument("--uri")
+    parser.add_argument("--guest", action="append", default=[])
+    parser.add_argument("--iperf-server")
+    parser.add_argument("--streams", type=int, default=4)
+    args = parser.parse_args()
+
+    config = get_config()
+    templates = args.template or sorted(
+        {config.get_domain_template(host.name) for host in config.hosts})
+    validate(templates, config.profiles, args.uri)
+    if args.guest:
+        guests = dict(guest.split("=", 1) for guest in args.guest)
+        measure(guests, args.iperf_server, args.streams)
+
+
+if __name__ == "__main__":
+    main()
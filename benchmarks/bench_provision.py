@@ -0,0 +1,65 @@
+"""Fixed overhead of a create, paid before any provisioning work and on
+top of it. None of the rows include the create itself (disk, define,
+boot, ansible), which is the same either way.
+
+- spawn: starting an interpreter, importing libvirt, pydantic and the app
+  and parsing config.yaml, what a createvm.py process per instance paid
+- connect: opening a connection to the hypervisor, also per instance
+- per process: the two together, the overhead of the old path
+- pool lookup: the overhead left in-process, finding the open connection
+  of the host in the pool, modules being loaded already
+
+    python -m benchmarks.bench_provision [--count N] [--uri URI]
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+from typing import Any, Callable
+
+import libvirt
+
+from app.service.virt import VirtPool
+
+SPAWN = "import createvm; createvm.get_config()"
+
+
+def per_call(fn: Callable[[], Any], n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+async def per_lookup(pool: VirtPool, n: int) -> float:
+    await pool.connect("default")
+    start = time.perf_counter()
+    for _ in range(n):
+        await pool.connect("default")
+    return (time.perf_counter() - start) / n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--uri", default="test:///default")
+    args = parser.parse_args()
+
+    spawn = per_call(
+        lambda: subprocess.run([sys.executable, "-c", SPAWN], check=True),
+        args.count)
+    connect = per_call(lambda: libvirt.open(args.uri).close(), args.count)
+    pool = VirtPool({"default": args.uri})
+    pooled = asyncio.run(per_lookup(pool, args.count * 1000))
+    pool.close()
+
+    print(f"{'':<12} {'overhead ms per create':>23}")
+    print(f"{'spawn':<12} {spawn * 1000:23.1f}")
+    print(f"{'connect':<12} {connect * 1000:23.1f}")
+    print(f"{'per process':<12} {(spawn + connect) * 1000:23.1f}")
+    print(f"{'pool lookup':<12} {pooled * 1000:23.4f}")
+
+
+if __name__ == "__main__":
+    main()
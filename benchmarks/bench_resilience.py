@@ -0,0 +1,184 @@
+"""Hypervisor call latency with a slow or hung libvirtd.
+
+Simulated connections stand in for libvirtd, every listAllDomains sleeping
+like an RPC would:
+
+- slow tail: --tail percent of the reads of a healthy host take --slow ms
+  instead of --rpc ms. Plain threads against Virt.read, with and without
+  hedging, what the p99 of a listing looks like.
+- hung host: one host stops answering while another is fine and both get
+  listed at once. Plain threads share the default executor, the hung calls
+  take every thread and the healthy host's wait behind them, even with a
+  timeout around each. Virt.call runs each host on its own threads, gives
+  up at the deadline and then fails fast while the breaker is open.
+
+    python -m benchmarks.bench_resilience [--reads N] [--tail PCT]
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+from app.service.resilience import HostUnavailable
+from app.service.virt import Virt
+from app.settings import ResilienceConfig
+
+
+class FakeConnection:
+
+    def __init__(self,
+                 rpc: float,
+                 slow: float = 0.0,
+                 tail: float = 0.0,
+                 hung: bool = False) -> None:
+        self.rpc = rpc
+        self.slow = slow
+        self.tail = tail
+        self.hung = hung
+        self.released = threading.Event()
+        self.rng = random.Random()
+
+    def listAllDomains(self) -> list[Any]:
+        if self.hung:
+            self.released.wait()
+        elif self.rng.random() < self.tail:
+            time.sleep(self.slow)
+        else:
+            time.sleep(self.rpc)
+        return []
+
+    def isAlive(self) -> int:
+        return 1
+
+    def close(self) -> None:
+        self.released.set()
+
+
+def make_virt(conn: FakeConnection, config: ResilienceConfig) -> Virt:
+    # never connected to libvirt's test driver, the simulated connections
+    # stand in for it
+    virt = Virt("test:///default", concurrency=16, resilience=config)
+    hedge = FakeConnection(conn.rpc, conn.slow, conn.tail)
+    virt.conn = conn  # type: ignore
+    virt.connected = True
+    virt.hedge_conn = hedge  # type: ignore
+    return virt
+
+
+def percentiles(samples: list[float]) -> str:
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    return (f"{p50 * 1000:8.1f} {p99 * 1000:8.1f} "
+            f"{samples[-1] * 1000:8.1f}")
+
+
+async def timed(call: Callable[[], Awaitable[Any]],
+                results: list[float]) -> None:
+    start = time.perf_counter()
+    try:
+        await call()
+    except (HostUnavailable, asyncio.TimeoutError):
+        pass
+    results.append(time.perf_counter() - start)
+
+
+async def slow_tail(args: argparse.Namespace) -> None:
+    rpc, slow = args.rpc / 1000, args.slow / 1000
+    print(f"slow tail: {args.reads} reads, 16 at a time, {args.tail}% "
+          f"take {args.slow} ms")
+    print(f"{'':<24} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+
+    async def run(label: str, read: Callable[[], Awaitable[Any]]) -> None:
+        results: list[float] = []
+        limit = asyncio.Semaphore(16)
+
+        async def one() -> None:
+            async with limit:
+                await timed(read, results)
+
+        await asyncio.gather(*(one() for _ in range(args.reads)))
+        print(f"{label:<24} {percentiles(results)}")
+
+    conn = FakeConnection(rpc, slow, args.tail / 100)
+    await run("threads", lambda: asyncio.to_thread(conn.listAllDomains))
+
+    virt = make_virt(FakeConnection(rpc, slow, args.tail / 100),
+                     ResilienceConfig())
+    await run("Virt.read", lambda: virt.read("list", listing))
+    virt.close()
+
+    virt = make_virt(FakeConnection(rpc, slow, args.tail / 100),
+                     ResilienceConfig(hedge=True))
+    await run("Virt.read, hedged", lambda: virt.read("list", listing))
+    print(f"{'':<24} {virt.hedges} hedged of {args.reads}")
+    virt.close()
+
+
+def listing(conn: Any) -> list[Any]:
+    return conn.listAllDomains()
+
+
+async def hung_host(args: argparse.Namespace) -> None:
+    rpc, deadline = args.rpc / 1000, args.deadline / 1000
+    print(f"\nhung host: {args.reads} listings of each host at once, "
+          f"{args.deadline} ms deadline")
+    print(f"{'':<24} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+
+    async def run(label: str, hung: Callable[[], Awaitable[Any]],
+                  healthy: Callable[[], Awaitable[Any]]) -> None:
+        failed: list[float] = []
+        served: list[float] = []
+        await asyncio.gather(
+            *(timed(hung, failed) for _ in range(args.reads)),
+            *(timed(healthy, served) for _ in range(args.reads)))
+        print(f"{label + ', hung':<24} {percentiles(failed)}")
+        print(f"{label + ', healthy':<24} {percentiles(served)}")
+
+    bad, good = FakeConnection(rpc, hung=True), FakeConnection(rpc)
+
+    async def bad_thread() -> Any:
+        return await asyncio.wait_for(asyncio.to_thread(bad.listAllDomains),
+                                      deadline)
+
+    async def good_thread() -> Any:
+        return await asyncio.wait_for(asyncio.to_thread(good.listAllDomains),
+                                      deadline * 10)
+
+    await run("threads", bad_thread, good_thread)
+    bad.close()
+
+    config = ResilienceConfig(deadlines={"list": deadline})
+    hung = make_virt(FakeConnection(rpc, hung=True), config)
+    healthy = make_virt(FakeConnection(rpc), config)
+    await run("Virt.call", lambda: hung.call("list", hung.conn.listAllDomains),
+              lambda: healthy.call("list", healthy.conn.listAllDomains))
+    # the next listings of the hung host don't wait for anything
+    failed: list[float] = []
+    await asyncio.gather(
+        *(timed(lambda: hung.call("list", hung.conn.listAllDomains), failed)
+          for _ in range(args.reads)))
+    print(f"{'Virt.call, breaker open':<24} {percentiles(failed)}")
+    hung.close()
+    healthy.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--rpc", type=float, default=2.0)
+    parser.add_argument("--slow", type=float, default=500.0)
+    parser.add_argument("--tail", type=float, default=2.0)
+    parser.add_argument("--deadline", type=float, default=500.0)
+    args = parser.parse_args()
+
+    asyncio.run(slow_tail(args))
+    # the threads listings pile up behind a hung host, fewer of them
+    args.reads //= 10
+    asyncio.run(hung_host(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,45 @@
 #!/usr/bin/env python3
+"""Provisions a single instance from the command line, through the same
+admission as the API: host capacity, the owner's quota, the name, host CPUs
+and the address or MAC are reserved before anything is created, and the
+instance is recorded once it runs. Its job is served by the API too."""
 
 import argparse
-from random import randrange
-import shutil
-import socket
-from subprocess import check_call
-import tempfile
-import time
+import asyncio
+import sys
 from typing import Optional
 
-import libvirt
-
-from app.service.virt import Virt
-from app.service.virt import VirtMode
+from fastapi import HTTPException
+
+from app.api.instance.schemas import InstanceTemplate
+from app.api.instance.views import admit_instances
+from app.api.instance.views import createvm_batch
+from app.api.instance.views import LOG_KEEPALIVE
+from app.db import get_cpu_placement
+from app.db import get_engine
+from app.db import get_inventory_reader
+from app.db import get_ipam
+from app.db import get_jobs
+from app.db import get_ledger
+from app.db import get_redis
+from app.db import get_scheduler
+from app.db import get_sessionmaker
+from app.db import get_virt_pool
+from app.models.users import User
+from app.service.jobs import Job
+from app.service.jobs import JobItem
+from app.service.jobs import JobStore
+from app.service.placement import RAM_UNITS
+from app.service.timeline import Timeline
 from app.settings import get_config
 
+# seconds the output of the job may take to be read back once it's done
+LOG_DRAIN = 5.0
+
 
 class Namespace(argparse.Namespace):
+    user: str
+    host: Optional[str]
     name: str
     vcpu: str
     ram: str
@@ -24,123 +47,148 @@ class Namespace(argparse.Namespace):
     os: str
     new_password: str
     hostname: Optional[str]
+    linked: bool
+    dedicated: bool
+    hugepages: bool
+    timeline: Optional[str]
+    performance: Optional[str]
+    qos: Optional[str]
 
 
-def rand_byte():
-    return randrange(0, 0xFF, 1)
-
-
-def gen_mac():
-    return "52:54:%02x:%02x:%02x:%02x" % (rand_byte(), rand_byte(), rand_byte(),
-                                          rand_byte())
-
-
-def create_xml(name, ram_unit, ram, vcpu, mac):
-    with open("task/template.xml", "r") as f:
-        xml = f.read()
-    xml = xml.format(
-        name=name,
-        ram_unit=ram_unit,
-        ram=ram,
-        vcpu=vcpu,
-        mac=mac,
-    )
-    return xml
-
-
-def gen_inventory(file, ip, password):
-    file.write(
-        f"[all]\ntarget ansible_host={ip} ansible_user=root ansible_ssh_pass={password}"
-        .encode())
-
-
-def create_image(os, size, name):
-    target = f"/usr/local/var/lib/libvirt/images/{name}"
-    shutil.copyfile(os.path, target)
-    check_call(["qemu-img", "resize", target, size])
-
-
-def wait_for_ssh(host: str = 'localhost', timeout: float = 5.0):
+def main(args: Namespace):
+    item = asyncio.run(run(args))
+    if args.timeline is not None:
+        with open(args.timeline, "a") as out:
+            timeline = Timeline(out)
+            for stage in item.stages:
+                timeline.record(stage)
+    if item.status != "COMPLETED":
+        sys.exit(item.error or "failed")
+
+
+async def run(args: Namespace) -> JobItem:
+    try:
+        return await provision(args)
+    except HTTPException as e:
+        sys.exit(str(e.detail))
+    finally:
+        get_virt_pool().close()
+        await get_engine().dispose()
+        await get_redis().close()
+
+
+async def print_log(jobs: JobStore, job: Job) -> None:
+    offset = 0
     while True:
-        try:
-            print("wait")
-            with socket.create_connection((host, 22), timeout=timeout):
-                break
-        except OSError as ex:
-            time.sleep(5)
-
+        start, lines, status = await jobs.read_log(job.id, offset)
+        for line in lines:
+            print(line)
+        offset = start + len(lines)
+        if status is not None:
+            return
+        if not lines:
+            await jobs.wait(job.id, offset, LOG_KEEPALIVE)
 
-def main(args: Namespace):
-    virt = Virt("qemu:///system", VirtMode.READ | VirtMode.WRITE)
 
+async def provision(args: Namespace) -> JobItem:
     config = get_config()
-
-    os = config.images.get(args.os)
-    if os is None:
-        print("OS NOT FOUND")
-        return
-
-    create_image(os, args.size, args.name)
-
-    ram = args.ram[:-3]
-    ram_unit = args.ram[-3:]
-
-    xml = create_xml(
-        name=args.name,
-        ram_unit=ram_unit,
-        ram=ram,
-        vcpu=args.vcpu,
-        mac=gen_mac(),
+    if args.os not in config.images:
+        sys.exit(f"unknown os {args.os}")
+    if args.performance is not None and args.performance not in config.profiles:
+        sys.exit(f"unknown performance profile {args.performance}")
+    if args.qos is not None and args.qos not in config.qos:
+        sys.exit(f"unknown QoS tier {args.qos}")
+    known = [host.name for host in config.hosts]
+    if args.host is not None and args.host not in known:
+        sys.exit(f"unknown host {args.host}")
+    hosts = [args.host] if args.host is not None else None
+
+    session_maker = get_sessionmaker()
+    async with session_maker() as session:
+        user = await User.get_by_username(session, args.user)
+    if user is None:
+        sys.exit(f"unknown user {args.user}")
+
+    template = InstanceTemplate(
+        os=args.os,
+        vcpu=int(args.vcpu),
+        ram=int(args.ram[:-3]),
+        ram_unit=args.ram[-3:],
+        size=int(args.size.removesuffix("G")),
+        root_password=args.new_password,
+        profile="dedicated" if args.dedicated else "shared",
+        hugepages=args.hugepages,
+        performance=args.performance,
+        qos=args.qos,
     )
-
-    domain = virt.define_vm(xml)
-    domain.create()
-
-    # WAIT FOR IP
-    iface = None
-    while True:
-        time.sleep(5)
-        iface = domain.interfaceAddresses(
-            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
-        if len(list(iface.items())) > 0:
-            break
-    iface, val = list(iface.items())[0]
-    ip = val["addrs"][0]["addr"]
-
-    wait_for_ssh(ip)
-
-    # RUN ANSIBLE
-    hostname = args.hostname if args.hostname is not None else args.name
-
-    with tempfile.NamedTemporaryFile() as f:
-        check_call([
-            "ansible-playbook",
-            "-vvv",
-            "task/playbook.yml",
-            "-e",
-            f"newhost={ip}",
-            "-e",
-            f"defaultpass={os.root_password}",
-            "-e",
-            f"newpassword={args.new_password}",
-            "-e",
-            f"newhostname={hostname}",
-        ])
+    scheduler = get_scheduler()
+    # placement needs the capacity of the hosts, the API refreshes it in the
+    # background
+    await scheduler.refresh(get_virt_pool(), get_inventory_reader())
+
+    jobs = get_jobs()
+    job = await jobs.create(user.id, [args.name])
+    reservations, allocation, ids, leases, pinnings = await admit_instances(
+        scheduler, get_ledger(), get_ipam(), get_cpu_placement(), session_maker,
+        user, template, [args.name], hosts)
+    job.items[0].host = reservations[0].host
+    print(f"job {job.id}, {args.name} on {reservations[0].host}",
+          file=sys.stderr)
+
+    log = asyncio.create_task(print_log(jobs, job))
+    await createvm_batch(
+        user=user,
+        job=job,
+        reservations=reservations,
+        ids=ids,
+        leases=leases,
+        pinnings=pinnings,
+        allocation=allocation,
+        template=template,
+        hostname=args.hostname,
+        linked=args.linked,
+    )
+    try:
+        # the end of the log is written last, unless redis failed
+        await asyncio.wait_for(log, LOG_DRAIN)
+    except asyncio.TimeoutError:
+        pass
+    return job.items[0]
 
 
 def setup():
     parser = argparse.ArgumentParser()
+    # owner of the instance, charged to their quota
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--host")
     parser.add_argument("--name", required=True)
     parser.add_argument("--vcpu", required=True)
+    # with its unit, e.g. 4GiB
     parser.add_argument("--ram", required=True)
+    # GiB, e.g. 20G
     parser.add_argument("--size", required=True)
     parser.add_argument("--os", required=True)
     parser.add_argument("--new-password", required=True)
     parser.add_argument("--hostname")
-    return parser.parse_args(namespace=Namespace())
+    parser.add_argument("--linked", action="store_true")
+    # the dedicated profile, on a host with dedicated CPUs
+    parser.add_argument("--dedicated", action="store_true")
+    parser.add_argument("--hugepages", action="store_true")
+    # JSON lines file receiving the timing of every stage
+    parser.add_argument("--timeline")
+    # one of the profiles of config.yaml, its default_profile otherwise
+    parser.add_argument("--performance")
+    # QoS tier of config.yaml, the user's or default_qos otherwise
+    parser.add_argument("--qos")
+    args = parser.parse_args(namespace=Namespace())
+    if args.ram[-3:] not in RAM_UNITS or not args.ram[:-3].isdigit():
+        parser.error("--ram takes a number and KiB, MiB or GiB, e.g. 4GiB")
+    if not args.size.removesuffix("G").isdigit():
+        parser.error("--size takes GiB, e.g. 20G")
+    return args
 
 
 if __name__ == "__main__":
     args = setup()
 
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,22 @@
+"""index instances user_id
+
+Revision ID: 5d0c3b9f2a71
+Revises: 1631a60036d2
+Create Date: 2026-10-19 09:12:04.118372
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5d0c3b9f2a71'
+down_revision = '1631a60036d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f("ix_instances_user_id"), "instances", ["user_id"])
+
+
+def downgrade():
+    op.drop_index(op.f("ix_instances_user_id"), table_name="instances")
@@ -0,0 +1,31 @@
+"""add qos tiers
+
+Revision ID: a4d8e2c61f95
+Revises: e5a9c2f17b30
+Create Date: 2026-10-19 18:05:12.640318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a4d8e2c61f95'
+down_revision = 'e5a9c2f17b30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.add_column(
+            sa.Column("qos", sa.String(length=16), nullable=True))
+    with op.batch_alter_table("instances") as batch_op:
+        batch_op.add_column(
+            sa.Column("qos", sa.String(length=16), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table("instances") as batch_op:
+        batch_op.drop_column("qos")
+    with op.batch_alter_table("users") as batch_op:
+        batch_op.drop_column("qos")
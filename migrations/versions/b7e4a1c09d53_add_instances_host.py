@@ -0,0 +1,29 @@
+"""add instances host
+
+Revision ID: b7e4a1c09d53
+Revises: 5d0c3b9f2a71
+Create Date: 2026-10-19 11:40:27.503914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4a1c09d53'
+down_revision = '5d0c3b9f2a71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("instances") as batch_op:
+        batch_op.add_column(
+            sa.Column("host",
+                      sa.String(length=64),
+                      nullable=False,
+                      server_default="default"))
+
+
+def downgrade():
+    with op.batch_alter_table("instances") as batch_op:
+        batch_op.drop_column("host")
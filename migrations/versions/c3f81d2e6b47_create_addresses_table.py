@@ -0,0 +1,37 @@
+"""create addresses table
+
+Revision ID: c3f81d2e6b47
+Revises: b7e4a1c09d53
+Create Date: 2026-10-19 14:05:51.220734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c3f81d2e6b47'
+down_revision = 'b7e4a1c09d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "addresses",
+        sa.Column("slot", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("ip", sa.String(length=45), nullable=False),
+        sa.Column("mac", sa.String(length=17), nullable=False),
+        sa.Column("host", sa.String(length=64), nullable=False),
+        sa.Column("name", sa.String(length=64), nullable=False),
+        sa.Column("instance_id", sa.String(length=32), nullable=True),
+        sa.PrimaryKeyConstraint("slot", name=op.f("pk_addresses")),
+        sa.UniqueConstraint("ip", name=op.f("uq_addresses_ip")),
+        sa.UniqueConstraint("mac", name=op.f("uq_addresses_mac")),
+    )
+    op.create_index(op.f("ix_addresses_instance_id"), "addresses",
+                    ["instance_id"])
+
+
+def downgrade():
+    op.drop_index(op.f("ix_addresses_instance_id"), table_name="addresses")
+    op.drop_table("addresses")
@@ -0,0 +1,43 @@
+"""create name reservations table
+
+Revision ID: e5a9c2f17b30
+Revises: c3f81d2e6b47
+Create Date: 2026-10-19 16:42:08.318250
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e5a9c2f17b30'
+down_revision = 'c3f81d2e6b47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "name_reservations",
+        sa.Column("name", sa.String(length=64), nullable=False),
+        sa.Column("host", sa.String(length=64), nullable=False),
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("instance_id", sa.String(length=32), nullable=False),
+        sa.Column("created", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["user_id"], ["users.id"],
+            name=op.f("fk_name_reservations_user_id_users")),
+        sa.PrimaryKeyConstraint("name", name=op.f("pk_name_reservations")),
+        sa.UniqueConstraint("instance_id",
+                            name=op.f("uq_name_reservations_instance_id")),
+    )
+    # names of existing instances are taken, a name shared by several of
+    # them is reserved once
+    op.execute("""
+        INSERT INTO name_reservations (name, host, user_id, instance_id, created)
+        SELECT name, MIN(host), MIN(user_id), MIN(id), 0
+        FROM instances WHERE name IS NOT NULL GROUP BY name
+    """)
+
+
+def downgrade():
+    op.drop_table("name_reservations")
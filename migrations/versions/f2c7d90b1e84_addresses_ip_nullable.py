@@ -0,0 +1,31 @@
+"""addresses without ip
+
+Revision ID: f2c7d90b1e84
+Revises: a4d8e2c61f95
+Create Date: 2026-10-19 21:42:37.118254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f2c7d90b1e84'
+down_revision = 'a4d8e2c61f95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # rows of instances whose address the DHCP server leases only hold a MAC
+    with op.batch_alter_table("addresses") as batch_op:
+        batch_op.alter_column("ip",
+                              existing_type=sa.String(length=45),
+                              nullable=True)
+
+
+def downgrade():
+    op.execute("DELETE FROM addresses WHERE ip IS NULL")
+    with op.batch_alter_table("addresses") as batch_op:
+        batch_op.alter_column("ip",
+                              existing_type=sa.String(length=45),
+                              nullable=False)
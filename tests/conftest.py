@@ -0,0 +1,35 @@
+import asyncio
+import inspect
+from pathlib import Path
+
+import pytest
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem: pytest.Function) -> bool:
+    # coroutine tests run in a loop of their own, no plugin needed
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return False
+    args = {
+        name: pyfuncitem.funcargs[name]
+        for name in pyfuncitem._fixtureinfo.argnames
+    }
+    asyncio.run(pyfuncitem.obj(**args))
+    return True
+
+
+@pytest.fixture
+def redis_server():
+    from fakeredis import FakeServer
+
+    # a server of its own, tests don't see each other's keys
+    return FakeServer()
+
+
+@pytest.fixture
+def redis(redis_server):
+    from fakeredis import FakeAsyncRedis
+
+    return FakeAsyncRedis(server=redis_server)
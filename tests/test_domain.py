@@ -0,0 +1,186 @@
+from pathlib import Path
+from uuid import uuid4
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from app.service.domain import DomainSpec
+from app.service.domain import DomainTemplate
+from app.service.domain import format_cpuset
+from app.service.domain import InvalidDomain
+from app.service.domain import Nic
+from app.service.domain import parse_cpuset
+from app.service.domain import Topology
+from app.service.domain import validate
+from app.settings import PerformanceProfile
+from app.settings import QosTier
+
+TEMPLATE = Path(__file__).parent.parent / "templates" / "default.xml"
+
+MAC = "52:54:00:00:00:01"
+
+
+@pytest.fixture(scope="module")
+def template():
+    return DomainTemplate.parse(TEMPLATE.read_text())
+
+
+def spec(**kwargs):
+    fields = dict(name="vm1",
+                  vcpu=2,
+                  ram=1 << 20,
+                  disk="/var/lib/libvirt/images/vm1.qcow2",
+                  nics=[Nic(MAC, "default")])
+    fields.update(kwargs)
+    return DomainSpec(**fields)
+
+
+def test_render(template):
+    id = uuid4()
+    root = ET.fromstring(template.render(spec(uuid=id, seed_iso="/seed.iso")))
+    assert root.findtext("name") == "vm1"
+    assert root.findtext("uuid") == str(id)
+    assert root.findtext("memory") == str(1 << 20)
+    assert root.findtext("currentMemory") == str(1 << 20)
+    assert root.findtext("vcpu") == "2"
+    disk = root.find("devices/disk[@device='disk']")
+    assert disk.find("source").get(
+        "file") == "/var/lib/libvirt/images/vm1.qcow2"
+    assert disk.find("target").get("dev") == "vda"
+    assert root.find("devices/disk[@device='cdrom']/source").get(
+        "file") == "/seed.iso"
+    [iface] = root.findall("devices/interface")
+    assert iface.find("mac").get("address") == MAC
+    assert iface.find("source").get("network") == "default"
+    # libvirt assigns the address of every NIC
+    assert iface.find("address") is None
+
+
+def test_render_nics(template):
+    nics = [Nic(MAC, "default"), Nic("52:54:00:00:00:02", "br0", "bridge")]
+    root = ET.fromstring(template.render(spec(nics=nics)))
+    ifaces = root.findall("devices/interface")
+    assert [iface.get("type") for iface in ifaces] == ["network", "bridge"]
+    assert ifaces[1].find("source").get("bridge") == "br0"
+
+
+def test_render_escapes(template):
+    root = ET.fromstring(template.render(spec(disk='/images/a"&<b>.qcow2')))
+    assert root.find("devices/disk/source").get(
+        "file") == '/images/a"&<b>.qcow2'
+
+
+def test_render_topology(template):
+    root = ET.fromstring(
+        template.render(spec(vcpu=4, topology=Topology(1, 2, 2))))
+    # into the template's <cpu>
+    cpu = root.find("cpu")
+    assert cpu.get("mode") == "host-passthrough"
+    assert cpu.find("topology").attrib == {
+        "sockets": "1",
+        "dies": "1",
+        "cores": "2",
+        "threads": "2",
+    }
+
+
+def test_render_cpuset(template):
+    root = ET.fromstring(template.render(spec(cpuset="4-7")))
+    pins = root.findall("cputune/vcpupin")
+    assert [pin.get("cpuset") for pin in pins] == ["4-7", "4-7"]
+    assert root.find("cputune/emulatorpin").get("cpuset") == "4-7"
+
+
+def test_render_scsi(template):
+    profile = PerformanceProfile(bus="scsi",
+                                 cache="none",
+                                 io="native",
+                                 iothread=True,
+                                 queues=0,
+                                 vhost=True)
+    root = ET.fromstring(template.render(spec(vcpu=4, performance=profile)))
+    disk = root.find("devices/disk[@device='disk']")
+    assert disk.find("target").attrib == {"dev": "sdb", "bus": "scsi"}
+    assert disk.find("address") is None
+    assert disk.find("driver").get("cache") == "none"
+    controller = root.find("devices/controller[@type='scsi']")
+    assert controller.get("model") == "virtio-scsi"
+    assert controller.find("driver").get("iothread") == "1"
+    assert root.findtext("iothreads") == "1"
+    driver = root.find("devices/interface/driver")
+    assert driver.attrib == {"name": "vhost", "queues": "4"}
+
+
+def test_render_qos(template):
+    tier = QosTier(disk_iops=500, net_average=100)
+    root = ET.fromstring(template.render(spec(qos=tier)))
+    assert root.findtext("devices/disk/iotune/total_iops_sec") == "500"
+    assert root.find("devices/interface/bandwidth/inbound").get(
+        "average") == "12207"
+
+
+def test_render_twice(template):
+    # nothing of one instance is left in the next one
+    template.render(spec(cpuset="1", qos=QosTier(disk_iops=1)))
+    xml = template.render(spec(name="vm2"))
+    assert "cputune" not in xml and "iotune" not in xml
+    assert "<name>vm2</name>" in xml
+
+
+def test_template_without_interface():
+    template = DomainTemplate.parse(
+        "<domain><name/><memory/><vcpu/><devices>"
+        "<disk device='disk'><source file=''/></disk>"
+        "</devices></domain>")
+    root = ET.fromstring(template.render(spec()))
+    assert root.find("devices/interface") is None
+    # a <cpu> of its own for the topology
+    root = ET.fromstring(
+        template.render(spec(vcpu=2, topology=Topology(1, 2, 1))))
+    assert root.find("cpu/topology").get("cores") == "2"
+
+
+@pytest.mark.parametrize("xml,error", [
+    ("<vm/>", "root element"),
+    ("<domain><name/></domain>", "no <devices>"),
+    ("<domain><devices/></domain>", "no disk"),
+    ("<domain><name/><memory/><vcpu/><cputune/><devices>"
+     "<disk device='disk'/></devices></domain>", "<cputune>"),
+    ("<domain>", "no element found"),
+])
+def test_invalid_template(xml, error):
+    with pytest.raises(InvalidDomain, match=error):
+        DomainTemplate.parse(xml)
+
+
+@pytest.mark.parametrize("kwargs,error", [
+    (dict(name="-vm"), "invalid domain name"),
+    (dict(name="vm 1"), "invalid domain name"),
+    (dict(vcpu=0), "vcpu must be positive"),
+    (dict(ram=0), "memory must be positive"),
+    (dict(disk=""), "disk path is empty"),
+    (dict(cpuset="0-x"), "invalid cpuset"),
+    (dict(topology=Topology(2, 2)), "doesn't match 2 vcpus"),
+    (dict(nics=[Nic("52:54:00:00:00", "default")]), "invalid MAC"),
+    (dict(nics=[Nic(MAC, "default"),
+                Nic(MAC.upper(), "br0", "bridge")]), "duplicate MAC"),
+    (dict(nics=[Nic(MAC, "eth0", "direct")]), "unsupported interface type"),
+])
+def test_validate(kwargs, error):
+    with pytest.raises(InvalidDomain, match=error):
+        validate(spec(**kwargs))
+
+
+def test_multiqueue_needs_virtio():
+    template = DomainTemplate.parse(
+        "<domain><name/><memory/><vcpu/><devices>"
+        "<disk device='disk'/><interface type='network'>"
+        "<model type='e1000'/></interface></devices></domain>")
+    with pytest.raises(InvalidDomain, match="virtio"):
+        template.render(spec(performance=PerformanceProfile(vhost=True)))
+
+
+def test_cpuset():
+    assert parse_cpuset("0-3,8,^2") == {0, 1, 3, 8}
+    assert format_cpuset({0, 1, 3, 8, 9, 10}) == "0-1,3,8-10"
+    assert format_cpuset([]) == ""
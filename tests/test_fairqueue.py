@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from app.service.fairqueue import LaneQueue
+from app.service.fairqueue import PRIORITY_ADMIN
+from app.service.fairqueue import ProvisionQueue
+
+
+def served(lane):
+    """User ids in the order the waiting tickets get their slots."""
+    order = []
+    while lane.running:
+        ticket = lane.running[0]
+        lane.release(ticket)
+        if lane.running and lane.running[-1] is not ticket:
+            order.append(lane.running[-1].user_id)
+    return order
+
+
+async def test_fewest_running_first():
+    lane = LaneQueue(1)
+    # a batch of 4 by user 1 queued before 2 single instances
+    held = [lane.submit(1, 0) for _ in range(4)]
+    lane.submit(2, 0)
+    lane.submit(3, 0)
+    assert held[0].granted is not None
+    assert [ticket.user_id for ticket in lane.order()] == [2, 3, 1, 1, 1]
+    assert served(lane) == [2, 3, 1, 1, 1]
+
+
+async def test_round_robin():
+    lane = LaneQueue(1)
+    for user_id in (1, 1, 1, 2, 2, 2):
+        lane.submit(user_id, 0)
+    # user 1 holds the slot, then they take turns
+    assert [ticket.user_id for ticket in lane.order()] == [2, 1, 2, 1, 2]
+    assert served(lane) == [2, 1, 2, 1, 2]
+
+
+async def test_admin_first():
+    lane = LaneQueue(1)
+    lane.submit(1, 0)
+    lane.submit(2, 0)
+    admin = lane.submit(3, PRIORITY_ADMIN)
+    assert lane.order()[0] is admin
+    assert admin.position == 0
+    assert len(lane) == 2
+
+
+async def test_position_and_wait():
+    lane = LaneQueue(2)
+    running = [lane.submit(1, 0), lane.submit(2, 0)]
+    waiting = [lane.submit(3, 0), lane.submit(4, 0), lane.submit(5, 0)]
+    assert [ticket.position for ticket in running] == [None, None]
+    assert [ticket.position for ticket in waiting] == [0, 1, 2]
+    # nothing to estimate from before a run finished
+    assert waiting[0].wait() is None
+    assert running[0].wait() == 0.0
+
+    lane.mean = 10.0
+    for ticket in lane.running:
+        ticket.granted -= 4.0
+    # 2 slots freed in 6s, then every 10s
+    assert waiting[0].wait() == pytest.approx(6.0, abs=0.1)
+    assert waiting[1].wait() == pytest.approx(6.0, abs=0.1)
+    assert waiting[2].wait() == pytest.approx(16.0, abs=0.1)
+
+
+async def test_mean():
+    lane = LaneQueue(1)
+    ticket = lane.submit(1, 0)
+    ticket.granted -= 10.0
+    lane.release(ticket)
+    assert lane.mean == pytest.approx(10.0, abs=0.1)
+    ticket = lane.submit(1, 0)
+    ticket.granted -= 20.0
+    lane.release(ticket)
+    assert lane.mean == pytest.approx(12.0, abs=0.1)
+
+
+async def test_slot_cancelled():
+    queue = ProvisionQueue({"h1": {"disk": 1, "light": 1}})
+    first = queue.submit("h1", "disk", 1)
+    second = queue.submit("h1", "disk", 2)
+    third = queue.submit("h1", "disk", 3)
+
+    async def hold(ticket, event):
+        async with queue.slot(ticket):
+            await event.wait()
+
+    done = asyncio.Event()
+    holder = asyncio.create_task(hold(first, done))
+    waiter = asyncio.create_task(hold(second, done))
+    await asyncio.sleep(0)
+    # the cancelled waiter gives its turn up
+    waiter.cancel()
+    await asyncio.sleep(0)
+    assert [ticket.user_id for ticket in queue.lane("h1", "disk").order()
+           ] == [3]
+    done.set()
+    await holder
+    assert third.granted is not None
@@ -0,0 +1,118 @@
+import time
+from uuid import uuid4
+
+from app.service.inventory import decode
+from app.service.inventory import encode
+from app.service.inventory import HEADER
+from app.service.inventory import HostInventory
+from app.service.inventory import InventoryReader
+from app.service.inventory import InventoryWriter
+from app.service.inventory import SEQUENCE
+from app.service.inventory import SEQUENCE_OFFSET
+
+
+def hosts(*names, updated=None):
+    inventory = {}
+    for host in names:
+        id = uuid4()
+        inventory[host] = HostInventory(
+            time.time() if updated is None else updated, {
+                id: {
+                    "id": id,
+                    "name": f"{host}-vm",
+                    "ip": "192.168.122.10",
+                    "vcpu": 2,
+                    "ram": "1048576",
+                    "state": "running",
+                }
+            })
+    return inventory
+
+
+def test_encode_decode():
+    inventory = hosts("h1", "h2")
+    assert decode(encode(inventory)) == inventory
+    assert inventory["h1"].usage() == (2, 1048576)
+
+
+def test_publish_read(tmp_path):
+    path = str(tmp_path / "inventory")
+    reader = InventoryReader(path, max_age=60)
+    # nothing published yet
+    assert reader.read() is None
+    writer = InventoryWriter(path, 4096)
+    assert reader.read() is None
+
+    first = hosts("h1")
+    assert writer.publish(encode(first)) == 2
+    snapshot = reader.read()
+    assert snapshot.hosts == first
+    # decoded once per sequence number
+    assert reader.read() is snapshot
+
+    second = hosts("h1", "h2")
+    writer.publish(encode(second))
+    assert reader.read().hosts == second
+    writer.close()
+
+
+def test_read_while_written(tmp_path):
+    path = str(tmp_path / "inventory")
+    writer = InventoryWriter(path, 4096)
+    reader = InventoryReader(path, max_age=60)
+    first = hosts("h1")
+    writer.publish(encode(first))
+    snapshot = reader.read()
+
+    # a write in progress: odd sequence number, payload half copied
+    SEQUENCE.pack_into(writer.mm, SEQUENCE_OFFSET, writer.sequence + 1)
+    writer.mm[HEADER.size:HEADER.size + 4] = b"\xff" * 4
+    assert reader.read() is snapshot
+    writer.close()
+
+
+def test_moved(tmp_path):
+    path = str(tmp_path / "inventory")
+    writer = InventoryWriter(path, 64)
+    reader = InventoryReader(path, max_age=60)
+    writer.publish(encode(hosts("h1")))
+    assert reader.read() is not None
+    old = reader.mm
+
+    # doesn't fit, published into a larger file the reader follows
+    large = hosts(*(f"h{i}" for i in range(20)))
+    writer.publish(encode(large))
+    assert writer.capacity >= len(encode(large))
+    assert reader.read().hosts == large
+    assert reader.mm is not old
+    writer.close()
+
+
+def test_new_writer(tmp_path):
+    path = str(tmp_path / "inventory")
+    writer = InventoryWriter(path, 4096)
+    reader = InventoryReader(path, max_age=60)
+    writer.publish(encode(hosts("h1")))
+    reader.read()
+    writer.close()
+
+    # sequence numbers start over, the reader maps the new file
+    writer = InventoryWriter(path, 4096)
+    inventory = hosts("h2")
+    writer.publish(encode(inventory))
+    assert reader.read().hosts == inventory
+    writer.close()
+
+
+def test_fresh(tmp_path):
+    path = str(tmp_path / "inventory")
+    writer = InventoryWriter(path, 4096)
+    reader = InventoryReader(path, max_age=60)
+    inventory = hosts("h1")
+    inventory.update(hosts("h2", updated=time.time() - 120))
+    writer.publish(encode(inventory))
+    assert reader.host("h1") == inventory["h1"]
+    # listed too long ago, or never
+    assert reader.host("h2") is None
+    assert reader.host("h3") is None
+    writer.close()
@@ -0,0 +1,149 @@
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.models.addresses import Address
+from app.models.base import Base
+from app.service.ipam import AddressConflict
+from app.service.ipam import Bitmap
+from app.service.ipam import check_dhcp
+from app.service.ipam import IPAM
+from app.service.ipam import NoAddress
+from app.service.ipam import slot_mac
+from app.settings import NetworkConfig
+
+SUBNET = "192.168.122.0/24"
+
+
+async def sessionmaker():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return async_sessionmaker(engine, expire_on_commit=False)
+
+
+def pool(start, end):
+    return NetworkConfig(mode="nat",
+                         subnet=SUBNET,
+                         pool_start=start,
+                         pool_end=end)
+
+
+def test_bitmap():
+    bitmap = Bitmap(4)
+    assert bitmap.first_clear() == 0
+    bitmap.set(0)
+    bitmap.set(1)
+    bitmap.set(3)
+    assert bitmap.first_clear() == 2
+    bitmap.set(2)
+    assert bitmap.first_clear() is None
+    bitmap.clear(1)
+    assert bitmap.first_clear() == 1
+
+
+def test_slot_mac():
+    assert slot_mac(1) == "52:54:00:00:00:01"
+    assert slot_mac(0xABCDEF) == "52:54:00:ab:cd:ef"
+
+
+def test_network_config():
+    # without a pool, addresses come from the DHCP server
+    assert not NetworkConfig(mode="nat", subnet=SUBNET).managed
+    assert pool("192.168.122.200", "192.168.122.254").managed
+    for start, end in [("192.168.122.200", None), ("10.0.0.1", "10.0.0.9"),
+                       ("192.168.122.9", "192.168.122.2")]:
+        with pytest.raises(ValueError):
+            pool(start, end)
+    with pytest.raises(ValueError):
+        NetworkConfig(mode="bridge",
+                      subnet=SUBNET,
+                      pool_start="192.168.122.2",
+                      pool_end="192.168.122.9")
+
+
+def test_reserve():
+    ipam = IPAM(pool("192.168.122.250", "192.168.122.255"))
+    ipam.reserve()
+    slots = []
+    while (slot := ipam.bitmap.first_clear()) is not None:
+        ipam.bitmap.set(slot)
+        slots.append(slot)
+    # the broadcast address is never handed out
+    assert slots == [250, 251, 252, 253, 254]
+
+
+async def test_allocate_pool():
+    session_maker = await sessionmaker()
+    ipam = IPAM(pool("192.168.122.200", "192.168.122.201"))
+    async with session_maker() as session:
+        first = await ipam.allocate(session, "h1", "a")
+        second = await ipam.allocate(session, "h1", "b")
+        assert (first.ip, first.mac) == ("192.168.122.200", "52:54:00:00:00:c8")
+        assert second.ip == "192.168.122.201"
+        with pytest.raises(NoAddress):
+            await ipam.allocate(session, "h1", "c")
+        await ipam.release(session, first)
+        assert (await ipam.allocate(session, "h1", "c")).ip == first.ip
+
+
+async def test_allocate_other_worker():
+    session_maker = await sessionmaker()
+    network = pool("192.168.122.200", "192.168.122.202")
+    mine, theirs = IPAM(network), IPAM(network)
+    async with session_maker() as session:
+        await mine.allocate(session, "h1", "a")
+        # taken by the other one after this one loaded its bitmap
+        taken = await theirs.allocate(session, "h1", "b")
+        assert taken.slot == 201
+        assert (await mine.allocate(session, "h1", "c")).slot == 202
+
+
+async def test_allocate_mac_only():
+    session_maker = await sessionmaker()
+    ipam = IPAM(NetworkConfig(mode="bridge", subnet=SUBNET))
+    async with session_maker() as session:
+        leases = [await ipam.allocate(session, "h1", name) for name in "abc"]
+        assert [lease.ip for lease in leases] == [None, None, None]
+        assert [lease.mac for lease in leases] == [
+            "52:54:00:00:00:01", "52:54:00:00:00:02", "52:54:00:00:00:03"
+        ]
+        await ipam.assign(session, leases[0], uuid4())
+        # no address to list for it
+        assert await Address.get_ips(session) == {}
+
+
+class FakeNetwork:
+
+    def XMLDesc(self, flags):
+        return ("<network><ip><dhcp>"
+                "<range start='192.168.122.2' end='192.168.122.127'/>"
+                "<host mac='52:54:00:00:00:09' ip='192.168.122.200'/>"
+                "</dhcp></ip></network>")
+
+    def DHCPLeases(self):
+        return [{"ipaddr": "192.168.122.201", "mac": "52:54:00:AA:00:01"}]
+
+
+class FakeConn:
+
+    def networkLookupByName(self, name):
+        return FakeNetwork()
+
+
+@pytest.mark.parametrize("ip,mac,conflict", [
+    ("192.168.122.5", "52:54:00:00:00:05", "DHCP range"),
+    ("192.168.122.200", "52:54:00:00:00:01", "pinned"),
+    ("192.168.122.200", "52:54:00:00:00:09", None),
+    ("192.168.122.201", "52:54:00:00:00:01", "leased"),
+    ("192.168.122.201", "52:54:00:aa:00:01", None),
+    ("192.168.122.210", "52:54:00:00:00:01", None),
+])
+def test_check_dhcp(ip, mac, conflict):
+    if conflict is None:
+        check_dhcp(FakeConn(), "default", mac, ip)
+        return
+    with pytest.raises(AddressConflict, match=conflict):
+        check_dhcp(FakeConn(), "default", mac, ip)
@@ -0,0 +1,129 @@
+import asyncio
+from uuid import uuid4
+
+from fakeredis import FakeAsyncRedis
+import pytest
+
+from app.service.jobs import job_status
+from app.service.jobs import JobStore
+from app.service.jobs import MAX_LINE
+from app.service.timeline import Stage
+from app.settings import JobsConfig
+
+CONFIG = JobsConfig(ttl=60, max_lines=3, interval=0.05)
+
+
+@pytest.fixture
+def stores(redis, redis_server):
+    # the API worker running the job and another one serving it
+    return (JobStore(redis, CONFIG),
+            JobStore(FakeAsyncRedis(server=redis_server), CONFIG))
+
+
+def test_job_status():
+    assert job_status(["QUEUED", "QUEUED"]) == "QUEUED"
+    assert job_status(["COMPLETED", "QUEUED"]) == "PROCESSING"
+    assert job_status(["COMPLETED", "FAILED"]) == "COMPLETED"
+
+
+async def test_create(stores):
+    mine, theirs = stores
+    job = await mine.create(7, ["vm1", "vm2"])
+    state = await theirs.get(job.id)
+    assert state.user_id == 7
+    assert state.status == "QUEUED"
+    assert [item["name"] for item in state.items] == ["vm1", "vm2"]
+    assert await theirs.exists(job.id)
+    assert await theirs.get(uuid4()) is None
+    assert 0 < await theirs.redis.ttl(theirs.key(job.id)) <= 60
+
+
+async def test_write(stores):
+    mine, theirs = stores
+    job = await mine.create(7, ["vm1"])
+    item = job.items[0]
+    item.status = "PROCESSING"
+    item.host = "h1"
+    item.timeline.append(Stage("copy", 1.0, 3.5))
+    job.log.append("copying")
+    job.log.append("x" * (MAX_LINE + 10))
+    await mine.write(job)
+
+    state = await theirs.get(job.id)
+    assert state.status == "PROCESSING"
+    assert state.items[0]["host"] == "h1"
+    assert state.items[0]["stages"] == [{
+        "name": "copy",
+        "start": 1.0,
+        "end": 3.5,
+        "error": None,
+        "duration": 2.5,
+    }]
+    start, lines, status = await theirs.read_log(job.id, 0)
+    assert (start, lines[0], status) == (0, "copying", None)
+    assert len(lines[1]) == MAX_LINE
+    # written out once
+    assert job.log.pending == []
+    await mine.write(job)
+    assert (await theirs.read_log(job.id, 0))[1] == lines
+
+
+async def test_log_trimmed(stores):
+    mine, theirs = stores
+    job = await mine.create(7, ["vm1"])
+    for i in range(5):
+        job.log.append(f"line {i}")
+    await mine.write(job)
+    # only the last max_lines lines are kept
+    assert await theirs.read_log(job.id,
+                                 0) == (2, ["line 2", "line 3", "line 4"], None)
+    assert await theirs.read_log(job.id, 4) == (4, ["line 4"], None)
+    assert await theirs.read_log(job.id, 5) == (5, [], None)
+
+
+async def test_running(stores):
+    mine, theirs = stores
+    job = await mine.create(7, ["vm1"])
+
+    async def follow():
+        read = []
+        offset = 0
+        while True:
+            start, lines, status = await theirs.read_log(job.id, offset)
+            read.extend(lines)
+            offset = start + len(lines)
+            if status is not None:
+                return read, status
+            if not lines:
+                await theirs.wait(job.id, offset, 1.0)
+
+    reader = asyncio.create_task(follow())
+    async with mine.running(job):
+        job.items[0].status = "PROCESSING"
+        job.log.append("first")
+        await asyncio.sleep(0.1)
+        assert (await theirs.get(job.id)).status == "PROCESSING"
+        job.log.append("second")
+        job.items[0].status = "FAILED"
+    assert await asyncio.wait_for(reader, 2.0) == (["first",
+                                                    "second"], "COMPLETED")
+    # the state is written before the end of the log
+    assert (await theirs.get(job.id)).items[0]["status"] == "FAILED"
+    assert await theirs.read_log(job.id, 2) == (2, [], "COMPLETED")
+
+
+async def test_wait(stores):
+    mine, theirs = stores
+    job = await mine.create(7, ["vm1"])
+    assert not await theirs.wait(job.id, 0, 0.05)
+
+    async def append():
+        await asyncio.sleep(0.05)
+        job.log.append("line")
+        await mine.write(job)
+
+    writer = asyncio.create_task(append())
+    assert await theirs.wait(job.id, 0, 1.0)
+    await writer
+    # the line read already doesn't wake the reader
+    assert not await theirs.wait(job.id, 1, 0.05)
@@ -0,0 +1,152 @@
+import json
+from uuid import uuid4
+
+import pytest
+
+from app.service.ledger import Allocation
+from app.service.ledger import Ledger
+from app.service.ledger import PENDING_KEY
+from app.service.ledger import QuotaExceeded
+
+SMALL = Allocation(vcpu=2, ram=1024, disk=10 << 30)
+# vcpu, ram and disk limits, -1 for none
+HOSTS = {"h1": (4, 4096, -1), "h2": (100, -1, -1)}
+
+
+class FakeVirt:
+
+    def __init__(self, allocations):
+        self.allocs = allocations
+
+    def allocations(self):
+        return self.allocs
+
+    async def call(self, kind, fn, *args):
+        return fn(*args)
+
+
+class FakePool:
+
+    def __init__(self, virts):
+        self.virts = virts
+        self.hosts = list(virts)
+
+    async def connect(self, host):
+        return self.virts[host]
+
+
+class FakeSession:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, stmt):
+        return self.rows
+
+
+def ledger(redis, user_vcpu=-1):
+    limits = (user_vcpu, -1, -1)
+    return Ledger(redis, HOSTS, limits, pending_ttl=60)
+
+
+async def usage(redis, key):
+    return {k.decode(): int(v) for k, v in (await redis.hgetall(key)).items()}
+
+
+async def test_admit_charges_host_and_user(redis):
+    id = uuid4()
+    await ledger(redis).admit("h1", 7, id, SMALL)
+    assert await usage(redis, Ledger.host_key("h1")) == {
+        "vcpu": 2,
+        "ram": 1024,
+        "disk": 10 << 30,
+    }
+    assert await usage(redis, Ledger.user_key(7)) == await usage(
+        redis, Ledger.host_key("h1"))
+    pending = json.loads(await redis.hget(PENDING_KEY, str(id)))
+    assert pending["host"] == Ledger.host_key("h1")
+    assert pending["vcpu"] == 2
+
+
+async def test_host_limit(redis):
+    l = ledger(redis)
+    await l.admit("h1", 7, uuid4(), SMALL)
+    await l.admit("h1", 8, uuid4(), SMALL)
+    with pytest.raises(QuotaExceeded) as e:
+        await l.admit("h1", 9, uuid4(), SMALL)
+    assert (e.value.scope, e.value.resource) == ("host", "vcpu")
+    # nothing charged by the refused admission
+    assert (await usage(redis, Ledger.host_key("h1")))["vcpu"] == 4
+    assert await usage(redis, Ledger.user_key(9)) == {}
+
+
+async def test_user_limit(redis):
+    l = ledger(redis, user_vcpu=3)
+    await l.admit("h2", 7, uuid4(), SMALL)
+    with pytest.raises(QuotaExceeded) as e:
+        await l.admit("h2", 7, uuid4(), SMALL)
+    assert e.value.scope == "user"
+    # admins aren't held to the user quota, the host's still applies
+    await l.admit("h2", 7, uuid4(), SMALL, unlimited_user=True)
+    assert (await usage(redis, Ledger.user_key(7)))["vcpu"] == 4
+
+
+async def test_release(redis):
+    l = ledger(redis)
+    id = uuid4()
+    await l.admit("h1", 7, id, SMALL)
+    await l.release("h1", 7, id, SMALL)
+    assert (await usage(redis, Ledger.host_key("h1")))["vcpu"] == 0
+    assert await redis.hget(PENDING_KEY, str(id)) is None
+    # releases are never refused, even past the limits
+    await l.adjust("h1", 7, Allocation(-100, 0, 0), check=False)
+
+
+async def test_reconcile(redis):
+    l = ledger(redis)
+    defined, copying, unowned, released = uuid4(), uuid4(), uuid4(), uuid4()
+    for id in (defined, copying, unowned, released):
+        await l.admit("h1", 7, id, Allocation(1, 100, 1000))
+    await l.release("h1", 7, released, Allocation(1, 100, 1000))
+    # admitted long ago and never defined
+    expired = uuid4()
+    await redis.hset(
+        PENDING_KEY, str(expired),
+        json.dumps({
+            "host": Ledger.host_key("h1"),
+            "user": Ledger.user_key(7),
+            "at": 0,
+            "vcpu": 1,
+            "ram": 1,
+            "disk": 1,
+        }))
+    # counters of a user without instances anymore
+    await redis.hset(Ledger.user_key(99), mapping={"vcpu": 5})
+    other = uuid4()
+    pool = FakePool({
+        "h1": FakeVirt([(defined, 1, 100, 1000), (unowned, 1, 100, 1000)]),
+        "h2": FakeVirt([(other, 4, 4096, 123456789012345)]),
+    })
+    rows = [(defined, 7), (other, 8)]
+    await l.reconcile(pool, lambda: FakeSession(rows))
+
+    # both domains plus the admission still copying its disk
+    assert await usage(redis, Ledger.host_key("h1")) == {
+        "vcpu": 3,
+        "ram": 300,
+        "disk": 3000,
+    }
+    # the domain without a row is charged to the user of its admission
+    assert (await usage(redis, Ledger.user_key(7)))["vcpu"] == 3
+    # large counters aren't rounded
+    assert (await usage(redis,
+                        Ledger.host_key("h2")))["disk"] == 123456789012345
+    assert await usage(redis, Ledger.user_key(99)) == {}
+    pending = await redis.hkeys(PENDING_KEY)
+    assert [id.decode() for id in pending] == [str(copying)]
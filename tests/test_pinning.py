@@ -0,0 +1,241 @@
+from types import SimpleNamespace
+from uuid import uuid4
+
+from fakeredis import FakeAsyncRedis
+import orjson
+import pytest
+
+from app.service.domain import DomainSpec
+from app.service.domain import DomainTemplate
+from app.service.domain import parse_cpuset
+from app.service.domain import Topology
+from app.service.pinning import CoreMap
+from app.service.pinning import CpuPlacement
+from app.service.pinning import HostTopology
+from app.service.pinning import NoCores
+from app.service.pinning import PinnedDomain
+from app.service.pinning import Pinning
+from tests.conftest import FIXTURES
+
+GIB = 1 << 20
+
+
+def topology(name):
+    return HostTopology.parse((FIXTURES / f"{name}.xml").read_text())
+
+
+def core_map(name, dedicated):
+    return CoreMap(topology(name), parse_cpuset(dedicated))
+
+
+def test_parse_single_cell():
+    host = topology("single_cell")
+    [cell] = host.cells
+    assert cell.id == 0
+    assert cell.memory == 16 * GIB
+    assert cell.cores == [(cpu,) for cpu in range(8)]
+    assert cell.pages == {4: 4 * GIB, 2048: 0, 1048576: 0}
+    assert host.cpus == set(range(8))
+
+
+def test_parse_smt():
+    host = topology("two_cells_smt")
+    assert [cell.id for cell in host.cells] == [0, 1]
+    # thread siblings together, once per core
+    assert host.cells[0].cores == [(0, 8), (1, 9), (2, 10), (3, 11)]
+    assert host.cells[1].cores == [(4, 12), (5, 13), (6, 14), (7, 15)]
+    assert host.cpus == set(range(16))
+
+
+def test_parse_no_topology():
+    assert HostTopology.parse(
+        "<capabilities><host/></capabilities>").cells == []
+
+
+def test_place_single_cell():
+    cores = core_map("single_cell", "2-7")
+    assert cores.shared == {0, 1}
+    pinning = cores.allocate(uuid4(), 4, 4 * GIB)
+    [cell] = pinning.cells
+    assert (cell.node, cell.cpus, cell.memory) == (0, (2, 3, 4, 5), 4 * GIB)
+    assert pinning.held == {2, 3, 4, 5}
+    assert pinning.page_size is None
+    assert pinning.topology() == Topology(1, 4, 1)
+    # the next one gets the cores left
+    assert cores.allocate(uuid4(), 2, GIB).vcpus == [6, 7]
+
+
+def test_place_whole_cores():
+    # core 0 of each cell stays shared
+    cores = core_map("two_cells_smt", "1-3,5-7,9-11,13-15")
+    pinning = cores.allocate(uuid4(), 3, GIB)
+    assert pinning.vcpus == [1, 9, 2]
+    # the idle sibling is held too
+    assert pinning.held == {1, 9, 2, 10}
+    assert pinning.topology() == Topology(1, 3, 1)
+
+    pinning = cores.allocate(uuid4(), 4, GIB)
+    # the fullest cell it fits in
+    assert pinning.cells[0].node == 1
+    assert pinning.topology() == Topology(1, 2, 2)
+
+
+def test_place_across_cells():
+    cores = core_map("two_cells_smt", "1-3,5-7,9-11,13-15")
+    pinning = cores.allocate(uuid4(), 8, 8 * GIB)
+    assert [(cell.node, len(cell.cpus), cell.memory) for cell in pinning.cells
+           ] == [(0, 6, 6 * GIB), (1, 2, 2 * GIB)]
+    assert pinning.memory == 8 * GIB
+    # uneven cells, no guest topology
+    assert pinning.topology() is None
+
+
+def test_no_cores():
+    cores = core_map("single_cell", "2-7")
+    id = uuid4()
+    with pytest.raises(NoCores):
+        cores.allocate(id, 8, GIB)
+    # memory bound to the cell counts too
+    with pytest.raises(NoCores):
+        cores.allocate(id, 2, 32 * GIB)
+    assert id not in cores.pending
+    cores.allocate(uuid4(), 6, GIB)
+    with pytest.raises(NoCores):
+        cores.allocate(id, 1, GIB)
+
+
+def test_release_and_commit():
+    cores = core_map("two_cells_smt", "1-3,5-7,9-11,13-15")
+    first, second = uuid4(), uuid4()
+    held = cores.allocate(first, 6, 4 * GIB).held
+    cores.release(first)
+    assert cores.allocate(second, 6, 4 * GIB).held == held
+
+    cores.commit(second)
+    assert cores.pending == {}
+    assert second in cores.defined
+    assert cores.used == held
+    assert cores.used_memory == {0: 4 * GIB}
+    assert cores.allocate(uuid4(), 6, 4 * GIB).cells[0].node == 1
+
+    # read back from the host, nothing defined anymore
+    cores.load([])
+    assert cores.used == set() and cores.defined == set()
+
+
+def test_hugepages():
+    cores = core_map("hugepages", "0-7")
+    assert cores.page_sizes(2 * GIB) == [1048576, 2048]
+    assert cores.page_sizes(3 * 1024) == []
+    with pytest.raises(NoCores, match="no hugepages"):
+        cores.allocate(uuid4(), 1, 3 * 1024, hugepages=True)
+
+    # the largest pages first, only cell 0 has 1 GiB ones
+    pinning = cores.allocate(uuid4(), 2, 2 * GIB, hugepages=True)
+    assert (pinning.page_size, pinning.cells[0].node) == (1048576, 0)
+    pinning = cores.allocate(uuid4(), 2, 2 * GIB, hugepages=True)
+    assert (pinning.page_size, pinning.cells[0].node) == (2048, 0)
+    assert cores.free_memory(0, 2048) == 0
+    assert cores.free_memory(1, 2048) == GIB
+    # cell 1 has cores left, not the pages
+    with pytest.raises(NoCores):
+        cores.allocate(uuid4(), 2, 2 * GIB, hugepages=True)
+    # normal pages don't count against the hugepages
+    assert cores.allocate(uuid4(), 2, 2 * GIB).page_size is None
+
+
+def test_pinned_domain():
+    template = DomainTemplate.parse(
+        (FIXTURES.parent.parent / "templates" / "default.xml").read_text())
+    cores = core_map("hugepages", "0-7")
+    id = uuid4()
+    pinning = cores.allocate(id, 6, 6 * GIB, hugepages=True)
+    xml = template.render(
+        DomainSpec("vm1", 6, 6 * GIB, "/vm1.qcow2", uuid=id, pinning=pinning))
+
+    domain = PinnedDomain.parse(xml)
+    assert domain.id == id
+    assert domain.cpus == set(pinning.vcpus)
+    assert domain.memory == {cell.node: cell.memory for cell in pinning.cells}
+    assert domain.page_size == pinning.page_size
+
+    # what a worker reading the host back holds
+    other = core_map("hugepages", "0-7")
+    other.load([domain])
+    assert other.used == pinning.held
+    assert other.defined == {id}
+    assert other.free_memory(0, 2048) == cores.free_memory(0, 2048) - sum(
+        cell.memory for cell in pinning.cells if cell.node == 0)
+
+    # shared instances float on a set, nothing held
+    xml = template.render(DomainSpec("vm2", 2, GIB, "/vm2.qcow2", cpuset="0-1"))
+    assert PinnedDomain.parse(xml).cpus == set()
+
+
+def test_pinning_record():
+    pinning = core_map("two_cells_smt", "0-15").allocate(uuid4(), 10, 4 * GIB)
+    record = orjson.loads(orjson.dumps(pinning, default=sorted))
+    assert Pinning.from_record(record) == pinning
+
+
+class FakeConn:
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+
+    def getCapabilities(self):
+        return self.capabilities
+
+    def listAllDomains(self):
+        return []
+
+
+class FakeVirt:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def read(self, kind, fn, *args):
+        return fn(self.conn, *args)
+
+
+class FakePool:
+
+    def __init__(self, capabilities):
+        self.virt = FakeVirt(FakeConn(capabilities))
+
+    async def connect(self, host):
+        return self.virt
+
+
+async def test_placement_workers(redis, redis_server):
+    pool = FakePool((FIXTURES / "single_cell.xml").read_text())
+    config = SimpleNamespace(
+        hosts=[SimpleNamespace(name="h1", dedicated_cpus="2-7")])
+    # two API workers, each with its own core maps
+    mine = CpuPlacement(pool, config, 60, redis)
+    theirs = CpuPlacement(pool, config, 60, FakeAsyncRedis(server=redis_server))
+    assert mine.hosts == ["h1"]
+    assert await mine.shared("h1") == "0-1"
+
+    first, second = uuid4(), uuid4()
+    taken = await mine.allocate("h1", first, 4, GIB, False)
+    # allocated against the other worker's allocation
+    assert (await theirs.allocate("h1", second, 2, GIB, False)).vcpus == [6, 7]
+    with pytest.raises(NoCores):
+        await theirs.allocate("h1", uuid4(), 1, GIB, False)
+
+    await mine.release("h1", first)
+    assert (await theirs.allocate("h1", uuid4(), 4, GIB,
+                                  False)).vcpus == taken.vcpus
+
+    # committed, still counted by the worker that didn't read it back yet
+    await theirs.commit("h1", second)
+    await mine.map("h1")
+    claimed = await redis.hkeys(mine.pending_key("h1"))
+    assert str(second) in [id.decode() for id in claimed]
+    with pytest.raises(NoCores):
+        await mine.allocate("h1", uuid4(), 1, GIB, False)
+
+    with pytest.raises(NoCores, match="no dedicated CPUs"):
+        await mine.allocate("h2", uuid4(), 1, GIB, False)
@@ -0,0 +1,98 @@
+import pytest
+
+from app.service.ratelimit import LocalBuckets
+from app.service.ratelimit import RateLimited
+from app.service.ratelimit import RateLimiter
+from app.service.ratelimit import retry_after
+from app.service.ratelimit import TokenBucket
+from app.settings import RateLimitConfig
+
+CONFIG = RateLimitConfig(user_rate=1.0,
+                         user_burst=10,
+                         global_rate=100.0,
+                         global_burst=1000,
+                         costs={
+                             "create": 4,
+                             "batch": 1
+                         })
+
+
+async def test_user_bucket(redis):
+    limiter = RateLimiter(redis, CONFIG)
+    await limiter.admit(1, "create")
+    await limiter.admit(1, "create")
+    with pytest.raises(RateLimited) as e:
+        await limiter.admit(1, "create")
+    # 2 tokens left, 2 more at 1/s
+    assert 1.5 < e.value.retry_after <= 2.0
+    # other users have buckets of their own, admins don't use theirs
+    await limiter.admit(2, "create")
+    await limiter.admit(1, "create", unlimited_user=True)
+
+
+async def test_global_bucket(redis):
+    config = CONFIG.model_copy(update={"global_burst": 5, "global_rate": 1.0})
+    limiter = RateLimiter(redis, config)
+    await limiter.admit(1, "create")
+    with pytest.raises(RateLimited):
+        await limiter.admit(2, "create")
+    with pytest.raises(RateLimited):
+        await limiter.admit(3, "create", unlimited_user=True)
+
+
+async def test_cost_above_burst(redis):
+    limiter = RateLimiter(redis, CONFIG)
+    # priced per instance, more than the bucket holds takes all of it
+    await limiter.admit(1, "batch", units=50)
+    with pytest.raises(RateLimited):
+        await limiter.admit(1, "batch")
+
+
+async def test_free_and_disabled(redis):
+    limiter = RateLimiter(redis, CONFIG)
+    for _ in range(100):
+        await limiter.admit(1, "list")
+    limiter = RateLimiter(redis, CONFIG.model_copy(update={"enabled": False}))
+    for _ in range(100):
+        await limiter.admit(1, "create")
+
+
+class BrokenRedis:
+
+    def register_script(self, script):
+
+        async def call(keys, args):
+            raise ConnectionError("redis is down")
+
+        return call
+
+
+async def test_fallback():
+    limiter = RateLimiter(BrokenRedis(), CONFIG)
+    await limiter.admit(1, "create")
+    await limiter.admit(1, "create")
+    with pytest.raises(RateLimited):
+        await limiter.admit(1, "create")
+    assert limiter.fallback_until > 0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2.0, burst=4, tokens=4, ts=0.0)
+    assert bucket.wait(3, 0.0) == 0
+    bucket.take(3)
+    assert bucket.wait(3, 0.0) == 1.0
+    # refilled, never past the burst
+    assert bucket.wait(3, 10.0) == 0
+    assert bucket.tokens == 4
+
+
+def test_local_buckets():
+    buckets = LocalBuckets(CONFIG)
+    assert buckets.take(1, 10) == 0
+    assert buckets.take(1, 1) > 0
+    assert buckets.take(None, 10) == 0
+
+
+def test_retry_after():
+    assert retry_after(0.01) == "1"
+    assert retry_after(2.2) == "3"
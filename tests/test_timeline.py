@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from app.service.timeline import bucket
+from app.service.timeline import quantile
+from app.service.timeline import read_timeline
+from app.service.timeline import Stage
+from app.service.timeline import StageHistograms
+from app.service.timeline import Timeline
+
+
+def test_bucket():
+    assert bucket(0.05) == "0.1"
+    assert bucket(0.1) == "0.1"
+    assert bucket(3) == "5"
+    assert bucket(601) == "+Inf"
+
+
+def test_quantile():
+    assert quantile({}, 0.5) is None
+    histogram = {"0.1": 5, "1": 4, "60": 1, "count": 10}
+    assert quantile(histogram, 0.5) == 0.1
+    assert quantile(histogram, 0.9) == 1
+    assert quantile(histogram, 0.99) == 60
+    # beyond the last bucket
+    assert quantile({"+Inf": 2, "count": 2}, 0.5) is None
+
+
+def test_timeline(tmp_path):
+    path = tmp_path / "timeline.jsonl"
+    stages = []
+    with open(path, "a") as out:
+        timeline = Timeline(out, stages)
+        with timeline.stage("define"):
+            pass
+        with pytest.raises(KeyError):
+            with timeline.stage("boot"):
+                raise KeyError("vm1")
+        # a line the run is still writing
+        out.write('{"name": "ansi')
+    assert [stage.name for stage in stages] == ["define", "boot"]
+    assert stages[1].error == "KeyError: 'vm1'"
+    assert stages[0].duration >= 0
+    assert read_timeline(str(path)) == stages
+    assert read_timeline(str(tmp_path / "missing")) == []
+    assert json.loads(path.read_text().splitlines()[0])["error"] is None
+
+
+async def test_histograms(redis):
+    histograms = StageHistograms(redis)
+    await histograms.observe([
+        Stage("copy", 0, 3),
+        Stage("copy", 0, 50),
+        Stage("boot", 0, 0.2, error="TimeoutError: "),
+    ])
+    snapshot = await histograms.snapshot()
+    assert snapshot["copy"] == {"5": 1, "60": 1, "count": 2, "sum": 53}
+    assert snapshot["boot"]["errors"] == 1
+    assert quantile(snapshot["copy"], 0.5) == 5